@@ -33,8 +33,9 @@
 #        - planner (..eventually)
 #
 
-import sys, random, time, thread
+import os, sys, random, time, thread
 import collections
+from math import atan2, hypot
 import asyncore
 import logging
 
@@ -44,6 +45,12 @@ LOG.setLevel(logging.DEBUG)
 
 import comm
 import conf
+from comm import tracing
+from face.engine import AUPool, PROFILES, DEFAULT_PROFILE, get_profile
+from face.timeline import compile_script, TimelineError
+from face.expressions import ExpressionLibrary, ExpressionError
+
+EXPRESSION_DURATION = .5        # default duration of expression changes
 
 # This module handles more than just facial expressions, so sort things a bit by
 #  specifying where each AU is.
@@ -59,43 +66,187 @@ AREAS = { 'face' : ('01L', '01R', '02L', '02R', '04L', '04R', '05L', '05R',
           'lips' : ()
           }
 
+# Objects driven by AUs in the backends, see Face.update_targets()
+TARGET_SHAPE, TARGET_EYES, TARGET_JAW, TARGET_TONGUE = range(4)
+
+def AU_target(name):
+    """Returns the kind of object driven by the AU called name."""
+    if name[0] == '6':
+        return TARGET_EYES
+    if name == '26':
+        return TARGET_JAW
+    if name[0] == '9':
+        return TARGET_TONGUE
+    return TARGET_SHAPE
+
+
 class FaceProtocolError(comm.ProtocolError):
     pass
 
 class FaceError(comm.CmdError):
     pass
 
+
+def gaze_to_AUs(x, y, z, duration):
+    """Converts a gaze vector to eye AUs (in radians).
+    The vector uses the face reference: the face looks towards -Y, Z is up.
+    """
+    azimuth, elevation = atan2(x, -y), atan2(z, hypot(x, y))
+    return (('61.5L', azimuth, duration), ('61.5R', azimuth, duration),
+            ('63.5', elevation, duration))
+
+
+def parse_AU(argline):
+    """Returns AU tuples from the arguments of an AU command:
+     AU_name  target_value  duration  [motion profile].
+    """
+    args = argline.split()
+    try:
+        au_name, value, duration = args[:3]
+        AU = (au_name, float(value), float(duration))
+    except ValueError, e:
+        raise FaceProtocolError("[AU] invalid float argument (%s)" % e)
+    if len(args) > 3:
+        try:
+            AU += (get_profile(args[3]),)
+        except KeyError:
+            raise FaceProtocolError("[AU] unknown motion profile %s "
+                                    "(have: %s)" % (args[3], PROFILES))
+    return (AU,)
+
+def parse_gaze(argline):
+    """Returns AU tuples from the arguments of a gaze command: x y z [duration].
+    """
+    try:
+        vector = [ float(v) for v in argline.split() ]
+    except ValueError, e:
+        raise FaceProtocolError("[gaze] invalid float argument (%s)" % e)
+    if len(vector) not in (3, 4):
+        raise FaceProtocolError("[gaze] expected x y z [duration]")
+    return gaze_to_AUs(*(vector+[0])[:4])
+
+def parse_expression(argline):
+    """Returns ({ expression : weight }, duration) from the arguments of an
+    expression command: name[:weight] [name[:weight] ...] [duration].
+    """
+    args, weights = argline.split(), {}
+    duration = EXPRESSION_DURATION
+    try:
+        if args and ':' not in args[-1] and args[-1][0] in '.0123456789':
+            duration = float(args.pop())
+        for arg in args:
+            name, weight = (arg.split(':', 1) + ['1'])[:2]
+            weights[name] = float(weight)
+    except ValueError, e:
+        raise FaceProtocolError("[expression] invalid float argument (%s)" % e)
+    if not weights:
+        raise FaceProtocolError("[expression] expected name[:weight] ... "
+                                "[duration]")
+    return weights, duration
+
+# commands available in timeline scripts (see timeline.py), see also
+#  Face.get_timeline_commands()
+TIMELINE_COMMANDS = { 'AU'   : parse_AU,
+                      'gaze' : parse_gaze }
+
+
 class FaceComm(object):
     """Remote connection handler: protocol parser."""
     
     def __init__(self, *args):
         self.fifo = collections.deque()
+        self.script = []                # timeline script being uploaded
 
     def cmd_AU(self, argline):
         """if empty, returns current values. Otherwise, set them.
-         argline: sending_module AU_name  target_value  duration.
+         argline: AU_name  target_value  duration  [motion profile].
+         In binary mode: tuple of (AU_name, target_value, duration).
+         Motion profiles are listed in face.engine.PROFILES (default: linear).
         """
-        if len(argline):
-            try:
-                au_name, value, duration = argline.split()[:3]
-                self.fifo.append((au_name, float(value), float(duration)))
-            except ValueError, e:
-                raise FaceProtocolError("[AU] invalid float argument (%s)", e)
+        if hasattr(argline, '__iter__'):
+            self.fifo.extend(argline)
+        elif len(argline):
+            self.fifo.extend(parse_AU(argline))
         else:
             msg = ""
             AU_info = self.server.get_all_AU()
             AU_info.sort()
             # name, target, duration
             for triplet in AU_info:
-                msg += "AU {0[0]:5s} {0[1]} {0[2]:.3f}\n".format(triplet)
+                msg += "AU {0[0]:5s} {0[1]:.3f} {0[2]:.3f}\n".format(triplet)
             self.send_msg(str(msg))
 
 
+    def cmd_gaze(self, argline):
+        """Sets eyes orientation from a gaze vector (see gaze_to_AUs).
+         argline: x y z [duration].
+         In binary mode: tuple of (x, y, z, duration).
+        """
+        if hasattr(argline, '__iter__'):
+            for x, y, z, duration in argline:
+                self.fifo.extend(gaze_to_AUs(x, y, z, duration))
+        else:
+            self.fifo.extend(parse_gaze(argline))
+
+    def cmd_expression(self, argline):
+        """Sets AUs to a blend of expressions of the face's library.
+         argline: name[:weight] [name[:weight] ...] [duration]
+          eg. expression happy:.3 surprise:.5 1
+         If empty, returns the names of available expressions.
+        """
+        if not argline.strip():
+            return self.send_msg('expressions %s' %
+                                 ' '.join(self.server.expressions.names))
+        weights, duration = parse_expression(argline)
+        try:
+            self.server.set_expression(weights, duration)
+        except ExpressionError, e:
+            raise FaceProtocolError("[expression] %s" % e)
+
     def cmd_commit(self, argline):
         """Commit buffered updates"""
-        self.server.set_AUs(self.fifo)
+        transaction_id, received = tracing.new_transaction()
+        committed = tracing.monotonic()
+        tracing.record('receive to commit', committed - received)
+        self.server.set_AUs(self.fifo, (transaction_id, received, committed))
         self.fifo.clear()
 
+    def cmd_timeline(self, argline):
+        """Uploads and controls the timeline played by the face (see
+         timeline.py). If empty, returns the timeline status.
+         argline: key time command arguments: adds a line to the script.
+                  load: replaces the timeline with the script uploaded so far.
+                  clear: forgets the script uploaded so far.
+                  play [scale] | pause | seek position | loop on|off
+        Replies ACK timeline <argline> or NACK timeline <argline> <error>.
+        """
+        args = argline.split(None, 1)
+        if not args:
+            timeline = self.server.timeline
+            if timeline is None:
+                return self.send_msg('timeline none')
+            return self.send_msg('timeline %i %.3f %.3f %s %.3f %s' % (
+                    len(timeline), timeline.position, timeline.length,
+                    timeline.playing and 'playing' or 'paused', timeline.scale,
+                    timeline.loop and 'loop' or 'once'))
+        action, argline = (args + [''])[:2]
+        if action == 'key':
+            self.script.append(argline)
+            return
+        try:
+            if action == 'clear':
+                self.script = []
+            elif action == 'load':
+                self.server.set_timeline(compile_script(
+                        self.script, self.server.get_timeline_commands()))
+                self.script = []
+            else:
+                self.server.control_timeline(action, argline)
+        except (TimelineError, ValueError), e:
+            return self.send_msg('NACK timeline %s %s' % (
+                    ' '.join(args), str(e).replace('\n', ' ')))
+        self.send_msg('ACK timeline %s' % ' '.join(args))
+
     # def cmd_start(self, argline):
     #     try:
     #         start = float(argline.strip())
@@ -118,104 +269,232 @@ class Face(object):
     Also maintains consistent muscle activation.
     AU value is normalized: 0 -> AU not streched, 1 -> stretched to max
     Setting an AU target value overwrites previous target.
-    On target overwrite, interpolation starts from current value.
+    On target overwrite, interpolation starts from current value, following
+     the motion profile given with the target (default: linear).
+    AU states are held by an AUPool (see engine.py).
     """
 
     def __init__(self):
-        self.AUs = {}
+        self.AUs = AUPool()
+        self.expressions = ExpressionLibrary.compile({}, [])
+        self.timeline = None
+        self.transactions = []  # committed, waiting for the next update
+        self.applied = []       # applied by the last update, not rendered yet
+        self.updated_at = tracing.monotonic()
         self.thread_id = thread.get_ident()
 
-    # TODO: it maybe slightly quicker if each area would have its own dict.
-    def get_features(self, origin):
-        """To get features for the cognition part.
-         origin: part of interest for servers managing more than 1 feature type.
-        """
-        if not origin:
-            return self.AUs
-        return [(k,v[-1]) for k,v in self.AUs.iteritems() if k in AREAS[origin]]
-
-    # TODO: it maybe slightly quicker if each area would have its own dict.
     def get_features(self, origin):
         """To get features for the cognition part.
          origin: part of interest for servers managing more than 1 feature type.
         """
+        names, values = self.AUs.names, self.AUs.value.tolist()
         if not origin:
-            return self.AUs
-        return [(k,v[-1]) for k,v in self.AUs.iteritems() if k in AREAS[origin]]
+            return zip(names, values)
+        return [ (n, v) for n, v in zip(names, values) if n in AREAS[origin] ]
 
     def get_all_AU(self):
-        return [(item[0],item[1][0],item[1][1])for item in self.AUs.iteritems()]
+        return [ (name,)+self.get_AU(name)[:2] for name in self.AUs.names ]
 
     def get_AU(self, name):
-        return self.AUs[name]
+        """Returns (target value, duration, elapsed, value).
+        Raises KeyError if the AU is not available."""
+        i, AUs = self.AUs.index[name], self.AUs
+        return (float(AUs.get_target(i)), float(AUs.duration[i]),
+                float(AUs.elapsed[i]), float(AUs.value[i]))
 
     def set_available_AUs(self, available_AUs):
         """Define list of AUs available for a specific face.
          available_AUs: list of AU names.
         """
-        for name in available_AUs:
-            # target_coeffs, duration, elapsed, value
-            self.AUs[name] = [(0,0) , .0 , .0, .0]
-        LOG.info("Available AUs: %s" % sorted(self.AUs.keys()))
-#        missing = 
-
-    def set_AUs(self, iterable):
+        self.AUs.set_names(available_AUs,
+                           [ AU_target(name) for name in available_AUs ])
+        LOG.info("Available AUs: %s" % sorted(self.AUs.names))
+        self.expressions = ExpressionLibrary.load(
+            self.AUs.names, getattr(conf, 'face_expressions', None))
+        LOG.info("Available expressions: %s" % self.expressions.names)
+
+    def set_AUs(self, iterable, transaction=None):
         """Set targets for a specific AU, giving priority to specific inputs.
-        iterable: array of (AU name, normalized target value, duration in sec.)
+        iterable: array of (AU name, normalized target value, duration in sec.
+         [, motion profile index (see engine.get_profile)])
+        transaction: (ID, time received, time committed) for tracing.
         """
         if self.thread_id != thread.get_ident():
             self.threadsafe_start()
-        for name, target_value, duration in iterable:
+        if transaction:
+            now = tracing.monotonic()
+            tracing.record('commit to set', now - transaction[2])
+            self.transactions.append(transaction + (now,))
+        self._set_AUs(iterable)
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_stop()
+
+    def _set_AUs(self, iterable):
+        indices, targets, durations, profiles = [], [], [], []
+        index = self.AUs.index
+        default_profile = get_profile(DEFAULT_PROFILE)
+        for AU in iterable:
+            name, target_value, duration = AU[:3]
+            profile = default_profile
+            if len(AU) > 3:
+                profile = AU[3]
             duration = max(duration, .001)
-            if self.AUs.has_key(name):
-                self.AUs[name][:3] = (
-                    ((target_value-self.AUs[name][3])/duration,
-                     self.AUs[name][3]), duration, 0)
+            if index.has_key(name):
+                names = (name,)
+            elif index.has_key(name+'R') and index.has_key(name+'L'):
+                names = (name+'R', name+'L')
             else:
-                try:
-                    self.AUs[name+'R'][:3] = (
-                        ((target_value-self.AUs[name+'R'][3])/duration,
-                         self.AUs[name+'R'][3]), duration, 0)
-                    self.AUs[name+'L'][:3] = (
-                        ((target_value-self.AUs[name+'L'][3])/duration,
-                         self.AUs[name+'L'][3]), duration, 0)
-                except KeyError, e:
-                    LOG.warning('AU %s not found (%s)', name, e)
+                LOG.warning('AU %s not found', name)
+                continue
+            for name in names:
+                indices.append(index[name])
+                targets.append(target_value)
+                durations.append(duration)
+                profiles.append(profile)
+        if indices:
+            self.AUs.set_targets(indices, targets, durations, profiles)
+
+    def set_expression(self, weights, duration=EXPRESSION_DURATION,
+                       profile=None):
+        """Sets AUs used by expressions to a blend of expressions.
+        weights: { expression name : weight }, see ExpressionLibrary.blend().
+        """
+        targets = self.expressions.blend(weights)
+        indices = self.expressions.indices
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_start()
+        self.AUs.set_targets(indices, targets[indices], max(duration, .001),
+                             profile)
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_stop()
+
+    def get_expression_AUs(self, weights, duration=EXPRESSION_DURATION):
+        """Returns AU tuples setting a blend of expressions."""
+        targets = self.expressions.blend(weights)
+        names = self.AUs.names
+        return [ (names[i], targets[i], duration) for i in
+                 self.expressions.indices.tolist() ]
+
+    def get_timeline_commands(self):
+        """Returns the commands available to timeline scripts: those of
+         TIMELINE_COMMANDS, expression, and f_expr (name intensity duration)
+         from .lpd files."""
+        def expression(argline):
+            return self.get_expression_AUs(*parse_expression(argline))
+        def f_expr(argline):
+            try:
+                name, intensity, duration = argline.split()[:3]
+                return self.get_expression_AUs({name: float(intensity)},
+                                               float(duration))
+            except ValueError, e:
+                raise FaceProtocolError("[f_expr] expected name intensity "
+                                        "duration (%s)" % e)
+        commands = dict(TIMELINE_COMMANDS)
+        commands['expression'] = expression
+        commands['f_expr'] = f_expr
+        return commands
+
+    def set_timeline(self, timeline):
+        """Replaces the timeline (see timeline.py), paused at its start."""
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_start()
+        self.timeline = timeline
         if self.thread_id != thread.get_ident():
             self.threadsafe_stop()
 
+    def control_timeline(self, action, argline=''):
+        """Controls playback of the timeline.
+        action: play [scale] | pause | seek position | loop on|off
+        Raises TimelineError on bad action or arguments.
+        """
+        if self.timeline is None:
+            raise TimelineError('no timeline loaded')
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_start()
+        try:
+            try:
+                if action == 'play':
+                    self.timeline.play(argline and float(argline) or None)
+                elif action == 'pause':
+                    self.timeline.pause()
+                elif action == 'seek':
+                    self._set_AUs(self.timeline.seek(float(argline)))
+                elif action == 'loop' and argline.strip() in ('on', 'off'):
+                    self.timeline.loop = argline.strip() == 'on'
+                else:
+                    raise TimelineError('bad timeline action: %s %s' % (
+                            action, argline))
+            except ValueError, e:
+                raise TimelineError('%s: invalid argument (%s)' % (action, e))
+        finally:
+            if self.thread_id != thread.get_ident():
+                self.threadsafe_stop()
+
     def solve(self):
         """Here we can set additional checks (eg. AU1 vs AU4, ...)
         """
 
+    def _step(self, time_step):
+        """Plays the timeline and advances AUs. Returns the result of
+        AUPool.step()."""
+        start = tracing.monotonic()
+        if self.timeline is not None:
+            self._set_AUs(self.timeline.advance(time_step))
+        result = self.AUs.step(time_step)
+        self.updated_at = tracing.monotonic()
+        tracing.record('face update', self.updated_at - start)
+        for transaction in self.transactions:
+            tracing.record('receive to update', start - transaction[1])
+            self.applied.append(transaction + (start,))
+        self.transactions = []
+        return result
+
+    def frame_done(self):
+        """To be called by backends once the changes returned by update() or
+        update_targets() are applied (eg. rendered)."""
+        now = tracing.monotonic()
+        tracing.record('backend update', now - self.updated_at)
+        for tid, received, committed, set_at, updated in self.applied:
+            tracing.record('receive to frame', now - received)
+            tracing.TRACER.complete(tid, (('received', received),
+                                          ('committed', committed),
+                                          ('set', set_at),
+                                          ('updated', updated),
+                                          ('rendered', now)))
+        self.applied = []
+
     def update(self, time_step):
         """Update AU values. This function shall be called for each frame.
          time_step: time in seconds elapsed since last call.
+        Returns: [ (AU name, value) ] of AUs which value changed.
         """
         if self.thread_id != thread.get_ident():
             self.threadsafe_start()
-        #TODO: motion dynamics
-        to_update = collections.deque()
-        for id, info in self.AUs.iteritems():
-            coeffs, duration, elapsed, value = info
-            target = coeffs[0] * duration + coeffs[1]
-            elapsed += time_step
-            if elapsed >= duration:      # keep timing
-                if value != target:
-                    self.AUs[id][2:] = duration, target
-                    to_update.append((id, target))
-                continue
+        indices, values = self._step(time_step)
+        to_update = zip(map(self.AUs.names.__getitem__, indices.tolist()),
+                        values.tolist())
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_stop()
+        return to_update
 
-            up_value = coeffs[0] * elapsed + coeffs[1]
-            self.AUs[id][2:] = elapsed, up_value
-            to_update.append((id, up_value))
+    def update_targets(self, time_step):
+        """Like update(), with changes grouped by target (see AU_target()).
+        Returns: { target : (AU indices, values) } of targets with changed
+         AUs, empty if nothing changed. Use self.AUs.names to get AU names.
+        """
         if self.thread_id != thread.get_ident():
             self.threadsafe_start()
-        return to_update
+        changes = self.AUs.split(*self._step(time_step))
+        if self.thread_id != thread.get_ident():
+            self.threadsafe_stop()
+        return changes
 
 
+# backend animating the face: the one linked as face/backend (eg. blender),
+#  unless the FACE_BACKEND environment variable names another (eg. headless).
+FACE_BACKEND = os.environ.get('FACE_BACKEND', 'backend')
 try:
-    from face.backend import main
+    main = __import__('face.'+FACE_BACKEND, fromlist=['main']).main
 except ImportError, e:
     print 
     print '*** FACE MISCONFIGURATION ***'
@@ -37,6 +37,8 @@ import sys, time, atexit
 from math import cos, sin, pi
 import GameLogic as G
 
+from face import TARGET_SHAPE, TARGET_EYES, TARGET_JAW, TARGET_TONGUE
+
 MAX_FPS = 50
 
 # A word on threading:
@@ -132,6 +134,14 @@ def initialize(server_addrPort):
     # TODO: p26 is copied on the 'jaw' bone too, use the one from face mesh.
     G.server[FACE].set_available_AUs([n[1:] for n in owner.getPropertyNames()])
 
+    # per AU index: property name and Shape Action actuator (or None)
+    names = G.server[FACE].AUs.names
+    actuators = dict([ (act.name, act) for act in acts ])
+    G.AU_props = [ 'p'+name for name in names ]
+    G.AU_actuators = [ actuators.get(name) for name in names ]
+    # (cos, sin) of the eye AUs, updated when they change
+    G.eye_trig = dict([ (name, (1.0, 0.0)) for name in EXTRA_PROPS ])
+
     # ok, startup
     G.initialized = True	
     G.setMaxLogicFrame(1)       # relative to rendering
@@ -143,42 +153,53 @@ def initialize(server_addrPort):
     G.last_update_time = time.time()    
     return cont
 
+def update_eyes():
+    """Sets eyes orientation from cached trigonometric values of eye AUs."""
+    # The model is supposed to look towards negative Y values
+    # Also Up is positive Z values
+    cx, sx = G.eye_trig['63.5']
+    sx = -sx                    # ax = -AU 63.5
+    for eye, AU in ((G.eye_L, '61.5R'), (G.eye_R, '61.5L')):
+        cz, sz = G.eye_trig[AU]
+        # No ACTION for eyes
+        eye.localOrientation = [ [cz,    -sz,     0  ],
+                                 [cx*sz,  cx*cz, -sx ],
+                                 [sx*sz,  sx*cz,  cx ] ]
+
 def update(faceServer, time_diff):
-    """
+    """Applies AUs changed since last frame, grouped by driven object.
+    Nothing is done for idle AUs.
     """
     global INFO_PERIOD
 
-    cont = G.getCurrentController()
-    eyes_done = False
-
     # threaded server is thread-safe
-    for au, value in faceServer.update(time_diff):
-        if au[0] == '6':        # XXX: yes, 6 is an eye prefix (do better ?)
-            if eyes_done:
-                continue
-            # The model is supposed to look towards negative Y values
-            # Also Up is positive Z values
-            ax  = -faceServer.get_AU('63.5')[3]
-            az0 = faceServer.get_AU('61.5R')[3]
-            az1 = faceServer.get_AU('61.5L')[3]
-            # No ACTION for eyes
-            G.eye_L.localOrientation = [
-                [cos(az0),        -sin(az0),         0],
-                [cos(ax)*sin(az0), cos(ax)*cos(az0),-sin(ax)],
-                [sin(ax)*sin(az0), sin(ax)*cos(az0), cos(ax)] ]
-            G.eye_R.localOrientation = [
-                [cos(az1),        -sin(az1),          0],
-                [cos(ax)*sin(az1), cos(ax)*cos(az1),-sin(ax)],
-                [sin(ax)*sin(az1), sin(ax)*cos(az1), cos(ax)] ]
-            eyes_done = True
-        elif au == '26':
-            # TODO: try with G.setChannel
-            G.jaw['p26'] = SH_ACT_LEN * value    # see always sensor in .blend
-        elif au[0] == '9':      # XXX: yes, 6 is a tongue prefix (do better ?)
-            G.tongue[au] = SH_ACT_LEN * value
-        else:
-            cont.owner['p'+au] = value * SH_ACT_LEN
-            cont.activate(cont.actuators[au])
+    changes = faceServer.update_targets(time_diff)
+    names = faceServer.AUs.names
+
+    if changes.has_key(TARGET_SHAPE):
+        indices, values = changes[TARGET_SHAPE]
+        indices = indices.tolist()
+        cont = G.getCurrentController()
+        owner = cont.owner
+        for i, value in zip(indices, (values * SH_ACT_LEN).tolist()):
+            owner[G.AU_props[i]] = value
+        for i in indices:
+            if G.AU_actuators[i]:
+                cont.activate(G.AU_actuators[i])
+    if changes.has_key(TARGET_EYES):
+        indices, values = changes[TARGET_EYES]
+        for i, value in zip(indices.tolist(), values.tolist()):
+            G.eye_trig[names[i]] = cos(value), sin(value)
+        update_eyes()
+    if changes.has_key(TARGET_JAW):
+        # TODO: try with G.setChannel
+        values = changes[TARGET_JAW][1]
+        G.jaw['p26'] = SH_ACT_LEN * float(values[-1])  # see always sensor
+    if changes.has_key(TARGET_TONGUE):
+        indices, values = changes[TARGET_TONGUE]
+        for i, value in zip(indices.tolist(), (values * SH_ACT_LEN).tolist()):
+            G.tongue[names[i]] = value
+    faceServer.frame_done()
 
     INFO_PERIOD += time_diff
     if INFO_PERIOD > 5:
@@ -205,8 +226,15 @@ def main(addr_port):
                 import comm; comm.set_default_logging(debug=True)
 
             cont = initialize(conf.lightHead_server)
-            G.server.set_listen_timeout(0.001)
+            # the game loop calls serve_once() every frame: never block it
+            G.server.set_poll_timeout(0)
             G.server.start()
+            # optional same-host client through shared memory (see comm.shm)
+            if hasattr(conf, 'lightHead_shm'):
+                from comm.shm import ShmChannel
+                channel = ShmChannel()
+                channel.create(conf.lightHead_shm)
+                G.server.serve_channel(channel, conf.lightHead_shm)
         except conf.LoadException, e:
             fatal('in file {0[0]}: {0[1]}'.format(e)) 
         except Exception, e:
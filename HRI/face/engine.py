@@ -0,0 +1,172 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+AU interpolation engine.
+
+The state of all AUs is held in numpy arrays indexed by AU (see AUPool.index),
+ so that a single vectorized step advances every AU each frame:
+ value = start + delta * profile(elapsed / duration), with elapsed growing up
+ to duration.
+Only AUs which value changed are reported to the backend, optionally split by
+ group (eg. the kind of object an AU drives, see AUPool.split()).
+
+Each transition follows a motion profile (easing curve) mapping the progress
+ of the transition (0 to 1) to the fraction of delta reached. Profiles are
+ sampled once in a lookup table (see PROFILES): the step interpolates between
+ samples only for AUs still moving with a non-linear profile, the fraction of
+ the others being their progress.
+"""
+
+import numpy
+
+LUT_SIZE = 256          # samples per profile (plus the end point)
+SPRING_STIFFNESS = 8.   # natural frequency of the spring, per duration
+
+
+def _spring(s):
+    """Critically damped spring, scaled to reach the target at s = 1."""
+    w = SPRING_STIFFNESS
+    return (1 - (1 + w*s) * numpy.exp(-w*s)) / (1 - (1 + w) * numpy.exp(-w))
+
+# { profile name : progress to fraction of the transition } 0 -> 0, 1 -> 1
+PROFILE_FUNCTIONS = {
+    'linear'      : lambda s: s,
+    'ease_in'     : lambda s: s**2,
+    'ease_out'    : lambda s: 1 - (1-s)**2,
+    'ease_in_out' : lambda s: 3*s**2 - 2*s**3,
+    'min_jerk'    : lambda s: 10*s**3 - 15*s**4 + 6*s**5,
+    'spring'      : _spring,
+    }
+DEFAULT_PROFILE = 'linear'
+
+PROFILES = sorted(PROFILE_FUNCTIONS.keys())     # profile index : name
+LINEAR = PROFILES.index('linear')
+_PROGRESS = numpy.linspace(0, 1, LUT_SIZE+1)
+LUT = numpy.array([ PROFILE_FUNCTIONS[name](_PROGRESS) for name in PROFILES ])
+
+
+def get_profile(name):
+    """Returns the index of a profile. Raises KeyError if unknown."""
+    try:
+        return PROFILES.index(name)
+    except ValueError:
+        raise KeyError(name)
+
+
+class AUPool(object):
+    """Array-backed state of a set of AUs.
+    names: AU names, in index order.
+    index: { AU name : index in the arrays }
+    group: group number of each AU.
+    """
+
+    def __init__(self, names=()):
+        self.set_names(names)
+
+    def set_names(self, names, groups=None):
+        """Resets the pool with AUs called names, all values set to 0.
+        groups: group number of each AU (default: all in group 0)."""
+        self.names = list(names)
+        self.index = dict([ (n, i) for i, n in enumerate(self.names) ])
+        size = len(self.names)
+        self.group = numpy.zeros(size, dtype=int)
+        if groups is not None:
+            self.group[:] = groups
+        self.start = numpy.zeros(size)
+        self.delta = numpy.zeros(size)
+        self.duration = numpy.ones(size)        # transitions done: progress 1
+        self.elapsed = numpy.ones(size)
+        self.value = numpy.zeros(size)
+        self.profile = numpy.zeros(size, dtype=int)
+        self.profile[:] = LINEAR
+        # preallocated buffers for step(), AUs with a non-linear profile
+        self._progress = numpy.ones(size)
+        self._values = numpy.zeros(size)
+        self._curved = numpy.zeros(size, dtype=bool)
+        self._curves_moving = False
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.index.has_key(name)
+
+    def get_target(self, i):
+        """Value AU of index i reaches at the end of its transition."""
+        return self.start[i] + self.delta[i]
+
+    def set_targets(self, indices, targets, durations, profiles=None):
+        """Starts transitions from current values of AUs indices (sequences of
+        same length). A duration shall not be 0.
+        profiles: profile indices (see get_profile()), default is linear."""
+        indices = numpy.asarray(indices, dtype=int)
+        current = self.value[indices]
+        self.start[indices] = current
+        self.delta[indices] = numpy.asarray(targets) - current
+        self.duration[indices] = durations
+        self.elapsed[indices] = 0
+        if profiles is None:
+            profiles = get_profile(DEFAULT_PROFILE)
+        self.profile[indices] = profiles
+        curved = self.profile[indices] != LINEAR
+        self._curved[indices] = curved
+        self._curves_moving = self._curves_moving or curved.any()
+
+    def step(self, time_step):
+        """Advances all AUs by time_step seconds.
+        Returns: (indices of the AUs which value changed, their new values)
+        """
+        elapsed = self.elapsed
+        elapsed += time_step
+        numpy.minimum(elapsed, self.duration, elapsed)
+        # fraction of delta reached, progress for linear and finished AUs
+        fraction = self._progress
+        numpy.divide(elapsed, self.duration, fraction)
+        if self._curves_moving:
+            curved = numpy.flatnonzero(self._curved & (fraction < 1))
+            self._curves_moving = len(curved) > 0
+        if self._curves_moving:
+            # linear interpolation between the 2 closest samples of profiles
+            position = fraction[curved] * LUT_SIZE
+            sample = position.astype(int)
+            position -= sample
+            sample += self.profile[curved] * (LUT_SIZE+1)
+            curve = LUT.take(sample)
+            curve += (LUT.take(sample+1) - curve) * position
+            fraction[curved] = curve
+        values = self._values
+        numpy.multiply(self.delta, fraction, values)
+        values += self.start
+        changed = numpy.flatnonzero(values != self.value)
+        values = values[changed]
+        self.value[changed] = values
+        return changed, values
+
+    def split(self, indices, values):
+        """Splits the result of step() by group of AUs.
+        Returns: { group : (indices, values) } for groups with changed AUs.
+        """
+        groups = {}
+        if not len(indices):
+            return groups
+        of_changed = self.group[indices]
+        for group in numpy.unique(of_changed).tolist():
+            mask = of_changed == group
+            groups[group] = indices[mask], values[mask]
+        return groups
@@ -0,0 +1,159 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Library of facial expressions.
+
+An expression is a set of AU weights. Expressions are compiled for the AUs
+ of a face into a matrix (one column per expression, one row per AU), so that
+ a blend of expressions (eg. 0.3 happy + 0.5 surprise) is a single
+ matrix-vector product giving the targets of all AUs.
+
+Definitions are read from a text file, one expression per line:
+ name AU:weight AU:weight ...
+AU names without side (eg. 12) apply to both sides (12L and 12R). Lines
+ starting with '#' are comments.
+The compiled matrix is cached in a binary file (numpy .npz) next to the
+ definitions, and reused while the definitions and the face's AUs are the
+ same.
+"""
+
+import os
+import logging
+
+import numpy
+
+LOG = logging.getLogger("face-srv")
+
+# default definitions, from the affect module's AU map
+DEFAULT_EXPRESSIONS = {
+    'neutral'  : {},
+    'happy'    : { '07':.8, '10':.8, '12':.8, '25':.8 },
+    'sad'      : { '17':.8, '16':.8, '15':.8, '01':.8, '02':.8, '04':.8 },
+    'disgust'  : { '17':.8, '16':.8, '15':.8, '10':.8, '09':.8 },
+    'surprise' : { '27':.2, '01':.2 },                  # jaw relax
+    'fear'     : { '01':.2, '10':.6, '25':.7 },
+    'anger'    : { '04':.6, '09':.9, '10':.8, '17':.7 },
+    }
+
+
+class ExpressionError(Exception):
+    pass
+
+
+def read_definitions(f):
+    """Returns { expression name : { AU name : weight } } from lines of f."""
+    expressions = {}
+    for number, line in enumerate(f):
+        tokens = line.split()
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        try:
+            expressions[tokens[0]] = dict([ (AU, float(weight)) for AU, weight
+                                            in [ t.split(':') for t in
+                                                 tokens[1:] ] ])
+        except ValueError, e:
+            raise ExpressionError('line %i: %s (%s)' % (number+1,
+                                                        line.strip(), e))
+    return expressions
+
+
+class ExpressionLibrary(object):
+    """Expressions compiled for a face.
+    names: expression names, in column order.
+    AUs: AU names of the face, in row order (same as the face's AUPool).
+    weights: matrix of AU weights (AUs x expressions).
+    indices: indices of the AUs used by at least one expression.
+    """
+
+    def __init__(self, names, AUs, weights):
+        self.names = list(names)
+        self.AUs = list(AUs)
+        self.weights = weights
+        self.index = dict([ (n, i) for i, n in enumerate(self.names) ])
+        self.indices = numpy.flatnonzero(weights.any(axis=1))
+
+    @classmethod
+    def compile(cls, expressions, AUs):
+        """Builds the library from { name : { AU name : weight } } for a face
+        having the given AU names."""
+        rows = dict([ (AU, i) for i, AU in enumerate(AUs) ])
+        names = sorted(expressions.keys())
+        weights = numpy.zeros((len(AUs), len(names)))
+        for column, name in enumerate(names):
+            for AU, weight in expressions[name].iteritems():
+                matches = [ n for n in (AU, AU+'L', AU+'R') if
+                            rows.has_key(n) ]
+                if not matches:
+                    LOG.debug('expression %s: no AU %s in this face', name, AU)
+                for n in matches:
+                    weights[rows[n], column] = weight
+        return cls(names, AUs, weights)
+
+    @classmethod
+    def load(cls, AUs, path=None):
+        """Returns the library for a face having the given AU names.
+        path: definitions file, compiled through its cache (path.npz).
+         Default: DEFAULT_EXPRESSIONS, without cache.
+        """
+        if not path:
+            return cls.compile(DEFAULT_EXPRESSIONS, AUs)
+        cache = path + '.npz'
+        mtime = os.path.getmtime(path)
+        try:
+            data = numpy.load(cache)
+            try:
+                if data['mtime'] == mtime and data['AUs'].tolist() == AUs:
+                    LOG.info('loaded expressions from %s', cache)
+                    return cls(data['names'].tolist(), AUs, data['weights'])
+            finally:
+                data.close()
+        except (IOError, KeyError, ValueError), e:
+            LOG.debug('no valid expression cache %s (%s)', cache, e)
+        f = open(path)
+        try:
+            library = cls.compile(read_definitions(f), AUs)
+        finally:
+            f.close()
+        try:
+            library.save(cache, mtime)
+        except IOError, e:
+            LOG.warning('could not save expression cache %s (%s)', cache, e)
+        return library
+
+    def save(self, cache, mtime):
+        f = open(cache, 'wb')
+        try:
+            numpy.savez(f, names=numpy.array(self.names),
+                        AUs=numpy.array(self.AUs), weights=self.weights,
+                        mtime=mtime)
+        finally:
+            f.close()
+
+    def blend(self, weights):
+        """Returns the AU targets (for all AUs) of a weighted blend.
+        weights: { expression name : weight }
+        Raises ExpressionError for unknown expressions."""
+        vector = numpy.zeros(len(self.names))
+        for name, weight in weights.iteritems():
+            try:
+                vector[self.index[name]] = weight
+            except KeyError:
+                raise ExpressionError('unknown expression %s (have: %s)' % (
+                        name, self.names))
+        return numpy.clip(self.weights.dot(vector), 0, 1)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# FACE MODULE: headless backend
+#
+# This backend runs the face pipeline without Blender: the lightHead server and
+#  Face.update() are driven by a simulated clock at a given frame rate, and AU
+#  values which would be written to the actuators are recorded in a binary
+#  trace along with per-frame timings (see TraceWriter).
+# Select it with the FACE_BACKEND environment variable (see face/__init__.py):
+#  $ FACE_BACKEND=headless python face/headless.py -n 500 -t face.trace
+#
+# Trace format (network byte order):
+#  header: 'LHTRACE1', number of AUs (I), then for each AU: name length (B),
+#          name.
+#  frame:  simulated time (d), wall time (d), serve duration (f), update
+#          duration (f), number of changed AUs n (H), n AU indices (H),
+#          n values (f).
+#
+
+import time
+import thread
+import struct
+import logging
+
+import numpy
+
+MAX_FPS = 50
+
+TRACE_MAGIC = 'LHTRACE1'
+TRACE_HEADER = struct.Struct('!8sI')
+TRACE_FRAME = struct.Struct('!ddffH')
+
+LOG = logging.getLogger("face-srv")
+
+
+class TraceWriter(object):
+    """Writes frames of a headless run to a binary trace file."""
+
+    def __init__(self, path, AU_names):
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, len(AU_names)))
+        for name in AU_names:
+            self.file.write(struct.pack('!B', len(name)) + name)
+
+    def write_frame(self, sim_time, wall_time, serve_time, update_time,
+                    indices, values):
+        self.file.write(TRACE_FRAME.pack(sim_time, wall_time, serve_time,
+                                         update_time, len(indices)))
+        self.file.write(numpy.asarray(indices, dtype='>u2').tostring())
+        self.file.write(numpy.asarray(values, dtype='>f4').tostring())
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """Returns (AU names, [ (simulated time, wall time, serve duration, update
+     duration, AU indices, values) ]) from a trace file."""
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    magic, count = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError('%s is not a face trace' % path)
+    offset, names = TRACE_HEADER.size, []
+    for i in xrange(count):
+        size = ord(data[offset])
+        names.append(data[offset+1:offset+1+size])
+        offset += 1 + size
+    frames = []
+    while offset < len(data):
+        frame = TRACE_FRAME.unpack_from(data, offset)
+        offset += TRACE_FRAME.size
+        n = frame[-1]
+        indices = numpy.frombuffer(data, '>u2', n, offset)
+        values = numpy.frombuffer(data, '>f4', n, offset + 2*n)
+        offset += 6*n
+        frames.append(frame[:-1] + (indices, values))
+    return names, frames
+
+
+class Clock(object):
+    """Simulated clock: each tick advances time by exactly 1/fps.
+    realtime: if True, tick() sleeps so that frames are not faster than fps.
+    """
+
+    def __init__(self, fps=MAX_FPS, realtime=True):
+        self.step = 1. / fps
+        self.realtime = realtime
+        self.time = 0.
+        self.frames = 0
+        self._next = time.time()
+
+    def tick(self):
+        """Returns the time step of the frame."""
+        if self.realtime:
+            self._next += self.step
+            delay = self._next - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self._next = time.time()        # late: don't catch up
+        self.time += self.step
+        self.frames += 1
+        return self.step
+
+
+def initialize(addr_port):
+    """Creates the lightHead server with a face having all known AUs."""
+    import comm
+    from face import AREAS
+    from lightHead_server import lightHeadServer, lightHeadHandler
+    server = comm.create_server(lightHeadServer, lightHeadHandler, addr_port,
+                                (False, False))
+    server.create_protocol_handlers()
+    AUs = []
+    for area in sorted(AREAS.keys()):
+        AUs.extend(AREAS[area])
+    server['face'].set_available_AUs(AUs + ['26'])
+    # the clock paces frames: never block in serve_once()
+    server.set_poll_timeout(0)
+    return server
+
+
+def main(addr_port, fps=MAX_FPS, frames=None, trace=None, realtime=True,
+         server=None):
+    """Serves the face until the server is shut down or frames were run.
+    fps: frame rate of the simulated clock.
+    trace: path of the binary trace to record.
+    realtime: if False, frames are run as fast as possible.
+    server: an already initialized server (see initialize()).
+    Returns the Clock.
+    """
+    import conf
+    conf.load(raise_exception=False)
+    if server is None:
+        server = initialize(addr_port)
+    face = server['face']
+    face.thread_id = thread.get_ident()         # frames are run from here
+    writer = trace and TraceWriter(trace, face.AUs.names)
+    clock = Clock(fps, realtime)
+    empty = numpy.zeros(0, dtype=int)
+    server.start()
+    try:
+        while server.running and (frames is None or clock.frames < frames):
+            time_step = clock.tick()
+            start = time.time()
+            server.serve_once()
+            served = time.time()
+            changes = face.update_targets(time_step).values()
+            updated = time.time()
+            if writer:
+                indices = values = empty
+                if changes:
+                    indices = numpy.concatenate([ i for i, v in changes ])
+                    values = numpy.concatenate([ v for i, v in changes ])
+                writer.write_frame(clock.time, updated, served - start,
+                                   updated - served, indices, values)
+            face.frame_done()
+    finally:
+        if writer:
+            writer.close()
+        server.shutdown()
+    return clock
+
+
+if __name__ == '__main__':
+    import os, sys, optparse
+    os.environ['FACE_BACKEND'] = 'headless'
+    parser = optparse.OptionParser(usage='%prog [options] [address:port]')
+    parser.add_option('-f', '--fps', dest='fps', type='float',
+                      default=MAX_FPS, help='frame rate of the clock')
+    parser.add_option('-n', '--frames', dest='frames', type='int',
+                      help='number of frames to run (default: until killed)')
+    parser.add_option('-t', '--trace', dest='trace',
+                      help='binary trace file to record')
+    parser.add_option('-s', '--simulated', dest='realtime', default=True,
+                      action='store_false', help="don't wait between frames")
+    options, args = parser.parse_args()
+    import comm
+    comm.set_default_logging(debug=False)
+    addr_port = ('localhost', 31337)
+    if args:
+        addr, port = args[0].rsplit(':', 1)
+        addr_port = (addr, port.isdigit() and int(port) or port)
+    try:
+        clock = main(addr_port, options.fps, options.frames, options.trace,
+                     options.realtime)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    print 'ran %i frames (%.3fs simulated)' % (clock.frames, clock.time)
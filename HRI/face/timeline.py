@@ -0,0 +1,158 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keyframed AU timelines played by the face server.
+
+A script is uploaded once and compiled into keyframes sorted by time. The face
+ server then plays it against its own clock (the time steps of Face.update()),
+ so that playback does not depend on network jitter.
+
+Script lines use the .lpd syntax: 'time:command arguments' (or 'time command
+ arguments'), time in seconds from the start of the script. Commands are
+ those given to compile_script(), eg. AU and gaze of the face protocol.
+ Blank lines and lines starting with '#' are ignored.
+"""
+
+import logging
+
+import numpy
+
+LOG = logging.getLogger("face-srv")
+
+MIN_DURATION = .001
+
+
+class TimelineError(Exception):
+    pass
+
+
+def compile_script(lines, commands):
+    """Returns a Timeline from script lines.
+    commands: { command : function(argline) returning AU tuples (name, value,
+     duration[, profile]) }. Unknown commands are skipped with a warning.
+    Raises TimelineError on malformed lines.
+    """
+    keyframes, skipped = [], {}
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if ':' in line.split(None, 1)[0]:
+                frame_time, cmdline = line.split(':', 1)
+            else:
+                frame_time, cmdline = line.split(None, 1)
+            command, argline = (cmdline.split(None, 1) + [''])[:2]
+            frame_time = float(frame_time)
+        except ValueError, e:
+            raise TimelineError('line %i: %s (%s)' % (number+1, line, e))
+        if not commands.has_key(command):
+            skipped[command] = skipped.get(command, 0) + 1
+            continue
+        try:
+            AUs = commands[command](argline)
+        except Exception, e:
+            raise TimelineError('line %i: %s (%s)' % (number+1, line, e))
+        keyframes.extend([ (frame_time, tuple(AU)) for AU in AUs ])
+    for command, count in skipped.iteritems():
+        LOG.warning('timeline: skipped %i unsupported %s commands',
+                    count, command)
+    return Timeline(keyframes)
+
+
+class Timeline(object):
+    """Keyframes (time, AU tuple) played by advance() calls.
+    position: current time in the script.
+    scale: playback speed (2: twice as fast).
+    loop: restart from the beginning once length is reached.
+    """
+
+    def __init__(self, keyframes):
+        keyframes = sorted(keyframes, key=lambda k: k[0])       # stable
+        self.times = numpy.array([ t for t, AU in keyframes ], dtype=float)
+        self.AUs = [ AU for t, AU in keyframes ]
+        self.length = max([ t + AU[2] for t, AU in keyframes ] or [0])
+        self.position = 0.
+        self.cursor = 0         # index of the next keyframe to play
+        self.scale = 1.
+        self.loop = False
+        self.playing = False
+
+    def __len__(self):
+        return len(self.AUs)
+
+    def _started(self, first, last, now):
+        """AU tuples of keyframes first to last (excluded), with durations
+        adjusted to end in time, given that they start late at now."""
+        AUs = []
+        for i in xrange(first, last):
+            name, value, duration = self.AUs[i][:3]
+            duration = max((self.times[i] + duration - now) / self.scale,
+                           MIN_DURATION)
+            AUs.append((name, value, duration) + self.AUs[i][3:])
+        return AUs
+
+    def play(self, scale=None):
+        if scale is not None:
+            if scale <= 0:
+                raise TimelineError('scale must be positive (got %s)' % scale)
+            self.scale = scale
+        if self.position >= self.length:
+            self.seek(0)
+        self.playing = True
+
+    def pause(self):
+        self.playing = False
+
+    def seek(self, position):
+        """Moves to position (seconds in the script).
+        Returns AU tuples restoring the state of the face at position: the
+         last keyframe of each AU before position, ending in time."""
+        position = min(max(position, 0), self.length)
+        self.position = position
+        self.cursor = int(numpy.searchsorted(self.times, position, 'left'))
+        latest = {}
+        for i in xrange(self.cursor):
+            latest[self.AUs[i][0]] = i
+        AUs = []
+        for i in sorted(latest.values()):
+            AUs.extend(self._started(i, i+1, position))
+        return AUs
+
+    def advance(self, time_step):
+        """Moves forward by time_step seconds of the face clock.
+        Returns AU tuples of keyframes reached."""
+        if not self.playing:
+            return []
+        now = self.position + time_step * self.scale
+        AUs = []
+        while True:
+            last = int(numpy.searchsorted(self.times, now, 'right'))
+            AUs.extend(self._started(self.cursor, last, now))
+            self.cursor = last
+            if now < self.length:
+                break
+            if not self.loop or self.length <= 0:
+                now = self.length
+                self.playing = False
+                break
+            now -= self.length
+            self.cursor = 0
+        self.position = now
+        return AUs
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for the face module.
+
+Run with the common and HRI directories in your PYTHONPATH (see
+ source_me_to_set_env.sh), eg:
+ $ python face_bench.py update
+Unless FACE_BACKEND is set, the headless face backend is used (see
+ face/headless.py), so that no Blender is needed.
+"""
+
+import os
+import time
+import socket
+import random
+import logging
+import optparse
+import tempfile
+import threading
+
+os.environ.setdefault('FACE_BACKEND', 'headless')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values)*p), len(values)-1)]
+
+
+class DictAUs(object):
+    """Former AU interpolation of Face.update(), as reference: a dict of
+     [ (slope, start), duration, elapsed, value ] per AU."""
+
+    def __init__(self, names):
+        self.AUs = {}
+        for name in names:
+            self.AUs[name] = [(0,0) , .0 , .0, .0]
+
+    def set_AUs(self, iterable):
+        """Profiles (4th item) are ignored: the dict loop was linear."""
+        for AU in iterable:
+            name, target_value, duration = AU[:3]
+            duration = max(duration, .001)
+            self.AUs[name][:3] = (((target_value-self.AUs[name][3])/duration,
+                                   self.AUs[name][3]), duration, 0)
+
+    def update(self, time_step):
+        to_update = []
+        for id, info in self.AUs.iteritems():
+            coeffs, duration, elapsed, value = info
+            target = coeffs[0] * duration + coeffs[1]
+            elapsed += time_step
+            if elapsed >= duration:
+                if value != target:
+                    self.AUs[id][2:] = duration, target
+                    to_update.append((id, target))
+                continue
+            up_value = coeffs[0] * elapsed + coeffs[1]
+            self.AUs[id][2:] = elapsed, up_value
+            to_update.append((id, up_value))
+        return to_update
+
+
+def bench_update(options):
+    """Time per frame of AU interpolation, by number of channels.
+    Every frame, a random tenth of the channels gets a new target, with the
+     given motion profile."""
+    try:
+        from face import Face, LOG
+        from face.engine import get_profile
+    except ImportError, e:
+        print 'update: cannot import the face module (%s)' % e
+        return
+    LOG.setLevel(logging.WARNING)
+    profile = get_profile(options.profile)
+    print 'profile:', options.profile
+    print '%8s %10s %12s %12s %10s' % ('channels', 'engine', 'mean (us)',
+                                       'p99 (us)', 'changed')
+    for n in options.channels:
+        names = [ 'AU%i' % i for i in xrange(n) ]
+        face = Face()
+        face.set_available_AUs(names)
+        engines = (('dict', DictAUs(names)), ('numpy', face))
+        random.seed(n)
+        commits = [ [ (random.choice(names), random.random(),
+                       random.uniform(.1, 1), profile)
+                      for i in xrange(max(n/10, 1)) ]
+                    for frame in xrange(options.frames) ]
+        for name, engine in engines:
+            timings, changed = [], 0
+            for commit in commits:
+                engine.set_AUs(commit)
+                t = time.time()
+                changed += len(engine.update(1./options.fps))
+                timings.append(time.time() - t)
+            print '%8i %10s %12.1f %12.1f %10i' % (
+                n, name, sum(timings)/len(timings)*1e6,
+                percentile(timings, .99)*1e6, changed/len(commits))
+
+
+def bench_latency(options):
+    """End-to-end latency, from sending an AU to the frame applying it, through
+    the lightHead server of the headless backend (see face/headless.py)."""
+    try:
+        from face import LOG, headless
+    except ImportError, e:
+        print 'latency: cannot import the headless face backend (%s)' % e
+        return
+    LOG.setLevel(logging.WARNING)
+    logging.getLogger('comm').setLevel(logging.WARNING)
+    server = headless.initialize(('localhost', 0))
+    trace = tempfile.mktemp('.trace')
+    period = 1. / options.fps
+    frames = options.samples * 2 + int(options.fps)     # 1s to spare
+    runner = threading.Thread(target=headless.main, args=(None,),
+                              kwargs={ 'fps' : options.fps, 'frames' : frames,
+                                       'trace' : trace, 'server' : server })
+    runner.start()
+    while not server.running:
+        time.sleep(.01)
+    sock = socket.create_connection(server.addr_port)
+    sent = []
+    for i in xrange(options.samples):
+        value = (i % 999 + 1) / 1000.
+        sent.append((time.time(), value))
+        sock.sendall('origin face\nAU 25 %.3f 0\ncommit\n' % value)
+        time.sleep(random.uniform(1, 2) * period)
+    runner.join()
+    sock.close()
+    names, frames = headless.read_trace(trace)
+    os.remove(trace)
+    AU = names.index('25')
+    applied = [ (wall, values[indices.tolist().index(AU)]) for
+                sim, wall, serve, update, indices, values in frames if
+                AU in indices.tolist() ]
+    latencies = []
+    for t, value in sent:
+        for wall, v in applied:
+            if wall >= t and abs(v - value) < 1e-6:
+                latencies.append(wall - t)
+                break
+    print '%8s %8s %12s %12s %12s' % ('fps', 'samples', 'mean (ms)',
+                                      'p99 (ms)', 'max (ms)')
+    print '%8i %8i %12.2f %12.2f %12.2f' % (
+        options.fps, len(latencies), sum(latencies)/len(latencies)*1e3,
+        percentile(latencies, .99)*1e3, max(latencies)*1e3)
+    serve = [ f[2] for f in frames ]
+    update = [ f[3] for f in frames ]
+    print 'per frame (us): serve mean %.1f p99 %.1f, update mean %.1f p99 %.1f'\
+        % (sum(serve)/len(serve)*1e6, percentile(serve, .99)*1e6,
+           sum(update)/len(update)*1e6, percentile(update, .99)*1e6)
+
+
+BENCHES = { 'update' : bench_update,
+            'latency' : bench_latency }
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] '+
+                                   '|'.join(sorted(BENCHES.keys())))
+    parser.add_option('-c', '--channels', dest='channels',
+                      default='60,600,6000',
+                      help='comma separated numbers of AU channels')
+    parser.add_option('-f', '--frames', dest='frames', type='int',
+                      default=500, help='number of measured frames')
+    parser.add_option('--fps', dest='fps', type='float', default=50.,
+                      help='simulated frame rate')
+    parser.add_option('-p', '--profile', dest='profile', default='linear',
+                      help='motion profile of AU transitions (update)')
+    parser.add_option('-s', '--samples', dest='samples', type='int',
+                      default=200, help='number of AUs sent for latency')
+    options, args = parser.parse_args()
+    options.channels = [ int(n) for n in options.channels.split(',') ]
+    for name in args or sorted(BENCHES.keys()):
+        if not BENCHES.has_key(name):
+            parser.error('unknown benchmark: %s' % name)
+        BENCHES[name](options)
@@ -32,7 +32,12 @@
 # INPUT: - learning (for context retrieval)
 #
 
+import time
+import bisect
 import logging
+import threading
+import collections
+from array import array
 
 from comm.meta_server import MetaRequestHandler, MetaServer
 
@@ -44,13 +49,159 @@ ORGN_LIPS = 'lips'
 ORGN_HEAD = 'head'
 ORIGINS = (ORGN_GAZE, ORGN_FACE, ORGN_LIPS, ORGN_HEAD)
 
+MAX_RATE = 100.         # maximum number of updates per second to subscribers
+DEFAULT_RATE = 10.
+SUBSCRIBER_QUEUE = 64   # pending updates per subscriber before dropping
+HISTORY_SIZE = 1024     # samples kept per feature
+HISTORY_RATE = 50.      # samples per second taken from the subservers
+HISTORY_QUERY = 2048    # maximum number of samples sent per get_history
+
+
+def format_feature(name, value):
+    """Protocol line for a feature: name followed by its values."""
+    if value and hasattr(value, '__iter__'):
+        value = ' '.join([ str(i) for i in value ])
+    return '%s %s' % (name, value)
+
+
+class Snapshot(dict):
+    """Read-only features of the pool, shared between readers.
+    version: version of the pool the snapshot was taken at."""
+
+    def __init__(self, items, version):
+        dict.__init__(self, items)
+        self.version = version
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('snapshots are read-only')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+
+class History(object):
+    """Fixed-size history of a feature: the last HISTORY_SIZE timestamped
+     samples, stored in flat arrays of doubles allocated once. A sample has
+     the same columns as the first one recorded: names for (name, value)
+     pairs (eg. AUs), indices for sequences (eg. neck rotation) or 'value'.
+     A record with different columns clears the history.
+    Memory used: capacity * (1 + number of columns) * 8 bytes.
+    """
+
+    def __init__(self, capacity=HISTORY_SIZE):
+        self.capacity = capacity
+        self.columns = None
+        self.times = array('d', [0.]) * capacity
+        self.values = None
+        self.start = 0          # index of the oldest sample
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        """Timestamp of the index-th oldest sample (for bisect)."""
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return self.times[(self.start + index) % self.capacity]
+
+    @staticmethod
+    def _columns(value):
+        if not hasattr(value, '__iter__'):
+            return ('value',), (value,)
+        value = tuple(value)
+        if value and isinstance(value[0], tuple):
+            value = sorted(value)
+            return tuple([ n for n,v in value ]), [ v for n,v in value ]
+        return tuple([ str(i) for i in xrange(len(value)) ]), value
+
+    def record(self, timestamp, value):
+        """Adds a sample, overwriting the oldest one if the history is full.
+        Timestamps shall not decrease: earlier ones are set to the last one.
+        """
+        columns, row = self._columns(value)
+        width = len(columns)
+        self.lock.acquire()
+        try:
+            if columns != self.columns:
+                self.columns = columns
+                self.values = array('d', [0.]) * (self.capacity * width)
+                self.start = self.size = 0
+            elif self.size:
+                timestamp = max(timestamp, self[self.size-1])
+            if self.size < self.capacity:
+                index = (self.start + self.size) % self.capacity
+                self.size += 1
+            else:
+                index = self.start
+                self.start = (self.start + 1) % self.capacity
+            self.times[index] = timestamp
+            self.values[index*width:(index+1)*width] = array('d', row)
+        finally:
+            self.lock.release()
+
+    def _sample(self, index):
+        i = (self.start + index) % self.capacity
+        width = len(self.columns)
+        return self.times[i], self.values[i*width:(i+1)*width].tolist()
+
+    def at(self, timestamp):
+        """Returns (timestamp, values) of the last sample taken at or before
+        timestamp, or None."""
+        self.lock.acquire()
+        try:
+            index = bisect.bisect_right(self, timestamp) - 1
+            return index >= 0 and self._sample(index) or None
+        finally:
+            self.lock.release()
+
+    def range(self, t0, t1, step=None, limit=HISTORY_QUERY):
+        """Returns [ (timestamp, values) ] of samples from t0 to t1 included.
+        step: if given, one sample per step seconds from t0 (or the first
+         sample if later) up to the last sample: the last one taken at or
+         before that time (samples are repeated if step is shorter than the
+         sampling period).
+        At most limit samples are returned."""
+        self.lock.acquire()
+        try:
+            if step:
+                if not self.size:
+                    return []
+                t0 = max(t0, self[0])
+                t1 = min(t1, self[self.size-1])
+                if t1 < t0:
+                    return []
+                # (tolerating rounding errors of timestamps)
+                count = min(int((t1 - t0) / step + 1e-3) + 1, limit)
+                return [ self._sample(bisect.bisect_right(self, t0+i*step) - 1)
+                         for i in xrange(count) ]
+            first = bisect.bisect_left(self, t0)
+            last = min(bisect.bisect_right(self, t1), first + limit)
+            return [ self._sample(i) for i in xrange(first, last) ]
+        finally:
+            self.lock.release()
+
 
 class FeaturePool(object):
     """This class serves as a short term memory. It holds all possible features
-    so other modules can query a snapshot of the current robot's state."""
+    so other modules can query a snapshot of the current robot's state.
+
+    Each change of a feature bumps the pool's version and records it as the
+     feature's sequence number, so readers can ask for changes since the
+     version they last saw. Values are stored immutable (lists become tuples)
+     and the snapshot of a version is built once, then shared.
+
+    Values are also recorded in a History per feature, along with the time
+     they were set at.
+    """
 
     def __init__(self):
         self.context = {}       # identifier : value(s)
+        self.seqs = {}          # identifier : version of its last change
+        self.version = 0
+        self.lock = threading.Lock()
+        self.snapshot = Snapshot((), 0)
+        self.histories = {}     # identifier : History
 
     def is_empty(self):
         return not self.context
@@ -60,13 +211,99 @@ class FeaturePool(object):
         features == None: return whole context
         features == iterable: return subset of the context.
         """
-        print features, self.context
+        snapshot = self.snapshot
+        if snapshot.version != self.version:
+            self.lock.acquire()
+            snapshot = self.snapshot = Snapshot(self.context, self.version)
+            self.lock.release()
         if not features:
-            return self.context
-        return dict( (f,self.context[f]) for f in features )
+            return snapshot
+        return Snapshot([ (f, snapshot[f]) for f in features ],
+                        snapshot.version)
 
-    def set_value(self, identifier, value):
-        self.context[identifier] = value
+    def get_changes(self, version, features=None):
+        """Returns a Snapshot of the features changed after version."""
+        self.lock.acquire()
+        try:
+            return Snapshot([ (f, self.context[f]) for f, seq in
+                              self.seqs.iteritems() if seq > version and
+                              (not features or f in features) ],
+                            self.version)
+        finally:
+            self.lock.release()
+
+    def get_history(self, identifier):
+        """Returns the History of a feature. Raises KeyError if unknown."""
+        return self.histories[identifier]
+
+    def set_value(self, identifier, value, timestamp=None):
+        """Returns True if value is new for identifier.
+        timestamp: time the value was read at, defaults to now."""
+        if isinstance(value, list):
+            value = tuple(value)
+        self.lock.acquire()
+        try:
+            if not self.histories.has_key(identifier):
+                self.histories[identifier] = History()
+            history = self.histories[identifier]
+            if self.seqs.has_key(identifier) and \
+                    self.context[identifier] == value:
+                changed = False
+            else:
+                self.version += 1
+                self.context[identifier] = value
+                self.seqs[identifier] = self.version
+                changed = True
+        finally:
+            self.lock.release()
+        history.record(timestamp or time.time(), value)
+        return changed
+
+
+class Subscription(object):
+    """Pushes features of the pool to a client when they change, at most at a
+     given rate. Updates wait in a bounded queue while the client does not
+     read fast enough (ie. the previous ones are not sent): the oldest updates
+     are then dropped.
+    """
+
+    def __init__(self, handler, features, rate):
+        self.handler = handler
+        self.server = handler.server
+        self.features = features
+        self.period = 1. / min(rate, MAX_RATE)
+        self.version = 0        # version of the pool last queued
+        self.queue = collections.deque(maxlen=SUBSCRIBER_QUEUE)
+        self.dropped = 0
+        self.timer = self.server.add_timer(0, self.publish)
+
+    def cancel(self):
+        self.server.cancel_timer(self.timer)
+
+    def publish(self):
+        """Queues changed features and sends the queue if the client kept up.
+        Run by the server's timers."""
+        if self.server.clients.get(self.handler.socket) is not self.handler:
+            return              # client disconnected
+        try:
+            self.server.update_features(self.features)
+            changes = self.server.FP.get_changes(self.version, self.features)
+            self.version = changes.version
+            for name, value in changes.iteritems():
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1
+                self.queue.append((name, value))
+            if self.handler.obuf:
+                LOG.debug('subscriber %s is late, %i updates dropped so far',
+                          self.handler.addr_port, self.dropped)
+            else:
+                while self.queue:
+                    self.handler.send_msg(format_feature(*self.queue.popleft()))
+        except StandardError, e:
+            LOG.warning('could not publish features to %s: %s',
+                        self.handler.addr_port, e)
+        finally:
+            self.timer = self.server.add_timer(self.period, self.publish)
 
 
 class lightHeadHandler(MetaRequestHandler):
@@ -78,6 +315,7 @@ class lightHeadHandler(MetaRequestHandler):
         for origin, srv_hclass in self.server.origins.iteritems():
             self.handlers[origin] = self.create_subhandler(*srv_hclass)
         self.updated = []
+        self.subscription = None
 
     def cmd_origin(self, argline):
         """Set or Send current origin/subhandler"""
@@ -98,20 +336,101 @@ class lightHeadHandler(MetaRequestHandler):
         self.updated = []
 
     def cmd_reload(self, argline):
-        """Reload subserver modules"""
-        self.send_msg('TODO')
+        """Rebuild command dispatch tables of all connected clients, so that
+        cmd_ functions replaced at runtime (eg. reloaded code) are used."""
+        for handler in self.server.clients.values():
+            handler.rebuild_routes()
+        self.send_msg('reloaded dispatch tables')
 
     def cmd_get_snapshot(self, argline):
-        """Returns the current snapshot of robot context"""
-        if self.server.FP.is_empty():
-            for origin in self.server.origins.iterkeys():
-                subserver = self.server.get_server(origin)
-                self.server.FP.set_value(origin, subserver.get_features(origin))
-        for k,v in self.server.FP.get_snapshot(argline.split()).iteritems():
-            if v and hasattr(v, '__iter__'):
-                v = [ str(i) for i in v ]
-            self.send_msg(k+' '+' '.join(v))
-        self.send_msg('end_snapshot')
+        """get_snapshot [features]: sends the current robot context (default:
+        all features), then end_snapshot <version>."""
+        features = argline.split()
+        try:
+            self.server.update_features(features)
+        except KeyError, e:
+            LOG.warning('unknown feature: %s', e)
+            return self.send_msg('NACK get_snapshot %s' % argline)
+        self.send_snapshot(self.server.FP.get_snapshot(features))
+
+    def cmd_get_changes(self, argline):
+        """get_changes version [features]: like get_snapshot but only sends
+        features changed since version (as given by end_snapshot)."""
+        args = argline.split()
+        try:
+            version = int(args.pop(0))
+            self.server.update_features(args)
+        except (IndexError, ValueError, KeyError), e:
+            LOG.warning('bad get_changes request (%s): %s', e, argline)
+            return self.send_msg('NACK get_changes %s' % argline)
+        self.send_snapshot(self.server.FP.get_changes(version, args))
+
+    def cmd_get_history(self, argline):
+        """get_history feature t0 t1 [step]: sends values of feature recorded
+        from t0 to t1 (seconds since epoch), one sample per step seconds if
+        given. Replies: history_columns <feature> <names>, then for each
+        sample: history <feature> <timestamp> <values>, then
+        end_history <feature> <number of samples>."""
+        args = argline.split()
+        try:
+            if len(args) not in (3, 4):
+                raise ValueError('3 or 4 arguments expected')
+            t0, t1 = float(args[1]), float(args[2])
+            step = len(args) == 4 and float(args[3]) or None
+            if step is not None and step <= 0:
+                raise ValueError('step must be positive')
+            history = self.server.FP.get_history(args[0])
+        except (ValueError, KeyError), e:
+            LOG.warning('bad get_history request (%s): %s', e, argline)
+            return self.send_msg('NACK get_history %s' % argline)
+        samples = history.range(t0, t1, step)
+        self.send_msg(format_feature('history_columns '+args[0],
+                                     history.columns))
+        for t, values in samples:
+            self.send_msg(format_feature('history %s %.6f' % (args[0], t),
+                                         values))
+        self.send_msg('end_history %s %i' % (args[0], len(samples)))
+
+    def send_snapshot(self, snapshot):
+        for k,v in snapshot.iteritems():
+            self.send_msg(format_feature(k, v))
+        self.send_msg('end_snapshot %i' % snapshot.version)
+
+    def cmd_subscribe(self, argline):
+        """subscribe [features] [rate]: pushes features (default: all) when
+        they change, at most rate times per second. Replaces any previous
+        subscription of this client."""
+        args = argline.split()
+        rate = DEFAULT_RATE
+        if args:
+            try:
+                rate = float(args[-1])
+                args.pop()
+            except ValueError:
+                pass
+        unknown = [ f for f in args if not self.server.origins.has_key(f) ]
+        if unknown or rate <= 0:
+            self.send_msg('NACK subscribe %s' % argline)
+            return
+        self.unsubscribe()
+        self.subscription = Subscription(self, args or None, rate)
+        self.send_msg('ACK subscribe %s' % argline)
+
+    def cmd_unsubscribe(self, argline):
+        """Stops pushing features to this client. Replies NACK if it had no
+        subscription."""
+        if self.unsubscribe():
+            self.send_msg('ACK unsubscribe')
+        else:
+            self.send_msg('NACK unsubscribe')
+
+    def unsubscribe(self):
+        """Returns False if there was no subscription to cancel."""
+        if not self.subscription:
+            return False
+        self.subscription.cancel()
+        self.subscription = None
+        return True
 
 
 class lightHeadServer(MetaServer):
@@ -122,11 +441,33 @@ class lightHeadServer(MetaServer):
         MetaServer.__init__(self)
         self.origins = {}       # { origin: self.server and associed handler }
         self.FP = FeaturePool() # the feature pool for context queries
+        self.add_timer(0, self.record_history)
 
     def __getitem__(self, protocol_keyword):
         return self.origins[protocol_keyword][0]
     get_server = __getitem__
 
+    def update_features(self, origins=None):
+        """Stores current features of origins (default: all) in the pool.
+        Returns: { origin : features }"""
+        features = {}
+        for origin in origins or self.origins.keys():
+            server = self.get_server(origin)
+            features[origin] = server.get_features(origin)
+            timestamp = None
+            if hasattr(server, 'get_features_time'):
+                timestamp = server.get_features_time(origin)
+            self.FP.set_value(origin, features[origin], timestamp)
+        return features
+
+    def record_history(self):
+        """Samples all features at HISTORY_RATE. Run by the server's timers."""
+        try:
+            self.update_features()
+        except StandardError, e:
+            LOG.warning('could not record features: %s', e)
+        self.add_timer(1/HISTORY_RATE, self.record_history)
+
     def get_handler(self, keyword):
         return self.origins[keyword][1]
 
@@ -7,9 +7,16 @@
 #  dependant. However as long as the hardware provides the required DOF and
 #  backend provides required functions, the end-result should be similar.
 #
+import os
+import time
+import threading
 import comm, conf
 import logging
 
+import numpy
+
+from spine import trajectory
+
 if hasattr(conf,'DEBUG_MODE') and conf.DEBUG_MODE:
     comm.set_default_logging(debug=True)
     LOG = comm.LOG
@@ -17,6 +24,11 @@ else:
     LOG = logging.getLogger(__package__)
 
 
+MOTION_PERIOD = .01     # in s, period of the motion thread while axes move
+MOTION_TIMEOUT = 30.    # in s, before a target not reached is given up
+POLL_RATE = 50.         # Hz, default rate of encoder reads (spine_poll_rate)
+
+
 class SpineProtocolError(comm.ProtocolError):
     pass
 
@@ -43,6 +55,190 @@ class NeckInfo(SpineElementInfo):
     pass
 
 
+class Motion(object):
+    """A command moving several axes, complete once all reached their target.
+    callback: function(reached) called once from the motion thread, reached
+     being False if an axis failed, timed out or got a newer target meanwhile.
+    """
+
+    def __init__(self, axes, callback=None):
+        self.remaining = set(axes)
+        self.callback = callback
+        self.reached = None
+        self.done = threading.Event()
+
+    def axis_done(self, axis, reached):
+        if self.reached is not None:
+            return
+        self.remaining.discard(axis)
+        if reached and self.remaining:
+            return
+        self.reached = reached
+        self.done.set()
+        if self.callback:
+            try:
+                self.callback(reached)
+            except Exception:
+                LOG.exception('motion callback %s failed', self.callback)
+
+    def wait(self, timeout=None):
+        """Blocks until complete. Returns True if all axes reached."""
+        self.done.wait(timeout)
+        return bool(self.reached)
+
+
+class MotionQueue(object):
+    """Axis targets sent to the hardware by a dedicated thread, so that callers
+    never wait for motors.
+    Latest target wins per axis: a target replaces the one not sent yet or not
+     reached yet (which Motion then completes with reached=False).
+    move: function(axis, target) commanding a motor, returns False on failure.
+    reached: function(axis, target) returns True once the motor reached target.
+    """
+
+    def __init__(self, move, reached, period=MOTION_PERIOD,
+                 timeout=MOTION_TIMEOUT):
+        self.move = move
+        self.reached = reached
+        self.period = period
+        self.timeout = timeout
+        self.pending = {}       # { axis : (target, Motion) } not sent yet
+        self.superseded = []    # [ (Motion, axis) ] replaced before being sent
+        self.moving = {}        # { axis : (target, Motion, deadline) }
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='spine-motion')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        self.cond.release()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def put(self, targets, callback=None):
+        """Queues targets: [ (axis, target) ]. Returns the Motion at once."""
+        motion = Motion([ axis for axis, target in targets ], callback)
+        self.cond.acquire()
+        try:
+            for axis, target in targets:
+                if self.pending.has_key(axis):
+                    self.superseded.append((self.pending[axis][1], axis))
+                self.pending[axis] = (target, motion)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return motion
+
+    def run(self):
+        self.cond.acquire()
+        try:
+            while self.running:
+                if not self.pending:
+                    self.cond.wait(self.moving and self.period or None)
+                pending, self.pending = self.pending, {}
+                superseded, self.superseded = self.superseded, []
+                self.cond.release()
+                try:
+                    self.process(pending, superseded)
+                finally:
+                    self.cond.acquire()
+        finally:
+            self.cond.release()
+
+    def process(self, pending, superseded):
+        """Sends new targets and completes motions. Called by the thread."""
+        for motion, axis in superseded:
+            motion.axis_done(axis, False)
+        now = time.time()
+        for axis, (target, motion) in sorted(pending.items()):
+            if self.moving.has_key(axis):
+                self.moving.pop(axis)[1].axis_done(axis, False)
+            if self.move(axis, target):
+                self.moving[axis] = (target, motion, now + self.timeout)
+            else:
+                LOG.error('failed to move axis %i to %s', axis, target)
+                motion.axis_done(axis, False)
+        for axis, (target, motion, deadline) in self.moving.items():
+            if self.reached(axis, target):
+                del self.moving[axis]
+                motion.axis_done(axis, True)
+            elif now > deadline:
+                del self.moving[axis]
+                LOG.warning('axis %i did not reach %s in time', axis, target)
+                motion.axis_done(axis, False)
+
+
+class EncoderPoller(object):
+    """Cache of the encoders of all axes, read in a single sweep per tick by a
+    dedicated thread: queries read the cache and never reach the hardware.
+    read: function(axes) returning the encoder values of axes.
+    axes: axis numbers, in cache order.
+    state: (encoder values as a numpy array in axes order, time of the sweep),
+     replaced as a whole by each sweep so that readers need no lock.
+    """
+
+    def __init__(self, read, axes, rate=POLL_RATE):
+        self.read = read
+        self.axes = list(axes)
+        self.index = dict([ (axis, i) for i, axis in enumerate(self.axes) ])
+        self.period = 1. / rate
+        self.state = (numpy.zeros(len(self.axes), dtype=int), None)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Reads all axes, then keeps reading them from a thread."""
+        self.poll()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='spine-encoders')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        next_tick = time.time()
+        while self.running:
+            next_tick += self.period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()         # late: don't catch up
+            try:
+                self.poll()
+            except SpineError, e:
+                LOG.warning('could not read encoders: %s', e)
+
+    def poll(self):
+        """Reads all axes once."""
+        values = numpy.array(self.read(self.axes), dtype=int)
+        self.state = (values, time.time())
+
+    def get(self, axes=None):
+        """Returns (encoder values of axes (default: all), time read at)."""
+        values, timestamp = self.state
+        if axes is None:
+            return values, timestamp
+        return values[[ self.index[axis] for axis in axes ]], timestamp
+
+    def get_encoder(self, axis):
+        return int(self.state[0][self.index[axis]])
+
+
 class SpineComm(object):
     """
     """
@@ -67,17 +263,37 @@ class SpineComm(object):
     # TODO: get rid of this and use a global AU pool
     def cmd_AU(self, argline):
         """Absolute rotation on 1 axis.
-        Syntax is: AU_name, target_value, attack_time (in s.)"""
-        args = argline.split()
-        if len(args) != 3:
-            LOG.warning('AU: expected 3 arguments (got %s)', args)
-            return
-        try:
-            dim = ('53.5', '55.5', '51.5').index(args[0])
-        except ValueError:
-            LOG.warning('AU not known: %s', args[0])
-            return
-        self.xyz[dim] = [ float(v) for v in args[1:] ]
+        Syntax is: AU_name, target_value, attack_time (in s.)
+        In binary mode: tuple of (AU_name, target_value, attack_time)."""
+        if hasattr(argline, '__iter__'):
+            records = argline
+        else:
+            args = argline.split()
+            if len(args) != 3:
+                LOG.warning('AU: expected 3 arguments (got %s)', args)
+                return
+            records = [ (args[0], float(args[1]), float(args[2])) ]
+        for name, value, attack in records:
+            try:
+                dim = ('53.5', '55.5', '51.5').index(name)
+            except ValueError:
+                LOG.warning('AU not known: %s', name)
+                continue
+            self.xyz[dim] = [value, attack]
+
+    def cmd_neck(self, argline):
+        """Absolute neck orientation on 3 axis, applied on commit.
+        Syntax is: x y z [attack_time]
+        In binary mode: tuple of (x, y, z, attack_time)."""
+        if hasattr(argline, '__iter__'):
+            records = argline
+        else:
+            args = [ float(arg) for arg in argline.split() ]
+            if len(args) not in (3, 4):
+                raise SpineProtocolError('neck: 3 or 4 arguments required')
+            records = [ (args+[0])[:4] ]
+        for x, y, z, attack in records:
+            self.xyz = [ [x, attack], [y, attack], [z, attack] ]
 
     def cmd_commit(self, argline):
         """from expr2"""
@@ -85,7 +301,10 @@ class SpineComm(object):
 
     def cmd_rotate(self, argline):
         """relative rotation on 3 axis.
-        Syntax is: neck|torso x y z [wait]"""
+        Syntax is: neck|torso x y z [wait]
+        With wait, replies ACK rotate <argline> once reached, or NACK rotate
+         <argline> if the rotation failed or was superseded. The server does
+         not block meanwhile."""
         if not argline:
             self.send_msg('rot_neck %s\nrot_torso %s' % (
                     SpineBase.round(self.server.get_neck_info().rot),
@@ -95,10 +314,14 @@ class SpineComm(object):
         args = argline.split()
         if len(args) < 4:
             raise SpineProtocolError('rotate: 4 or 5 arguments required')
-        wait = len(args) == 5 and args[4] == 'wait'
+        callback = None
+        if len(args) == 5 and args[4] == 'wait':
+            def callback(reached):
+                self.send_msg('%s rotate %s' % (reached and 'ACK' or 'NACK',
+                                                argline))
         xyz = [ round(float(arg),SpineBase.PRECISION) for arg in args[1:4] ]
         try:
-            self.relative_rotators[args[0]](xyz, wait)
+            self.relative_rotators[args[0]](xyz, callback=callback)
         except KeyError, e:
             raise SpineProtocolError("invalid body-part %s (%s)", args[0], e)
 
@@ -130,6 +353,12 @@ class SpineBase(object):
         self._tolerance = 0.0    # in radians
         self._motors_on = False
         self._lock_handler = None
+        self._profile = trajectory.DEFAULT_PROFILE
+        self._player = None             # TrajectoryPlayer started by animate
+
+    def pre_shutdown(self):
+        if self._player is not None:
+            self._player.stop()
 
     # Note: property decorators are great but don't allow child class to define
     #       just the setter...
@@ -142,6 +371,14 @@ class SpineBase(object):
         """Returns NeckInfo instance"""
         return self._neck_info
 
+    def get_features(self, origin):
+        """To get features for the cognition part: the neck rotation."""
+        return SpineBase.round(self.get_neck_info().rot)
+
+    def get_features_time(self, origin):
+        """Time features were read at, None for now."""
+        return None
+
     def get_tolerance(self):
         """In radians"""
         return self._tolerance
@@ -150,16 +387,30 @@ class SpineBase(object):
         """In radians"""
         self._tolerance = value
 
+    def get_limits(self, part):
+        """Returns (max speeds in rad/s, max accelerations in rad/s^2) of the X,
+        Y and Z axes of part ('neck' or 'torso'), None for no limits."""
+        return None, None
+
+    def set_profile(self, name):
+        """Motion profile of animations (see trajectory.PROFILES)."""
+        if name not in trajectory.PROFILES:
+            raise SpineError('unknown profile %s' % name)
+        self._profile = name
+
     def set_lock_handler(self, handler):
         """function to call upon collision detection locking"""
         self._lock_handler = handler
     
-    def set_neck_orientation(self, axis3):
-        """Absolute orientation:"""
+    def set_neck_orientation(self, xyz, wait=False, callback=None):
+        """Absolute orientation:
+        wait: block until reached (raises SpineError if not).
+        callback: function(reached) called once done (see Motion).
+        """
         raise NotImplemented()
 
-    def set_torso_orientation(self, axis3):
-        """Absolute orientation:"""
+    def set_torso_orientation(self, xyz, wait=False, callback=None):
+        """Absolute orientation: same arguments as set_neck_orientation"""
         raise NotImplemented()
 
     def set_neck_rot_pos(self, axis3_rot=None, axis3_pos=None):
@@ -173,25 +424,60 @@ class SpineBase(object):
     # TODO: poll AU values from the AU pool after each update
     def animate(self, neck_rot_attack, torso_rot_attack):
         """Set neck and torso's absolute orientation with timing information.
+        Each axis follows a trajectory reaching its orientation after its
+         attack time (or as soon as the limits of the axis allow), streamed to
+         the backend as waypoints (see trajectory.py). A part already animated
+         goes on from its current position and velocity.
         neck_rot_attack:  X,Y,Z: (orientation_in_rads, attack_time_in_s)
         torso_rot_attack: X,Y,Z: (orientation_in_rads, attack_time_in_s)
+        Either can be None.
+        Returns: { part : trajectory.Trajectory } of the parts animated.
         """
-        # raise NotImplemented()
-        self.set_neck_orientation([ rad for rad, att in neck_rot_attack])
-
-    def rotate_neck(self, xyz, wait=True):
+        if self._player is None:
+            self._player = trajectory.TrajectoryPlayer()
+            self._player.start()
+        plans = {}
+        for part, rot_attack, info, send in (
+            ('neck', neck_rot_attack, self.get_neck_info,
+             self.set_neck_orientation),
+            ('torso', torso_rot_attack, self.get_torso_info,
+             self.set_torso_orientation) ):
+            if not rot_attack:
+                continue
+            start, velocity = self._player.get_state(part) or \
+                (info().rot, None)                      # smooth replanning
+            max_speed, max_accel = self.get_limits(part)
+            plan = trajectory.Trajectory(start,
+                                         [ rad for rad, att in rot_attack ],
+                                         [ att for rad, att in rot_attack ],
+                                         self._profile, max_speed, max_accel,
+                                         velocity)
+            LOG.debug('%s: %s -> %s in %ss', part, start, rot_attack,
+                      plan.durations)
+            self._player.play(part, plan, send, lambda info=info: info().rot)
+            plans[part] = plan
+        return plans
+
+    def cancel_animation(self, part):
+        """Stops the trajectory of part ('neck' or 'torso'), if any."""
+        if self._player is not None:
+            self._player.cancel(part)
+
+    def rotate_neck(self, xyz, wait=False, callback=None):
         """Set neck's relative orientation."""
+        self.cancel_animation('neck')
         ptp = self.get_neck_info().rot
         xyz_ = map(float.__add__, ptp, xyz)
         LOG.debug('neck %s + %s = %s', ptp, xyz, xyz_)
-        self.set_neck_orientation(xyz_, wait)
+        self.set_neck_orientation(xyz_, wait, callback)
 
-    def rotate_torso(self, xyz, wait=True):
+    def rotate_torso(self, xyz, wait=False, callback=None):
         """Set torso's relative orientation."""
+        self.cancel_animation('torso')
         ptp = self.get_torso_info().rot
         xyz_ = map(float.__add__, ptp, xyz)
         LOG.debug('torso %s + %s = %s', ptp, xyz, xyz_)
-        self.set_torso_orientation(xyz_, wait)
+        self.set_torso_orientation(xyz_, wait, callback)
 
     def switch_on(self):
         """Mandatory 1st call after hardware is switched on.
@@ -208,8 +494,12 @@ class SpineBase(object):
         raise NotImplemented()
 
 
+# backend driving the hardware: the one linked as spine/backend (eg. the
+#  Katana), unless the SPINE_BACKEND environment variable names another (eg.
+#  simulated).
+SPINE_BACKEND = os.environ.get('SPINE_BACKEND', 'backend')
 try:
-    from spine.backend import SpineHW as Spine
+    Spine = __import__('spine.'+SPINE_BACKEND, fromlist=['SpineHW']).SpineHW
 except ImportError, e:
     print 
     print '*** SPINE MISCONFIGURATION ***'
@@ -7,6 +7,9 @@
 # Axis are independant: an axis can be controlled (rigid) while others not.
 #
 import math
+import threading
+
+import numpy
 
 import logging
 LOG = logging.getLogger(__package__)
@@ -16,7 +19,19 @@ try:
 except ImportError:
     raise ImportError('The KNI module is not included in this release and shall'
                       ' be built from source.')
-from spine import SpineError, SpineBase
+from spine import SpineError, SpineBase, MotionQueue, EncoderPoller, \
+    POLL_RATE
+
+
+# columns of the calibration table (see SpineHW.CALIBRATION)
+CAL_MEAN, CAL_FACTOR, CAL_MIN, CAL_MAX = range(4)
+
+def calibration_table(axis_limits):
+    """Returns the calibration table of AXIS_LIMITS: a row per axis (row 0
+    unused, like AXIS_LIMITS) of mean, factor, min and max."""
+    return numpy.array([ (0, 1, 0, 0) ] + [ (mean, factor, mn, mx) for
+                                            mn, mx, mean, factor in
+                                            axis_limits[1:] ], dtype=float)
 
 
 def showTPos(tpos):
@@ -40,6 +55,11 @@ class SpineHW(SpineBase):
         (-15600,  -400, -8000,  12750/(math.pi/2)) )    # neck z
 
     SPEED_LIMITS = ( (0,255), (1,2) )   # 1: long accel, 2: short accel
+    SPEED_UNIT = 100.                   # KNI speed unit in encoder/s
+    ACCEL_UNIT = 10000.                 # KNI acceleration unit in encoder/s^2
+
+    # axes moving X, Y and Z of each part (None: no such axis, does not move)
+    PART_AXES = { 'neck' : (4, 5, 6), 'torso' : (2, None, 1) }
     
 
 #POSE_REST = [23500, 5600, 1800, 25100, 6500, 6900]     
@@ -54,19 +74,51 @@ class SpineHW(SpineBase):
                   AXIS_LIMITS[5][2],
                   AXIS_LIMITS[6][2] )
 
+    CALIBRATION = calibration_table(AXIS_LIMITS)
+    _columns = {}       # { axes : (means, factors, mins, maxs) }
+
+    @staticmethod
+    def get_calibration(axes):
+        """Returns columns of the calibration table for axes (a tuple), as
+        (means, factors, mins, maxs). Encoder values are integers."""
+        try:
+            return SpineHW._columns[axes]
+        except KeyError:
+            table = SpineHW.CALIBRATION[list(axes)]
+            columns = SpineHW._columns[axes] = (
+                table[:,CAL_MEAN].astype(int), table[:,CAL_FACTOR],
+                table[:,CAL_MIN].astype(int), table[:,CAL_MAX].astype(int))
+            return columns
+
+    @staticmethod
+    def rads2encs(axes, rads):
+        """Converts orientations of axes (a tuple) to encoder values, clamped to
+        the range of each axis.
+        Returns (encoder values, mask of the clamped ones) as numpy arrays."""
+        means, factors, mins, maxs = SpineHW.get_calibration(axes)
+        encs = (factors * rads).astype(int)
+        encs += means
+        clamped = numpy.minimum(numpy.maximum(encs, mins), maxs)
+        return clamped, clamped != encs
+
+    @staticmethod
+    def encs2rads(axes, encs):
+        """Converts encoder values of axes (a tuple) to orientations (numpy
+        array)."""
+        means, factors, mins, maxs = SpineHW.get_calibration(axes)
+        return (encs - means) / factors
+
     @staticmethod
     def rad2enc(axis, rad):
-        info = SpineHW.AXIS_LIMITS[axis]
-        e = int(info[3]*rad) + info[2]
-        f = min(max(info[0], e), info[1])
-        if e != f:
-            LOG.warning('axis %i limited value %i to %i %s', axis,e,f,info[:2])
-        return f
+        encs, clamped = SpineHW.rads2encs((axis,), (rad,))
+        if clamped[0]:
+            LOG.warning('axis %i limited value %s rad to %i %s', axis, rad,
+                        encs[0], SpineHW.AXIS_LIMITS[axis][:2])
+        return int(encs[0])
 
     @staticmethod
     def enc2rad(axis, enc):
-        info = SpineHW.AXIS_LIMITS[axis]
-        return 1.0/info[3]*(enc - info[2])
+        return float(SpineHW.encs2rads((axis,), (enc,))[0])
 
 
     def __init__(self):
@@ -76,9 +128,59 @@ class SpineHW(SpineBase):
         self._accel = 1                 
         self._tolerance = 50
         #TODO: fill self.neck_info and self.torso_info
+        self.KNI_lock = threading.Lock()        # KNI calls from many threads
         init_arm()
+        self.motion = MotionQueue(self.move_axis, self.axis_reached)
+        self.motion.start()
+        import conf
+        self.encoders = EncoderPoller(self.read_encoders,
+                                      xrange(1, len(self.AXIS_LIMITS)),
+                                      getattr(conf,'spine_poll_rate',POLL_RATE))
         self.switch_on()
 
+    def pre_shutdown(self):
+        SpineBase.pre_shutdown(self)
+        self.motion.stop()
+        self.encoders.stop()
+
+    def call_KNI(self, function, *args):
+        """Calls function of KNI with args, serialized with the calls of other
+        threads (the single link to the hardware). Returns its result."""
+        self.KNI_lock.acquire()
+        try:
+            return getattr(KNI, function)(*args)
+        finally:
+            self.KNI_lock.release()
+
+    def move_axis(self, axis, enc):
+        """Commands a motor (called by the motion thread)."""
+        LOG.debug('moving axis %i to encoder %i', axis, enc)
+        return self.call_KNI('moveMot', axis, enc, self._speed,
+                             self._accel) != -1
+
+    def axis_reached(self, axis, enc):
+        """Like KNI.waitForMot, without blocking (called by the motion
+        thread)."""
+        return abs(self.encoders.get_encoder(axis) - enc) <= self._tolerance
+
+    def read_encoders(self, axes):
+        """Reads the hardware (called by the encoder poller)."""
+        return [ self.call_KNI('getEncoder', axis) for axis in axes ]
+
+    def get_features_time(self, origin):
+        return self.encoders.get()[1]
+
+    def move_axes(self, encs, wait=False, callback=None):
+        """Queues targets for the motion thread. Returns the Motion.
+        encs: [ (axis, encoder value) ]
+        wait: block until reached (raises SpineError if not).
+        callback: function(reached) called once done (see spine.Motion).
+        """
+        motion = self.motion.put(encs, callback)
+        if wait and not motion.wait():
+            raise SpineError('failed to reach %s' % encs)
+        return motion
+
     def get_speed(self):
         return float(self._speed)/self.SPEED_LIMITS[0][1]
 
@@ -86,6 +188,14 @@ class SpineHW(SpineBase):
         max_speed = self.SPEED_LIMITS[0][1]
         self._speed = min(int(value*max_speed), max_speed)
 
+    def get_limits(self, part):
+        """Limits of the current speed and acceleration settings, in rad/s and
+        rad/s^2, for X, Y and Z of part."""
+        factors = numpy.array([ axis and abs(self.CALIBRATION[axis,CAL_FACTOR])
+                                or 1. for axis in self.PART_AXES[part] ])
+        return (self._speed * self.SPEED_UNIT / factors,
+                self._accel * self.ACCEL_UNIT / factors)
+
     def set_accel(self, value):
         """Set normalized values, relative to hardware capabilities."""
         self._accel = min(value, self.SPEED_LIMITS[1][1])
@@ -96,49 +206,52 @@ class SpineHW(SpineBase):
         self._tolerance = tolerance
 
     def get_torso_info(self):
-        """Returns TorsoInfo instance"""
-        self._torso_info.rot= self.round([SpineHW.enc2rad(2,KNI.getEncoder(2)),
-                                          0.0,
-                                          SpineHW.enc2rad(1,KNI.getEncoder(1))])
+        """Returns TorsoInfo instance, from the last encoder reads"""
+        encs, timestamp = self.encoders.get((1, 2))
+        z, x = SpineHW.encs2rads((1, 2), encs).tolist()
+        self._torso_info.rot= self.round([x, 0.0, z])
         return self._torso_info
 
     def get_neck_info(self):
-        """Returns NeckInfo instance"""
+        """Returns NeckInfo instance, from the last encoder reads"""
         # XXX: we are not using the same reference: create a mapping function
 #        tp = KNI.TPos()
 #        KNI.getPosition(tp)
 #        self._neck_info.pos= self.round([tp.X, tp.Y, tp.Z])
 #        self._neck_info.rot= self.round([tp.phi, tp.theta, tp.psi])
 
-        self._neck_info.rot = self.round( \
-            [ SpineHW.enc2rad(i, KNI.getEncoder(i)) for i in \
-                  xrange(4, len(self.AXIS_LIMITS)) ])
+        axes = self.PART_AXES['neck']
+        encs, timestamp = self.encoders.get(axes)
+        self._neck_info.rot = self.round(SpineHW.encs2rads(axes, encs))
         return self._neck_info
 
     def switch_on(self):
         """Mandatory 1st call after hardware is switched on.
-        Starts calibration if needed.
+        Starts calibration if needed, then the encoder poller.
         """
         if False in self.check_motors():
             self.calibrate()
         self.switch_auto()
-        self.set_neck_orientation((0,0,0))
-        self.set_torso_orientation((0,0,0))
+        # not polling during calibration (moves reached are read from there)
+        if not self.encoders.running:
+            self.encoders.start()
+        self.set_neck_orientation((0,0,0), True)
+        self.set_torso_orientation((0,0,0), True)
 
     def switch_off(self):
         """Set the robot for safe hardware switch off."""
-        self.pose_rest()
+        self.pose_rest(wait=True)
         self.switch_manual()
         
     def switch_manual(self):
         """WARNING: Allow free manual handling of the robot. ALL MOTORS OFF!"""
-        if KNI.allMotorsOff() == -1:
+        if self.call_KNI('allMotorsOff') == -1:
             raise SpineError('failed to switch motors off')
         self._motors_on = False
 
     def switch_auto(self):
         """Resumes normal (driven-mode) operation of the robot."""
-        if not self._motors_on and KNI.allMotorsOn() == -1:
+        if not self._motors_on and self.call_KNI('allMotorsOn') == -1:
             raise SpineError('failed to switch motors on')
         self._motors_on = True
 
@@ -146,65 +259,55 @@ class SpineHW(SpineBase):
         """Mandatory call upon hardware switch on. Also can be use to test 
          calibration procedure."""
         # TODO: use another sequence so that the arm does not collide itself
-        if KNI.calibrate(0) == -1:
+        if self.call_KNI('calibrate', 0) == -1:
             raise SpineError('failed to calibrate hardware')
 
     def check_motors(self):
         """Test each motor status"""
+        axes = range(1, len(self.AXIS_LIMITS))
+        encs = self.read_encoders(axes)
         motors = [None]*len(self.AXIS_LIMITS)
-        for i in xrange(1, len(self.AXIS_LIMITS)):
+        for i, enc in zip(axes, encs):
             LOG.debug('checking motor %i', i)
-            enc = KNI.getEncoder(i)
-            motors[i] = KNI.moveMot(i, enc, self._speed, self._accel) != -1
+            motors[i] = self.call_KNI('moveMot', i, enc, self._speed,
+                                      self._accel) != -1
         return motors
 
-    def reach_pose(self, pose):
+    def reach_pose(self, pose, wait=False):
         """This pose is defined so that the hardware is safe to switch-off.
         pose: a *list* of encoder values for each spine axis
         """
-        # no wait
-        if KNI.moveToPosEnc(*pose+[self._speed, self._accel, self._tolerance]+
-                             [True]) == -1:
-            raise SpineError('failed to reach pose')
+        return self.move_axes([ (i+1, enc) for i, enc in enumerate(pose) ],
+                              wait)
 
-    def pose_rest(self):
-        self.reach_pose(list(self.POSE_REST))
+    def pose_rest(self, wait=False):
+        return self.reach_pose(list(self.POSE_REST), wait)
 
-    def pose_average(self):
+    def pose_average(self, wait=False):
         """This pose is defined according to the mean value of each axis.
         Use this function to pose the robot so it has an even range of possible
         movements."""
-        self.reach_pose([(mn+mx)/2 for mn,mx,orig,fac in self.AXIS_LIMITS[1:]])
+        means, factors, mins, maxs = self.get_calibration(
+            tuple(range(1, len(self.AXIS_LIMITS))))
+        return self.reach_pose(((mins + maxs) // 2).tolist(), wait)
 
-    def set_neck_orientation(self, xyz, wait=True):
+    def set_neck_orientation(self, xyz, wait=False, callback=None):
         """Absolute orientation:
         Our own version since the IK is useless (ERROR: No solution found)"""
-        encs = [ (4+i, SpineHW.rad2enc(4+i, v)) for i,v in enumerate(xyz) ]
-        for axis, enc in encs:
-            LOG.debug('moving axis %i to encoder %i', axis, enc)
-            if KNI.moveMot(axis, enc, self._speed, self._accel) == -1:
-                raise SpineError('failed to reach rotation (axis %i)' % axis)
-        if not wait:
-            return
-        for axis, enc in encs:
-            if KNI.waitForMot(axis, enc, self._tolerance) != 1:
-                raise SpineError('failed to wait for motor %i' % (axis))
-
-    def set_torso_orientation(self, xyz, wait=True):
+        axes = self.PART_AXES['neck']
+        encs, clamped = SpineHW.rads2encs(axes, xyz)
+        if clamped.any():
+            LOG.debug('neck %s limited to %s', xyz, encs)
+        return self.move_axes(zip(axes, encs.tolist()), wait, callback)
+
+    def set_torso_orientation(self, xyz, wait=False, callback=None):
         """Absolute orientation:
         Our own version since the IK is useless (ERROR: No solution found)"""
-        encs = [ (1, SpineHW.rad2enc(1, xyz[2])),
-                 (2, SpineHW.rad2enc(2, xyz[0])),
-                 (3, SpineHW.rad2enc(3, 0)) ]
-        for axis, enc in encs:
-            LOG.debug('moving axis %i to encoder %i', axis, enc)
-            if KNI.moveMot(axis, enc, self._speed, self._accel) == -1:
-                raise SpineError('failed to reach rotation (axis %i)' % axis)
-        if not wait:
-            return
-        for axis, enc in encs:
-            if KNI.waitForMot(axis, enc, self._tolerance) != 1:
-                raise SpineError('failed to wait for motor %i' % axis)
+        axes = (1, 2, 3)
+        encs, clamped = SpineHW.rads2encs(axes, (xyz[2], xyz[0], 0))
+        if clamped.any():
+            LOG.debug('torso %s limited to %s', xyz, encs)
+        return self.move_axes(zip(axes, encs.tolist()), wait, callback)
 
     def set_neck_rot_pos(self, rot_xyz=None, pos_xyz=None):
         """Absolute orentation and position using KNI IK"""
@@ -213,13 +316,13 @@ class SpineHW(SpineBase):
                      rot_xyz, pos_xyz) 
             return False
         tp = KNI.TPos()
-        KNI.getPosition(tp)
+        self.call_KNI('getPosition', tp)
         if rot_xyz:
             tp.phy, tp.theta, tp.psi = rot_xyz
         if pos_xyz:
             tp.X, tp.Y, tp.Z = pos_xyz
-        ret = KNI.moveToPos(tp, self._speed, self._accel)
-        KNI.getPosition(tp)
+        ret = self.call_KNI('moveToPos', tp, self._speed, self._accel)
+        self.call_KNI('getPosition', tp)
         if ret == -1:
             raise SpineError('failed to reach rotation/position')
         return True
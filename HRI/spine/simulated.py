@@ -0,0 +1,251 @@
+#
+# This module implements a simulated Katana-400-6M backend for the spine module.
+#
+# The KNI functions used by the Katana backend (katHD400s_6M) are emulated by
+#  Katana: each axis follows a trapezoidal speed profile towards its target,
+#  within the encoder ranges of SpineHW.AXIS_LIMITS, integrated by a background
+#  thread at a fixed control rate. waitForMot() blocks until the axis reached
+#  its target, like the real thing. The Katana backend is then loaded against
+#  the simulated arm, so that spine servers and clients can be load-tested
+#  without hardware. Select it with the SPINE_BACKEND environment variable (see
+#  spine/__init__.py):
+#  $ SPINE_BACKEND=simulated python spine/__init__.py
+#
+# Command-to-settle latencies (from moveMot to the axis reaching its target) are
+#  recorded in the 'spine settle' histogram (see comm.tracing and the 'stats'
+#  command).
+#
+import os
+import sys
+import imp
+import atexit
+import math
+import time
+import threading
+
+import logging
+LOG = logging.getLogger(__package__)
+
+from comm import tracing
+
+CONTROL_RATE = 100.     # Hz, integration of motor states
+SPEED_UNIT = 100.       # KNI speed unit (encoder per 10ms) in encoder/s
+ACCEL_UNIT = 10000.     # KNI acceleration unit (encoder per 10ms^2) in enc/s^2
+WAIT_TIMEOUT = 30.      # in s, before waitForMot gives up
+
+
+class TPos(object):
+    """Cartesian position of the end effector, as KNI.TPos."""
+
+    def __init__(self):
+        self.X = self.Y = self.Z = 0.
+        self.phi = self.theta = self.psi = 0.
+
+
+class Axis(object):
+    """State of a simulated motor, in encoder units."""
+
+    def __init__(self, limits, position):
+        self.min, self.max = limits[:2]
+        self.position = float(position)
+        self.target = self.position
+        self.velocity = 0.
+        self.max_speed = 0.
+        self.accel = 0.
+        self.commanded = None   # time of the last move command, until settled
+
+    def move(self, target, speed, accel):
+        self.target = float(target)
+        self.max_speed = speed * SPEED_UNIT
+        self.accel = accel * ACCEL_UNIT
+        self.commanded = tracing.monotonic()
+
+    def stop(self):
+        self.target = self.position
+        self.velocity = 0.
+        self.commanded = None
+
+    def step(self, dt):
+        """Advances the motor by dt seconds. Returns True if it just settled."""
+        if self.commanded is None:
+            return False
+        distance = self.target - self.position
+        remaining = abs(distance)
+        if remaining <= abs(self.velocity) * dt or self.max_speed <= 0:
+            self.position, self.velocity = self.target, 0.
+            return True
+        # fastest speed allowing to brake before the target
+        desired = min(self.max_speed, math.sqrt(2*self.accel*remaining))
+        desired = math.copysign(desired, distance)
+        dv = self.accel * dt
+        self.velocity = min(max(desired, self.velocity - dv), self.velocity+dv)
+        self.position = min(max(self.min, self.position + self.velocity*dt),
+                            self.max)
+        return False
+
+
+class Katana(object):
+    """Simulated arm, implementing the KNI functions used by the Katana backend.
+    Functions return -1 on failure like KNI.
+    rate: frequency of the control loop, in Hz.
+    """
+
+    TPos = TPos
+
+    def __init__(self, rate=CONTROL_RATE):
+        self.rate = rate
+        self.axes = [None]              # indices like KNI
+        self.calibrated = False
+        self.motors_on = False
+        self.running = False
+        self.thread = None
+        self.cond = threading.Condition()
+
+    def set_axes(self, limits, pose):
+        """limits: AXIS_LIMITS of the backend, pose: initial encoder values."""
+        self.axes = [None] + [ Axis(l, p) for l, p in zip(limits[1:], pose) ]
+
+    def run(self):
+        """Control loop: integrates motor states with a fixed time step."""
+        period = 1. / self.rate
+        next_tick = time.time()
+        while self.running:
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()         # late: don't catch up
+            self.cond.acquire()
+            try:
+                self.step(period)
+            finally:
+                self.cond.release()
+
+    def step(self, dt):
+        """Advances all axes by dt seconds. Call with cond acquired."""
+        now = tracing.monotonic()
+        for axis in self.axes[1:]:
+            commanded = axis.commanded
+            if axis.step(dt):
+                axis.commanded = None
+                tracing.record('spine settle', now - commanded)
+        self.cond.notify_all()
+
+    def shutdown(self):
+        """Stops the control loop."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # KNI functions
+
+    def initKatana(self, config_file, address):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name='katana-sim')
+            self.thread.setDaemon(True)
+            self.thread.start()
+            LOG.info('simulated Katana running at %iHz', self.rate)
+        return 1
+
+    def calibrate(self, axis):
+        self.calibrated = self.motors_on = True
+        return 1
+
+    def allMotorsOn(self):
+        self.motors_on = True
+        return 1
+
+    def allMotorsOff(self):
+        self.cond.acquire()
+        try:
+            for axis in self.axes[1:]:
+                axis.stop()
+            self.motors_on = False
+        finally:
+            self.cond.release()
+        return 1
+
+    def getEncoder(self, axis):
+        return int(round(self.axes[axis].position))
+
+    def moveMot(self, axis, enc, speed, accel):
+        if not (self.calibrated and self.motors_on):
+            return -1
+        motor = self.axes[axis]
+        if not motor.min <= enc <= motor.max:
+            LOG.warning('axis %i: encoder %i out of range %s', axis, enc,
+                        (motor.min, motor.max))
+            return -1
+        self.cond.acquire()
+        try:
+            motor.move(enc, speed, accel)
+        finally:
+            self.cond.release()
+        return 1
+
+    def waitForMot(self, axis, enc, tolerance):
+        motor = self.axes[axis]
+        deadline = time.time() + WAIT_TIMEOUT
+        self.cond.acquire()
+        try:
+            while abs(motor.position - enc) > tolerance:
+                if motor.commanded is None or time.time() > deadline:
+                    return -1                   # not moving there anymore
+                self.cond.wait(deadline - time.time())
+        finally:
+            self.cond.release()
+        return 1
+
+    def moveToPosEnc(self, *args):
+        """args: encoder of each axis, speed, accel, tolerance, wait"""
+        encs, (speed, accel, tolerance, wait) = args[:-4], args[-4:]
+        for axis, enc in enumerate(encs):
+            if self.moveMot(axis+1, enc, speed, accel) == -1:
+                return -1
+        if wait:
+            for axis, enc in enumerate(encs):
+                if self.waitForMot(axis+1, enc, tolerance) != 1:
+                    return -1
+        return 1
+
+    def getPosition(self, tpos):
+        """No kinematic model: tpos is left unchanged."""
+        pass
+
+    def moveToPos(self, tpos, speed, accel):
+        LOG.warning('no inverse kinematics in the simulated Katana')
+        return -1
+
+
+def load_backend(kni):
+    """Loads a private copy of the Katana backend, driving kni instead of the
+    KNI module."""
+    path = os.path.join(os.path.dirname(__file__), 'katHD400s_6M')
+    saved = sys.modules.get('KNI')
+    sys.modules['KNI'] = kni
+    try:
+        return imp.load_module('spine.katHD400s_6M_simulated', None, path,
+                               ('', '', imp.PKG_DIRECTORY))
+    finally:
+        if saved is None:
+            del sys.modules['KNI']
+        else:
+            sys.modules['KNI'] = saved
+
+
+KNI = Katana()
+atexit.register(KNI.shutdown)
+_katana = load_backend(KNI)
+KNI.set_axes(_katana.SpineHW.AXIS_LIMITS, _katana.SpineHW.POSE_REST)
+
+
+def init_arm():
+    """Starts the simulated arm (replaces init_arm of the Katana backend)."""
+    KNI.initKatana(None, 'simulated')
+
+_katana.init_arm = init_arm
+
+SpineHW = _katana.SpineHW
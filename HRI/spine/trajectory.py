@@ -0,0 +1,198 @@
+#
+# Trajectories of the spine axes, for animate().
+#
+# A Trajectory moves each axis from its start to its target orientation in its
+#  own attack time, following a motion profile (see PROFILES) to rest. A start
+#  velocity (when replanning a moving axis) is blended in so that the motion
+#  goes on smoothly. Attack times too short for the speed or acceleration
+#  limits of an axis are extended to the shortest feasible ones.
+# TrajectoryPlayer samples trajectories at a fixed rate from a thread and
+#  streams the waypoints to the backend, so that the head reaches its targets
+#  in time, along with the AU transitions of the face. Waypoints are sent ahead
+#  of time by the lag measured between commands and the motion of each part.
+#
+import time
+import threading
+
+import logging
+LOG = logging.getLogger(__package__)
+
+import numpy
+
+RATE = 50.              # Hz, waypoints streamed to the backend
+MIN_DURATION = .001     # in s, attack time of 0
+MAX_LAG = .5            # in s, bound of the measured command-to-motion lag
+LAG_SMOOTHING = .1      # weight of each new lag measure
+MIN_LAG_SPEED = .05     # in rad/s, slower motions don't tell the lag
+
+
+def _min_jerk(s):
+    return 10*s**3 - 15*s**4 + 6*s**5
+
+def _trapezoidal(s):
+    """Constant acceleration during the 1st third, constant speed, then
+    constant deceleration during the last third."""
+    return numpy.where(s < 1/3., 2.25*s**2,
+                       numpy.where(s > 2/3., 1 - 2.25*(1-s)**2, 1.5*s - .25))
+
+# { name : (fraction of the move at progress s (0 to 1),
+#           peak speed and peak acceleration of a move of 1 in 1s) }
+PROFILES = {
+    'min_jerk'    : (_min_jerk, 1.875, 5.7735),
+    'trapezoidal' : (_trapezoidal, 1.5, 4.5),
+    }
+DEFAULT_PROFILE = 'min_jerk'
+
+def _start_velocity(s):
+    """Offset of a start speed of 1 (per unit of progress), vanishing with
+    its speed and acceleration at s = 1 (quintic Hermite basis)."""
+    return s - 6*s**3 + 8*s**4 - 3*s**5
+
+
+class Trajectory(object):
+    """Motion of several axes, each from start to target in its own duration.
+    durations: attack time of each axis (in s.), extended if needed to respect
+     max_speed (in rad/s) and max_accel (in rad/s^2) of each axis.
+    velocity: speed of each axis at start (in rad/s), default is rest.
+    duration: time the last axis reaches its target.
+    """
+
+    def __init__(self, start, target, durations, profile=DEFAULT_PROFILE,
+                 max_speed=None, max_accel=None, velocity=None):
+        try:
+            self.fraction, speed, accel = PROFILES[profile]
+        except KeyError:
+            raise ValueError('unknown profile %s (have: %s)' % (
+                    profile, sorted(PROFILES.keys())))
+        self.start = numpy.asarray(start, dtype=float)
+        self.delta = numpy.asarray(target, dtype=float) - self.start
+        distance = numpy.abs(self.delta)
+        durations = numpy.maximum(numpy.asarray(durations, dtype=float),
+                                  MIN_DURATION)
+        if max_speed is not None:
+            durations = numpy.maximum(durations, speed * distance / max_speed)
+        if max_accel is not None:
+            durations = numpy.maximum(durations,
+                                      numpy.sqrt(accel * distance / max_accel))
+        self.durations = durations
+        self.duration = durations.max()
+        # start velocity in distance per unit of progress
+        self.velocity = None
+        if velocity is not None:
+            self.velocity = numpy.asarray(velocity, dtype=float) * durations
+
+    def sample(self, t):
+        """Returns positions of all axes at t seconds from the start."""
+        progress = numpy.clip(t / self.durations, 0, 1)
+        position = self.start + self.delta * self.fraction(progress)
+        if self.velocity is not None:
+            position += self.velocity * _start_velocity(progress)
+        return position
+
+    def get_velocity(self, t, dt=.001):
+        """Returns speeds of all axes at t seconds from the start (in rad/s).
+        """
+        return (self.sample(t + dt) - self.sample(t - dt)) / (2*dt)
+
+
+class TrajectoryPlayer(object):
+    """Streams trajectories of spine parts (eg. neck and torso) from a thread.
+    Each tick, send(positions) of a playing part is called with the positions
+     of its trajectory at that time plus the lag of the part, until the end of
+     the trajectory.
+    The lag of a part is measured while it moves, from the positions returned
+     by the position() function given to play(): it is the time the part takes
+     to reach a waypoint.
+    """
+
+    def __init__(self, rate=RATE):
+        self.period = 1. / rate
+        # { part : (Trajectory, start time, send, position) }
+        self.tracks = {}
+        self.lags = {}          # { part : lag in s }
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='spine-player')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def play(self, part, trajectory, send, position=None):
+        """Plays trajectory for part from now on, replacing the one playing.
+        position: function returning the current positions of part, to measure
+         its lag (default: no lead)."""
+        self.lock.acquire()
+        self.tracks[part] = (trajectory, time.time(), send, position)
+        self.lock.release()
+
+    def cancel(self, part):
+        self.lock.acquire()
+        self.tracks.pop(part, None)
+        self.lock.release()
+
+    def get_state(self, part):
+        """Returns the current (positions, velocities) of the trajectory of part,
+        None if not playing."""
+        self.lock.acquire()
+        try:
+            if not self.tracks.has_key(part):
+                return None
+            trajectory, start = self.tracks[part][:2]
+        finally:
+            self.lock.release()
+        elapsed = time.time() - start
+        return trajectory.sample(elapsed), trajectory.get_velocity(elapsed)
+
+    def get_lag(self, part):
+        """Returns the lag measured for part (in s.)."""
+        return self.lags.get(part, 0.)
+
+    def measure_lag(self, part, trajectory, elapsed, position):
+        """Updates the lag of part from its positions when elapsed seconds
+        into trajectory: the part is at the waypoint sent lag seconds ago."""
+        velocity = trajectory.get_velocity(elapsed)
+        speed2 = numpy.dot(velocity, velocity)
+        if speed2 < MIN_LAG_SPEED**2:
+            return
+        lead = self.get_lag(part)
+        behind = trajectory.sample(elapsed) - numpy.asarray(position)
+        lag = min(max(lead + numpy.dot(behind, velocity) / speed2, 0), MAX_LAG)
+        self.lags[part] = lead + (lag - lead) * LAG_SMOOTHING
+
+    def run(self):
+        next_tick = time.time()
+        while self.running:
+            next_tick += self.period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.time()         # late: don't catch up
+            self.lock.acquire()
+            tracks = self.tracks.items()
+            self.lock.release()
+            now = time.time()
+            for part, (trajectory, start, send, position) in tracks:
+                elapsed = now - start
+                if elapsed >= trajectory.duration:
+                    self.lock.acquire()
+                    if self.tracks.get(part, (None,))[0] is trajectory:
+                        del self.tracks[part]
+                    self.lock.release()
+                try:
+                    if position is not None:
+                        self.measure_lag(part, trajectory, elapsed, position())
+                    send(trajectory.sample(elapsed + self.get_lag(part))
+                         .tolist())
+                except StandardError, e:
+                    LOG.warning('%s: could not send waypoint (%s)', part, e)
+                    self.cancel(part)
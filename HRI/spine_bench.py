@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for the spine module.
+
+Run with the common and HRI directories in your PYTHONPATH (see
+ source_me_to_set_env.sh), eg:
+ $ python spine_bench.py tracking
+Unless SPINE_BACKEND is set, the simulated Katana is used (see
+ spine/simulated.py), so that no arm is needed.
+"""
+
+import os
+import time
+import socket
+import random
+import logging
+import optparse
+import threading
+
+os.environ.setdefault('SPINE_BACKEND', 'simulated')
+
+import comm
+from comm import tracing
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values)*p), len(values)-1)]
+
+
+def print_settle():
+    for h in tracing.TRACER.get_stats():
+        if h.name == 'spine settle':
+            print 'settle (ms): %i moves, mean %.1f p99 %.1f max %.1f' % (
+                h.count, h.mean()*1e3, h.percentile(.99)*1e3, h.max*1e3)
+
+
+def bench_settle(options):
+    """Time for set_neck_orientation() with wait to return, for random targets
+    within +-0.3 rad on each axis."""
+    try:
+        from spine import Spine, LOG
+    except ImportError, e:
+        print 'settle: cannot import the spine module (%s)' % e
+        return
+    LOG.setLevel(logging.WARNING)
+    spine = Spine()
+    tracing.TRACER.reset()
+    random.seed(0)
+    timings = []
+    for i in xrange(options.moves):
+        xyz = [ random.uniform(-.3, .3) for axis in xrange(3) ]
+        t = time.time()
+        spine.set_neck_orientation(xyz, True)
+        timings.append(time.time() - t)
+    spine.pre_shutdown()
+    print '%8s %12s %12s %12s' % ('moves', 'mean (ms)', 'p99 (ms)', 'max (ms)')
+    print '%8i %12.1f %12.1f %12.1f' % (
+        len(timings), sum(timings)/len(timings)*1e3,
+        percentile(timings, .99)*1e3, max(timings)*1e3)
+    print_settle()
+
+
+def bench_tracking(options):
+    """Neck tracking through the spine server: neck targets are sent at camera
+    rate, each followed by a state query which reply time is measured."""
+    try:
+        from spine import Spine, SpineComm, LOG
+    except ImportError, e:
+        print 'tracking: cannot import the spine module (%s)' % e
+        return
+    LOG.setLevel(logging.WARNING)
+    logging.getLogger('comm').setLevel(logging.WARNING)
+    server = comm.create_server(Spine, SpineComm, ('localhost', 0),
+                                (False, False))
+    server.set_poll_timeout(.1)
+    server.start()
+    runner = threading.Thread(target=server.serve_forever)
+    runner.start()
+    tracing.TRACER.reset()
+    sock = socket.create_connection(server.addr_port)
+    sock_file = sock.makefile()
+    period = 1. / options.rate
+    random.seed(0)
+    xyz, replies = [0., 0., 0.], []
+    start = next_frame = time.time()
+    try:
+        for i in xrange(options.samples):
+            xyz = [ min(max(v + random.uniform(-.02, .02), -.3), .3)
+                    for v in xyz ]
+            t = time.time()
+            sock.sendall('neck %.4f %.4f %.4f %.3f\ncommit\nrotate\n' % tuple(
+                    xyz + [period]))
+            while not sock_file.readline().startswith('rot_torso'):
+                pass
+            replies.append(time.time() - t)
+            next_frame += period
+            delay = next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        duration = time.time() - start
+    finally:
+        sock.close()
+        server.running = False
+        runner.join()
+        server.shutdown()
+    print '%8s %10s %12s %12s %12s' % ('rate', 'achieved', 'mean (ms)',
+                                       'p99 (ms)', 'max (ms)')
+    print '%8i %10.1f %12.2f %12.2f %12.2f' % (
+        options.rate, len(replies)/duration, sum(replies)/len(replies)*1e3,
+        percentile(replies, .99)*1e3, max(replies)*1e3)
+    print_settle()
+
+
+def arrival(plan, target, tolerance=.01, step=.005):
+    """Time the trajectory plan gets within tolerance of target on all axes."""
+    t = 0.
+    while t < plan.duration and \
+            max(abs(plan.sample(t) - target)) > tolerance:
+        t += step
+    return min(t, plan.duration)
+
+
+def bench_animate(options):
+    """Arrival of animate() to random neck targets within +-0.3 rad, each with
+    the given attack time. Lateness is split in:
+     stretch: extension of the attack time to the speed and acceleration
+      limits of the axes (the planned duration, past the attack time),
+     lag: time past the trajectory's own arrival until the neck is within .01
+      rad of its target (tracking of the trajectory by the arm)."""
+    try:
+        from spine import Spine, LOG
+    except ImportError, e:
+        print 'animate: cannot import the spine module (%s)' % e
+        return
+    LOG.setLevel(logging.WARNING)
+    spine = Spine()
+    spine.set_profile(options.profile)
+    random.seed(0)
+    stretches, lags = [], []
+    for i in xrange(options.moves):
+        xyz = [ random.uniform(-.3, .3) for axis in xrange(3) ]
+        start = time.time()
+        plan = spine.animate([ (v, options.attack) for v in xyz ],
+                             None)['neck']
+        planned = arrival(plan, xyz)
+        while max([ abs(a - b) for a, b in
+                    zip(spine.get_neck_info().rot, xyz) ]) > .01:
+            time.sleep(.005)
+        stretches.append(plan.duration - options.attack)
+        lags.append(time.time() - start - planned)
+    lead = spine._player.get_lag('neck')
+    spine.pre_shutdown()
+    print '%12s %10s %8s %14s %12s %12s' % (
+        'profile', 'attack (s)', 'moves', 'stretch (ms)', 'lag (ms)',
+        'max lag (ms)')
+    print '%12s %10.2f %8i %14.1f %12.1f %12.1f' % (
+        options.profile, options.attack, len(lags),
+        sum(stretches)/len(stretches)*1e3, sum(lags)/len(lags)*1e3,
+        max(lags)*1e3)
+    print 'measured command-to-motion lag (lead of waypoints): %.1f ms' % (
+        lead*1e3)
+
+
+BENCHES = { 'animate' : bench_animate,
+            'settle' : bench_settle,
+            'tracking' : bench_tracking }
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] '+
+                                   '|'.join(sorted(BENCHES.keys())))
+    parser.add_option('-a', '--attack', dest='attack', type='float',
+                      default=1., help='attack time of animations (in s.)')
+    parser.add_option('-p', '--profile', dest='profile', default='min_jerk',
+                      help='motion profile of animations')
+    parser.add_option('-m', '--moves', dest='moves', type='int', default=20,
+                      help='number of moves to settle')
+    parser.add_option('-r', '--rate', dest='rate', type='float', default=30.,
+                      help='rate of neck targets (camera frame rate)')
+    parser.add_option('-s', '--samples', dest='samples', type='int',
+                      default=150, help='number of neck targets sent')
+    options, args = parser.parse_args()
+    for name in args or sorted(BENCHES.keys()):
+        if not BENCHES.has_key(name):
+            parser.error('unknown benchmark: %s' % name)
+        BENCHES[name](options)
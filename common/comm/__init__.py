@@ -41,10 +41,24 @@ __version__ = "0.3"
 __date__    = "$$"
 
 import os
+import time
+import errno
+import Queue
+import signal
+import thread
 import socket
 import select
 import logging
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
+
+from comm.reactor import get_reactor_class, EV_READ, EV_WRITE, EV_ERROR
+from comm.event_loop import Scheduler, EventLoop, Future, get_event_loop, \
+    TimeoutError, CancelledError
+from comm import frames, tracing
+try:
+    from comm.shm import ShmChannel
+except ImportError:                     # not a POSIX system
+    ShmChannel = None
 
 LOGFORMAT = "%(lineno)4d:%(filename).21s\t-%(levelname)s-\t%(message)s"
 # let users set log format themselves (see set_default_logging)
@@ -68,27 +82,39 @@ class ClassError(Exception):
     pass
 
 
-class BaseServer(object):
+class BaseServer(Scheduler):
     """Allows using a single threaded approach, inspired from SocketServer.
     Unfortunately SocketServer is an old-style class and has a rigid design.
+    Sockets are registered once in a reactor (see reactor.py) so that each
+     call to serve_once() only costs O(ready sockets).
+    serve_once() blocks until a socket is ready, a timer is due or wakeup() is
+     called (see set_poll_timeout() for a non-blocking serve_once()).
+    Messages sent by handlers are queued and flushed at the end of each
+     serve_once() tick. Partial writes wait for the socket to be writable.
+    Timers (see Scheduler in event_loop.py) are run after socket events.
     """
+
+    reactor_class = get_reactor_class()
+
     def __init__(self):
+        Scheduler.__init__(self)
         self.running = False
         self.threaded = False
         self.listen_timeout = 0.5
         self.handler_timeout = 0.01     # aim for 100 select() per second
         self.handler_looping = True     # default looping behaviour for RequestHandler
         self.clients = {}               # { sock : handler object }
+        self.pending_flush = {}         # { sock : handler with queued data }
+        self.channels = {}              # { channel served : name }
         self.socket = None
-        self.polling_sockets = None     # array of sockets polled in this thread
 
     def set_threaded(self):
         """Enable the server to start() its own thread.
-        Sets handler_timeout so select is blocking."""
+        Sets handler_timeout so sockets are blocking."""
         self.threaded = True
-        self.__is_shut_down = threading.Event()
-        self.__threading_lock = threading.Lock()
-        self.handler_timeout = None     # blocking select() in thread
+        self.__is_shut_down = Event()
+        self.__threading_lock = Lock()
+        self.handler_timeout = None     # blocking sockets in thread
 
     def set_addrPort(self, addrPort):
         self.addr_port = addrPort
@@ -101,15 +127,15 @@ class BaseServer(object):
         self.listen_timeout = listen_timeout
         if self.running:
             self.socket.settimeout(listen_timeout)
-            self.update_poll_timeout()
 
     def set_handler_timeout(self, timeout):
         """Sets new handlers' socket timeout."""
         self.handler_timeout = timeout
 
-    def update_poll_timeout(self):
-        self.poll_interval = min([sock.gettimeout() for sock in \
-                                      self.polling_sockets + [self.socket]])
+    def set_reactor_class(self, name):
+        """Selects the reactor by name ('epoll', 'poll' or 'select').
+        Must be called before start()."""
+        self.reactor_class = get_reactor_class(name)
 
     def activate(self):
         """To be overriden"""
@@ -123,15 +149,19 @@ class BaseServer(object):
         """Starts the server (listen to connections)"""
         self.running = True
         self.activate()
-        self.polling_sockets = [self.socket]
-        self.update_poll_timeout()
+        self.setup_reactor()
         if self.threaded:
-            self.thread = Thread(target=G.server.serve_forever, name='server')
+            self.thread = Thread(target=self.serve_forever, name='server')
             self.thread.start()
-        LOG.debug("server started in %s-thread mode",
-                  self.threaded and 'multi' or 'single')
+        LOG.debug("server started in %s-thread mode (%s reactor)",
+                  self.threaded and 'multi' or 'single', self.reactor.name)
         return self.threaded and self.thread or None
 
+    def setup_reactor(self):
+        """Creates the reactor and registers the listening socket."""
+        self.reactor = self.reactor_class()
+        self.reactor.register(self.socket)
+
     def pre_shutdown(self):
         """To be overriden"""
         pass
@@ -142,37 +172,65 @@ class BaseServer(object):
         if self.socket:
             self.running = False
             if self.threaded:
+                self.wakeup()
                 self.__is_shut_down.wait()
                 self.thread.join()
             else:
-                for fd, client in self.clients.items():
-                    client.finish()
-                    if client.socket in self.polling_sockets:
-                        self.close_request(client.socket)
+                for sock, client in self.clients.items():
+                    if self.reactor is not None and sock in self.reactor:
+                        client.finish()
+                        self.close_request(sock)
+                    else:
+                        self.stop_request(sock)
         self.disactivate()
+        if self.reactor is not None:
+            self.reactor.close()
         LOG.debug('server now shut down.')
 
     def serve_once(self):
         """Check for incoming connections and saves further calls to select()
-         for that thread."""
-        # XXX: Consider using another file descriptor or
-        # connecting to the socket to wake this up instead of
-        # polling. Polling reduces our responsiveness to a
-        # shutdown request and wastes cpu at all other times.
+         for that thread. Due timers are run after socket events."""
+        self.loop_thread = thread.get_ident()
         try:
-            r, w, e = select.select(self.polling_sockets, [],
-                                    self.polling_sockets, self.poll_interval)
-            if e:
-                return self.handle_error(e, self.clients[e].addr_port)
-            for sock in r:
-                if sock == self.socket:
-                    self._handle_request_noblock()
-                elif not self.clients[sock].read_socket():
-                    self.close_request(sock)
+            for sock, events in self.reactor.poll(self.get_poll_timeout()):
+                self.handle_socket_events(sock, events)
+            self.run_timers()
+            self.flush_clients()
         except Exception, err:
-            return self.handle_error(self.polling_sockets, None)
+            return self.handle_error(self.socket, None)
         return True
 
+    def handle_socket_events(self, sock, events):
+        """Handles events (see reactor.py) of the listening socket or of a
+         client socket."""
+        if sock is self.socket:
+            return self._handle_request_noblock()
+        # may have been closed by a previous handler in this pass
+        if not self.clients.has_key(sock):
+            return
+        if events & EV_ERROR:
+            self.handle_error(sock, self.clients[sock].addr_port)
+            return self.close_request(sock)
+        if events & EV_WRITE:
+            self.pending_flush[sock] = self.clients[sock]
+        if events & EV_READ and not self.clients[sock].read_socket():
+            self.close_request(sock)
+
+    def flush_clients(self):
+        """Sends data queued by handlers. Handlers which could not send
+        everything are flushed again once their socket is writable."""
+        pending, self.pending_flush = self.pending_flush, {}
+        for sock, handler in pending.iteritems():
+            if not self.clients.has_key(sock):
+                continue
+            try:
+                done = handler.flush()
+            except socket.error, e:
+                handler.handle_error(e)
+                self.close_request(sock)
+                continue
+            self.reactor.modify(sock, done and EV_READ or EV_READ|EV_WRITE)
+
     def serve_forever(self):
         """Blocking call. Inspired from SocketServer.
         """
@@ -230,15 +288,63 @@ class BaseServer(object):
         """Creates a new client. Overridden by ForkingMixIn and ThreadingMixIn.
         """
         handler = self.finish_request(sock, client_addrPort)
-        self.polling_sockets.append(sock)
-        self.update_poll_timeout()
+        self.reactor.register(sock)
         self.clients[sock] = handler
 
+    def serve_channel(self, channel, name):
+        """Serves an already connected socket-like object (eg. a
+         shm.ShmChannel) as one more client. Call after start().
+        Each time its client disconnects, the channel is reset() and served by
+         a new handler for the next client."""
+        self.channels[channel] = name
+        self.process_request(channel, ('localhost', name))
+
+    def reset_channel(self, channel):
+        """Serves channel again, for its next client."""
+        if self.running and self.channels.has_key(channel):
+            channel.reset()
+            self.process_request(channel, ('localhost', self.channels[channel]))
+
+    def run_request(self, sock, client_addrPort):
+        """Runs a handler until disconnection, outside of the reactor.
+        Used by threads and processes serving a single client."""
+        try:
+            try:
+                handler = self.finish_request(sock, client_addrPort)
+                self.clients[sock] = handler
+                handler.run()
+            except:
+                self.handle_error(sock, client_addrPort)
+        finally:
+            self.clients.pop(sock, None)
+            sock.close()
+
+    def stop_request(self, sock):
+        """Makes the thread running a handler (see run_request) return."""
+        handler = self.clients.get(sock)
+        if handler:
+            handler.running = False
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
     def close_request(self, sock):
         """Cleans up an individual request. Extend but don't override."""
-        del self.polling_sockets[self.polling_sockets.index(sock)]
+        if self.pending_flush.pop(sock, None):
+            try:
+                self.clients[sock].flush()
+            except socket.error:
+                pass
+        self.reactor.unregister(sock)
         del self.clients[sock]
-        self.update_poll_timeout()
+        if self.channels.has_key(sock):
+            if self.running:
+                # after the closing of sock by the caller
+                self.call_soon(self.reset_channel, sock)
+            else:
+                sock.shutdown(socket.SHUT_RDWR)         # for its client
+                del self.channels[sock]
 
     def set_auto(self):
         """Restores functions hooked by set_manual
@@ -447,36 +553,260 @@ class ThreadingMixIn:
         """Same as in BaseServer but as a thread.
         In addition, exception handling is done here.
         """
-        try:
-            self.finish_request(socket, client_addrPort)
-            self.close_request(socket)
-        except:
-            self.handle_error(socket, client_addrPort)
-            self.close_request(socket)
+        self.run_request(socket, client_addrPort)
 
     def process_request(self, socket, client_addrPort):
         """Start a new thread to process the request."""
-        t = threading.Thread(target = self.process_request_thread,
-                             args = (socket, client_addrPort))
+        t = Thread(target = self.process_request_thread,
+                   args = (socket, client_addrPort))
         if self.daemon_threads:
             t.setDaemon (1)
         t.start()
 
 
+class PoolingMixIn(object):
+    """Mix-in class to handle requests with a pool of pre-started threads.
+    Accepted connections wait in a bounded queue for a free worker. When the
+     queue is full, the connection is given to reject_request().
+    """
+
+    pool_size = 8               # number of worker threads
+    queue_size = 16             # accepted connections waiting for a worker
+    daemon_threads = True
+
+    def set_pool_size(self, pool_size, queue_size=None):
+        """Must be called before start()."""
+        self.pool_size = pool_size
+        if queue_size is not None:
+            self.queue_size = queue_size
+
+    def activate(self):
+        super(PoolingMixIn, self).activate()
+        self.requests = Queue.Queue(self.queue_size)
+        self.stopping = False
+        self.workers = []
+        for i in xrange(self.pool_size):
+            worker = Thread(target=self.process_requests_thread,
+                            name='worker-%i' % i)
+            worker.setDaemon(self.daemon_threads)
+            worker.start()
+            self.workers.append(worker)
+
+    def shutdown(self):
+        """Workers stop taking queued connections from now on."""
+        self.stopping = True
+        super(PoolingMixIn, self).shutdown()
+
+    def disactivate(self):
+        self.stopping = True
+        # connections not served yet are closed
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            if request is not None:
+                request[0].close()
+        self.wake_worker()
+        super(PoolingMixIn, self).disactivate()
+
+    def wake_worker(self):
+        """Makes a waiting worker return, which wakes the next one up."""
+        try:
+            self.requests.put_nowait(None)
+        except Queue.Full:
+            pass                        # workers have requests to check
+
+    def process_requests_thread(self):
+        """Worker loop: serves queued connections until stopping."""
+        while True:
+            request = self.requests.get()
+            if request is None or self.stopping:
+                if request is not None:
+                    request[0].close()
+                self.wake_worker()
+                break
+            self.run_request(*request)
+
+    def process_request(self, sock, client_addrPort):
+        """Queues the request for a worker."""
+        if self.stopping:
+            return sock.close()
+        try:
+            self.requests.put_nowait((sock, client_addrPort))
+        except Queue.Full:
+            self.reject_request(sock, client_addrPort)
+
+    def reject_request(self, sock, client_addrPort):
+        """Rejection policy when all workers are busy and the queue is full.
+        Default tells the client and closes the connection. May be overriden.
+        """
+        LOG.warning('all %i workers busy: rejecting %s', self.pool_size,
+                    client_addrPort)
+        try:
+            sock.sendall('busy\n')
+        except socket.error:
+            pass
+        sock.close()
+
+
+class PreforkingMixIn(object):
+    """Mix-in class pre-forking processes which share the listening socket.
+    Each child serves its own clients with its own reactor, the parent process
+     only restarts children which died.
+    """
+
+    num_children = 4
+    supervise_interval = 1.0
+
+    def set_num_children(self, num_children):
+        """Must be called before start()."""
+        self.num_children = num_children
+
+    def setup_reactor(self):
+        """The parent process does not accept connections."""
+        self.children = []
+        self.is_child = False
+        for i in xrange(self.num_children):
+            if self.spawn_child():
+                return
+        self.reactor = self.reactor_class()
+
+    def spawn_child(self):
+        """Returns True in the child process."""
+        pid = os.fork()
+        if pid:
+            self.children.append(pid)
+            return False
+        self.is_child, self.children = True, []
+        super(PreforkingMixIn, self).setup_reactor()
+        try:
+            try:
+                self.serve_forever()
+            except:
+                self.handle_error(self.socket, None)
+        finally:
+            os._exit(0)
+
+    def serve_once(self):
+        """Parent process: waits for shutdown and restarts dead children."""
+        if self.is_child:
+            return super(PreforkingMixIn, self).serve_once()
+        self.reactor.poll(self.supervise_interval)
+        for pid in self.children[:]:
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except os.error:
+                done, status = pid, None
+            if done and self.running:
+                LOG.warning('child %i died (status %s), restarting', pid, status)
+                self.children.remove(pid)
+                if self.spawn_child():
+                    return False
+        return True
+
+    def disactivate(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except os.error:
+                pass
+        super(PreforkingMixIn, self).disactivate()
+
+
+class AsyncMixIn(object):
+    """Mix-in class serving requests from a shared EventLoop (see
+     event_loop.py) instead of the server's own reactor: many servers and
+     clients can be served by a single thread calling loop.run_forever().
+    Timers are those of the loop.
+    """
+
+    loop = None
+
+    def set_event_loop(self, loop):
+        """Must be called before start(). Default is get_event_loop()."""
+        self.loop = loop
+
+    def setup_reactor(self):
+        if self.loop is None:
+            self.loop = get_event_loop()
+        self.reactor = self.loop.shared_reactor(self)
+        self.reactor.register(self.socket)
+        self.loop.servers.append(self)
+
+    def in_loop_thread(self):
+        return self.loop is None or self.loop.in_loop_thread()
+
+    def add_timer(self, delay, function, *args):
+        if self.loop is None:           # timer set up before start()
+            self.loop = get_event_loop()
+        return self.loop.add_timer(delay, function, *args)
+
+    def cancel_timer(self, timer):
+        self.loop.cancel_timer(timer)
+
+    def call_soon(self, function, *args):
+        return self.loop.call_soon(function, *args)
+
+    def serve_once(self):
+        """Runs one tick of the loop, serving its other users as well."""
+        self.loop.run_once()
+        return True
+
+    def shutdown(self):
+        """Safe from any thread: the loop thread closes the connections."""
+        if not self.in_loop_thread():
+            return self.loop.call_from_thread(self.shutdown).result()
+        super(AsyncMixIn, self).shutdown()
+
+
 class ForkingUDPServer(ForkingMixIn, UDPServer): pass
 class ForkingTCPServer(ForkingMixIn, TCPServer): pass
 
 class ThreadingUDPServer(ThreadingMixIn, UDPServer): pass
 class ThreadingTCPServer(ThreadingMixIn, TCPServer): pass
 
+class PoolingTCPServer(PoolingMixIn, TCPServer): pass
+class PreforkingTCPServer(PreforkingMixIn, TCPServer): pass
+class AsyncTCPServer(AsyncMixIn, TCPServer): pass
+
+class ShmServer(BaseServer):
+    """Serves one client at a time through a shared memory channel (see
+    shm.py). addr_port is the path of the channel file, eg. under /dev/shm.
+    """
+
+    def activate(self):
+        self.channel = ShmChannel()
+        self.channel.create(self.addr_port)
+
+    def disactivate(self):
+        self.running = False
+        self.channel.shutdown(socket.SHUT_RDWR)
+        if self.clients.has_key(self.channel):
+            self.clients[self.channel].finish()
+            self.close_request(self.channel)
+        self.channels.pop(self.channel, None)
+        self.channel.close()
+        self.channel.unlink()
+
+    def setup_reactor(self):
+        self.reactor = self.reactor_class()
+        self.serve_channel(self.channel, self.addr_port)
+
+
 #
 # addition
 # { type of port : { proto : { threading : class } } }
+# threading: False, True (thread per client), 'pool', 'prefork' or 'async'
 #
 SERVER_CLASSES = { type(42): {'udp': { True : ThreadingUDPServer,
                                        False: UDPServer },
                               'tcp': { True : ThreadingTCPServer,
-                                       False: TCPServer }
+                                       False: TCPServer,
+                                       'pool': PoolingTCPServer,
+                                       'prefork': PreforkingTCPServer,
+                                       'async': AsyncTCPServer }
                               } }
 
 if hasattr(socket, 'AF_UNIX'):
@@ -497,19 +827,32 @@ if hasattr(socket, 'AF_UNIX'):
 
     class ThreadingUnixStreamServer(ThreadingMixIn, UnixStreamServer): pass
     class ThreadingUnixDatagramServer(ThreadingMixIn, UnixDatagramServer): pass
+    class PoolingUnixStreamServer(PoolingMixIn, UnixStreamServer): pass
+    class PreforkingUnixStreamServer(PreforkingMixIn, UnixStreamServer): pass
+    class AsyncUnixStreamServer(AsyncMixIn, UnixStreamServer): pass
 #
 # And of pure reuse
 #
     SERVER_CLASSES[type('')] = { 'tcp': { True : ThreadingUnixStreamServer,
-                                          False: UnixStreamServer },
+                                          False: UnixStreamServer,
+                                          'pool': PoolingUnixStreamServer,
+                                          'prefork': PreforkingUnixStreamServer,
+                                          'async': AsyncUnixStreamServer},
                                  'udp': { True : ThreadingUnixDatagramServer,
                                           False: UnixDatagramServer }
                                  }
 
+if ShmChannel:
+    SERVER_CLASSES.setdefault(type(''), {})['shm'] = { False: ShmServer }
+
 def getBaseServerClass(addr_port, threaded):
     """Returns the appropriate base class for server according to addr_port"""
     """protocol can be specified using a prefix from 'udp:' or 'tcp:' in the
-     port field (eg. 'udp:4242'). Default is udp."""
+     port field (eg. 'udp:4242'). Default is udp. Use 'shm:<path>' for a
+     shared memory channel (see shm.py).
+    threaded: False, True (a thread per client), 'pool' (a pool of threads),
+     'prefork' (processes sharing the listening socket) or 'async' (served by
+     the event loop, see AsyncMixIn)."""
     D_PROTO = 'tcp'
     try:
         addr, port = addr_port
@@ -517,9 +860,10 @@ def getBaseServerClass(addr_port, threaded):
         raise ValueError('addr_port is a tuple also for AF_UNIX: %s'% addr_port)
     # check protocol
     if type(port) == type(''):
-        proto, port = port.find(':') > 0 and port.split(':') or (D_PROTO, port)
+        proto, port = port.find(':') > 0 and port.split(':', 1) or (D_PROTO, port)
         if port.isdigit():
-            addr_port = (addr, int(port))
+            port = int(port)
+        addr_port = (addr, port)
     else:
         proto = D_PROTO
 
@@ -555,8 +899,10 @@ def create_RequestHandlerClass(handler_class, threaded=False):
                 self._threading_lock.release()
         handler_class.__init__(self)
 
-    return type(handler_class.__name__+'RequestHandler',
-                (handler_class, RequestHandler),{'__init__':handler_init})
+    cls = type(handler_class.__name__+'RequestHandler',
+               (handler_class, RequestHandler),{'__init__':handler_init})
+    build_cmd_table(cls)
+    return cls
 
 
 def create_server(ext_class, handler_class, addr_port, thread_info):
@@ -583,6 +929,30 @@ def create_server(ext_class, handler_class, addr_port, thread_info):
 # Protocol Level: Request Handlers and Remote Clients 
 ###
 
+def build_cmd_table(cls):
+    """(Re)builds the dispatch table of cls: { command name : attribute name }
+    for all cmd_ functions of cls and its bases. The table is stored in cls.
+    """
+    prefix = BaseComm.CMD_PREFIX
+    table = {}
+    for attr in dir(cls):
+        if attr.startswith(prefix) and callable(getattr(cls, attr)):
+            table[attr[len(prefix):]] = attr
+    cls._cmd_table = table
+    return table
+
+def get_cmd_table(cls):
+    """Returns the dispatch table of cls, building it on first use."""
+    try:
+        return cls.__dict__['_cmd_table']       # not the one of a base class
+    except KeyError:
+        return build_cmd_table(cls)
+
+def invalidate_cmd_table(cls):
+    """Forgets the dispatch table of cls, rebuilt on next get_cmd_table()."""
+    if cls.__dict__.has_key('_cmd_table'):
+        del cls._cmd_table
+
 class BaseComm(object):
     """Basic protocol handling and command-to-function resolver. This is the
      base class for a local client connecting to a server (BaseClient) or for a
@@ -590,15 +960,41 @@ class BaseComm(object):
      This class mainly relies on socket's fileno() function.
 
     To implement a binary protocol, you'd override process() and parse_cmd().
+
+    Received bytes are appended to a bytearray (rbuf) using recv_into() and a
+     preallocated chunk of recv_size bytes. Only newly arrived bytes are
+     scanned for end of lines, and process() only gets complete lines.
+
+    Commands are resolved with self.cmds, a dict of bound cmd_ functions built
+     from the class dispatch table (see build_cmd_table()).
+
+    In binary mode (see frames.py), rbuf holds frames instead of lines and
+     cmd_ functions receive tuples of decoded records.
+
+    Outgoing messages are queued in obuf and sent together by flush(). With
+     autoflush, each message is flushed (blocking) right away.
     """
 
     CMD_PREFIX = "cmd_"
+    RECV_SIZE = 4096
+    autoflush = True
 
     def __init__(self):
-        self.command = ''
+        self.rbuf = bytearray()         # received data not processed yet
+        self._rscan = 0                 # rbuf[:_rscan] has no end of line
+        self.set_recv_size(self.RECV_SIZE)
         self.buffered = ''
         self.connected = False
         self.running = False
+        self.binary = False             # reading frames instead of lines
+        self.obuf = []                  # queued outgoing data
+        self._olock = Lock()
+        self.bind_cmds()
+
+    def bind_cmds(self):
+        """Sets self.cmds: { command name : bound function }"""
+        self.cmds = dict( (name, getattr(self, attr)) for name, attr in
+                          get_cmd_table(self.__class__).iteritems() )
 
     def abort(self):
         """For read_while_running"""
@@ -622,17 +1018,73 @@ class BaseComm(object):
             return self.abort()
         return self.read_socket()
 
+    def set_recv_size(self, size):
+        """Sets the maximum number of bytes read by a single recv."""
+        self.recv_size = size
+        self._rchunk = bytearray(size)
+
     def read_socket(self):
         """Read its own socket."""
         try:
-            buff = self.socket.recv(1024)
-            if not buff:
+            length = self.socket.recv_into(self._rchunk, self.recv_size)
+            if not length:
                 return self.abort()
-            self.command += buff
         except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True             # spurious wakeup
             self.handle_error(e)
             return self.abort()
-        self.command = self.command[self.process(self.command):]
+        self.rbuf += buffer(self._rchunk, 0, length)
+        return self.process_rbuf()
+
+    def process_rbuf(self):
+        """Gives complete lines from rbuf to process(), keeping the rest.
+        Scanning starts where the previous call stopped: rbuf[:_rscan] is known
+         to have no end of line.
+        Return: False if the connection was aborted.
+        """
+        if not self.binary:
+            end = self.rbuf.rfind('\n', self._rscan) + 1
+            if end:
+                lines = str(buffer(self.rbuf, 0, end))
+                del self.rbuf[:end]
+                length = self.process(lines)
+                if length < end:
+                    self.rbuf[0:0] = lines[length:]
+            self._rscan = len(self.rbuf)
+        # process() stops after switching to binary mode
+        if self.binary:
+            return self.process_frames()
+        return True
+
+    def process_frames(self):
+        """Dispatches complete frames from rbuf, keeping the rest.
+        A frame holding a partial record aborts the connection (returns False).
+        """
+        tracing.received()
+        offset, size = 0, len(self.rbuf)
+        while size - offset >= frames.HEADER.size:
+            kind, length = frames.HEADER.unpack_from(self.rbuf, offset)
+            start = offset + frames.HEADER.size
+            if start + length > size:
+                break
+            offset = start + length
+            try:
+                cmd, args = frames.decode(kind, buffer(self.rbuf,start,length))
+            except KeyError:
+                LOG.warning("%s> unknown frame kind %i [%iB]",
+                            self.socket.fileno(), kind, length)
+                continue
+            except frames.FrameError, e:
+                LOG.warning("%s> %s, resetting connection",
+                            self.socket.fileno(), e)
+                del self.rbuf[:]
+                return self.abort()
+            if cmd is None:
+                self.process(args+'\n')
+            else:
+                self.dispatch(cmd, args, 'frame %s [%iB]' % (cmd, length))
+        del self.rbuf[:offset]
         return True
 
     def read_while_running(self):
@@ -644,10 +1096,11 @@ class BaseComm(object):
             pass
 
     def handle_notfound(self, cmd, args):
-        """When a method (a command) is not found in self. See process().
+        """When a command is not found in self.cmds. See process().
+        cmd: command name (without CMD_PREFIX).
         To be overriden.
         """
-        LOG.debug("function %s not found in %s [args: '%s']", cmd, self, args)
+        LOG.debug("command %s not found in %s [args: '%s']", cmd, self, args)
 
     def handle_error(self, e):
         """Callback for connection error.
@@ -656,12 +1109,19 @@ class BaseComm(object):
 
     def parse_cmd(self, cmdline):
         cmd_tokens = cmdline.split(None,1) # keep 1
-        cmd, args = self.CMD_PREFIX+cmd_tokens.pop(0),\
-                    cmd_tokens and cmd_tokens[0] or ""
+        if not cmd_tokens:
+            return
+        cmd, args = cmd_tokens.pop(0), cmd_tokens and cmd_tokens[0] or ""
+        self.dispatch(cmd, args, cmdline)
+
+    def dispatch(self, cmd, args, cmdline):
+        """Calls the function bound to command cmd with args.
+        cmdline: what to log if the command fails.
+        """
         try:
             try:
-                bound_fct = getattr(self, cmd)
-            except AttributeError:
+                bound_fct = self.cmds[cmd]
+            except KeyError:
                 self.handle_notfound(cmd, args)
             else:
                 bound_fct(args)
@@ -675,15 +1135,17 @@ class BaseComm(object):
         """Command dispatcher function.
 
         Tokenize command and calls 'cmd_ + 1st_token' function defined in self.
-         Calls self.handle_notfound if the built function name isn't defined.
+         Calls self.handle_notfound if the command isn't in self.cmds.
          Function is called with remaining tokens (array) as one argument.
          Simultaneous commands (called within the same step) can be issued
           linking them with '&&'.
 
-        command: string of text to be parsed
+        command: string of complete lines to be parsed
         Returns the number of bytes read.
         """        
         length = 0
+        start = tracing.monotonic()
+        tracing.received(start)
         LOG.debug("%s> command [%iB]: '%s'",
                   self.socket.fileno(), len(command), command)
 
@@ -705,12 +1167,62 @@ class BaseComm(object):
             self.buffered = ''
             for cmd in cmdline.split('&&'):
                 self.parse_cmd(cmd)
+            if self.binary:
+                break
+        tracing.record('process', tracing.monotonic() - start)
         return length
 
     def send_msg(self, msg):
         """Sends msg with a trailing \\n as required by the protocol."""
         LOG.debug("sending %s\n", msg)
-        self.socket.send(msg+'\n')
+        self.queue_data(msg+'\n')
+
+    def send_frame(self, kind, records):
+        """Sends records in a frame of the given kind (see frames.py).
+        The connection must be in binary mode."""
+        self.queue_data(frames.encode(kind, records))
+
+    def queue_data(self, data):
+        """Queues data for the next flush()."""
+        self._olock.acquire()
+        self.obuf.append(data)
+        self._olock.release()
+        if self.autoflush:
+            self.flush()
+        else:
+            self.request_flush()
+
+    def request_flush(self):
+        """Called when data is queued without autoflush. To be overriden."""
+        pass
+
+    def flush(self):
+        """Sends queued data with a single system call.
+        With autoflush this blocks until everything is sent, otherwise what
+         could not be sent stays queued.
+        Returns: True if everything was sent.
+        """
+        self._olock.acquire()
+        try:
+            if not self.obuf:
+                return True
+            data = len(self.obuf) == 1 and self.obuf[0] or ''.join(self.obuf)
+            if self.autoflush:
+                self.obuf = []
+                self.socket.sendall(data)
+                return True
+            try:
+                sent = self.socket.send(data)
+            except socket.timeout:
+                sent = 0
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                sent = 0
+            self.obuf = sent < len(data) and [data[sent:]] or []
+            return not self.obuf
+        finally:
+            self._olock.release()
 
     def cmd_bye(self, args):
         """Disconnects that client."""
@@ -724,8 +1236,11 @@ class RequestHandler(BaseComm):
     Reads data from self.request and adds default functions :
      cmd_shutdown, cmd_clients and cmd_verb.
     If needed, define your own protocol handler overriding BaseComm.process.
+    Messages are flushed by the server at the end of each serve_once() tick.
     """
 
+    autoflush = False
+
     def __init__(self, server, sock, addr_port):
         BaseComm.__init__(self)
         self.server = server
@@ -757,8 +1272,36 @@ class RequestHandler(BaseComm):
         """Overrides SocketServer"""
 #        if not self.server.handler_looping:
 #            return
-        LOG.info("%i> connection terminating : %s on "+str(self.addr_port[1]),
-                 self.socket.fileno(), self.addr_port[0])
+        LOG.info("connection terminating : %s on "+str(self.addr_port[1]),
+                 self.addr_port[0])
+
+    def send_msg(self, msg):
+        """Sends msg from the thread serving this handler: other threads wake
+        the server up instead of writing concurrently to the socket."""
+        if self.server.in_loop_thread() or not self.served_by_reactor():
+            return BaseComm.send_msg(self, msg)
+        self.server.call_soon(BaseComm.send_msg, self, msg)
+
+    def served_by_reactor(self):
+        """False if the handler runs in its own thread or process."""
+        return self.server.reactor is not None and \
+            self.socket in self.server.reactor
+
+    def request_flush(self):
+        """Lets the server flush at the end of the tick."""
+        if self.served_by_reactor():
+            self.server.pending_flush[self.socket] = self
+        else:
+            self.autoflush = True
+            self.flush()
+
+    def cmd_binary(self, args):
+        """Switches to binary frames (see frames.py). Replies in ASCII."""
+        if args.strip() != str(frames.VERSION):
+            self.send_msg('binary refused %i' % frames.VERSION)
+            return
+        self.binary = True
+        self.send_msg('binary %i' % frames.VERSION)
 
     def cmd_shutdown(self, args):
         """Disconnects all clients and terminate the server process."""
@@ -782,6 +1325,30 @@ class RequestHandler(BaseComm):
             obuffer += "\\\n> %s:  %5s  %s" % client_info
         self.send_msg(obuffer)
         
+    def cmd_stats(self, args):
+        """Latency of trace points (see tracing.py), in microseconds:
+         stats <name> <count> <mean> <50th percentile> <99th percentile> <max>
+         then end_stats <number of trace points>.
+         args: 'reset' clears statistics, 'last' lists recent transactions:
+          transaction <ID> <stage>:<microseconds since received> ...
+        """
+        args = args.strip()
+        if args == 'reset':
+            tracing.TRACER.reset()
+        elif args == 'last':
+            for tid, stages in list(tracing.TRACER.recent):
+                start = stages[0][1]
+                self.send_msg('transaction %i %s' % (tid, ' '.join([
+                                '%s:%i' % (name, (t - start)*1e6) for
+                                name, t in stages ])))
+            return self.send_msg('end_stats %i' % len(tracing.TRACER.recent))
+        histograms = tracing.TRACER.get_stats()
+        for h in histograms:
+            self.send_msg('stats %s %i %i %i %i %i' % (
+                    h.name.replace(' ', '_'), h.count, h.mean()*1e6,
+                    h.percentile(.5)*1e6, h.percentile(.99)*1e6, h.max*1e6))
+        self.send_msg('end_stats %i' % len(histograms))
+
     def cmd_verb(self, args):
         """Changes LOG verbosity level."""
         if not args:
@@ -802,11 +1369,33 @@ class BaseClient(BaseComm):
     def __init__(self, addr_port):
         BaseComm.__init__(self)
         family, self.target_addr = get_conn_infos(addr_port)
-        self.socket = socket.socket(family)
+        if family == AF_SHM:
+            self.socket = ShmChannel()
+        else:
+            self.socket = socket.socket(family)
 
     def set_timeout(self, timeout):
         self.socket.settimeout(timeout)
 
+    def set_binary(self, timeout=None):
+        """Asks the server to switch to binary frames (see send_frame()).
+        Frames shall only be sent once the server accepted: if the connection
+         is read from another thread, wait up to timeout seconds for it.
+        Returns: True if the server accepted.
+        """
+        self.binary_accepted = Event()
+        self.send_msg('binary %i' % frames.VERSION)
+        if timeout:
+            self.binary_accepted.wait(timeout)
+        return self.binary_accepted.isSet()
+
+    def cmd_binary(self, argline):
+        """Server's answer to set_binary()."""
+        if argline.startswith('refused'):
+            LOG.warning('server refused binary mode (%s)', argline)
+        else:
+            self.binary_accepted.set()
+
     def disconnect(self):
         """Set flag for disconnection.
         You need to set a timeout to connect_and_run() or read_until_done()"""
@@ -850,6 +1439,133 @@ class BaseClient(BaseComm):
         LOG.debug('client disconnected from remote server %s', self.target_addr)
 
 
+class AsyncBaseClient(BaseClient):
+    """Client served by an EventLoop (see event_loop.py): connecting, reading
+     and sending never block, so that many clients can share one thread.
+    Instead of polling attributes set by cmd_ functions, callers can wait for
+     replies with expect() or request().
+    """
+
+    autoflush = False
+
+    def __init__(self, addr_port, loop=None):
+        BaseClient.__init__(self, addr_port)
+        self.loop = loop or get_event_loop()
+        self.reactor = self.loop.shared_reactor(self)
+        self.socket.setblocking(0)
+        self.connecting = None
+        self.waiters = {}               # { command : [(Future, commands)] }
+
+    def connect(self):
+        """Starts connecting, from any thread.
+        Returns a Future set to True once connected."""
+        self.connecting = Future(self.loop)
+        if self.loop.in_loop_thread():
+            self._connect()
+        else:
+            self.loop.call_soon(self._connect)
+        return self.connecting
+
+    def _connect(self):
+        err = self.socket.connect_ex(self.target_addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            return self._connect_failed(err)
+        self.reactor.register(self.socket, EV_WRITE)
+
+    def _connect_failed(self, err):
+        e = socket.error(err, os.strerror(err))
+        self.handle_error('%s: %s' % (self.target_addr, e))
+        self.reactor.unregister(self.socket)
+        self.socket.close()
+        self.connecting.set_exception(e)
+
+    def handle_socket_events(self, sock, events):
+        """Called by the loop with events (see reactor.py) of our socket."""
+        if not self.connected:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return self._connect_failed(err)
+            self.connected = self.running = True
+            self.reactor.modify(sock, EV_READ)
+            self.handle_connect()
+            self.connecting.set_result(True)
+            if self.obuf:
+                self.request_flush()
+            return
+        if events & EV_ERROR:
+            self.handle_error('error on socket %s' % sock)
+            return self.close()
+        if events & EV_WRITE:
+            self.loop.pending_flush[sock] = self
+        if events & EV_READ and not self.read_socket() or not self.running:
+            self.close()
+
+    def send_msg(self, msg):
+        """Queues msg, from any thread. Sent at the end of the loop's tick."""
+        if self.loop.in_loop_thread():
+            return BaseComm.send_msg(self, msg)
+        self.loop.call_soon(BaseComm.send_msg, self, msg)
+
+    def request_flush(self):
+        if self.connected:
+            self.loop.pending_flush[self.socket] = self
+
+    def expect(self, *commands):
+        """Returns a Future set to (command, argline) by the next reply being
+         one of commands, eg. expect('ACK', 'NACK').
+        Waiters of a command are served in order."""
+        future = Future(self.loop)
+        for command in commands:
+            self.waiters.setdefault(command, []).append((future, commands))
+        return future
+
+    def request(self, msg, *commands):
+        """Sends msg and returns expect(*commands)."""
+        future = self.expect(*commands)
+        self.send_msg(msg)
+        return future
+
+    def dispatch(self, cmd, args, cmdline):
+        BaseComm.dispatch(self, cmd, args, cmdline)
+        waiters = self.waiters.get(cmd)
+        while waiters:
+            future, commands = waiters.pop(0)
+            self._forget(future, commands)
+            if not future.done():
+                future.set_result((cmd, args))
+                break
+
+    def _forget(self, future, commands):
+        """Removes future from the waiters of all its commands."""
+        for command in commands:
+            waiters = self.waiters.get(command)
+            if waiters is None:
+                continue
+            waiters[:] = [ w for w in waiters if w[0] is not future ]
+            if not waiters:
+                del self.waiters[command]
+
+    def disconnect(self):
+        """Closes the connection, from any thread."""
+        if self.loop.in_loop_thread():
+            self.close()
+        else:
+            self.loop.call_soon(self.close)
+
+    def close(self):
+        """Closes the connection and fails all waiters."""
+        self.reactor.unregister(self.socket)
+        self.socket.close()
+        was_connected, self.connected, self.running = self.connected, False, False
+        waiters, self.waiters = self.waiters, {}
+        for futures in waiters.itervalues():
+            for future, commands in futures:
+                if not future.done():
+                    future.set_exception(ProtocolError('disconnected'))
+        if was_connected:
+            self.handle_disconnect()
+
+
 def set_default_logging(debug=False):
     """This function does nothing if the root logger already has
     handlers configured."""
@@ -858,8 +1574,12 @@ def set_default_logging(debug=False):
     LOG.setLevel(log_lvl)
     LOG.info('set log level to %s', debug and 'DEBUG' or 'INFO')
 
+AF_SHM = 'shm'
+
 def get_conn_infos(addr_port):
     LOCALHOSTS = ["127.0.0.1", "localhost"]
+    if type(addr_port[1]) == type("") and addr_port[1].startswith('shm:'):
+        return AF_SHM, addr_port[1][4:]
     if hasattr(socket, "AF_UNIX") and type(addr_port[1]) == type(""):
         if addr_port[0] and addr_port[0] not in LOCALHOSTS:
             raise ProtcolError('address must be null or one of %s', LOCALHOSTS)
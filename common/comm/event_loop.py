@@ -0,0 +1,386 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event loop shared by several servers and clients.
+
+Scheduler holds timers and is the base of BaseServer and EventLoop.
+An EventLoop polls a single reactor for all its users: servers (see
+ comm.AsyncMixIn) and clients (see comm.AsyncBaseClient). Each user gets a
+ SharedReactor; objects it registers are dispatched back to its
+ handle_socket_events() method.
+
+Operations completing in the loop are represented by a Future which other
+ threads can wait for, and the loop thread can run the loop until it is done
+ (see EventLoop.run_until_complete()).
+
+ loop = comm.get_event_loop()
+ client = MyClient(('localhost', 4242))
+ client.connect().result(5)
+ command, argline = client.request('hello', 'ACK', 'NACK').result(1)
+"""
+
+import time
+import heapq
+import thread
+import socket
+import logging
+from threading import Thread, Lock, Event
+
+from comm.reactor import get_reactor_class, EV_READ, EV_WRITE
+
+LOG = logging.getLogger('comm')
+
+
+class TimeoutError(Exception):
+    """A Future was not done in time."""
+    pass
+
+class CancelledError(Exception):
+    """A Future was cancelled."""
+    pass
+
+
+class Scheduler(object):
+    """Timers run by the thread polling self.reactor.
+    The poll timeout is shortened so that timers are called in time, and
+     other threads adding a timer wake the poll up.
+    """
+
+    timer_resolution = 0.001            # poll() timeouts are in milliseconds
+
+    def __init__(self):
+        self.reactor = None
+        self.poll_timeout = None        # block until something happens
+        self.timers = []                # heap of [deadline, id, fct, args]
+        self._timers_lock = Lock()
+        self._timers_count = 0
+        self.loop_thread = None         # thread id polling the reactor
+
+    def set_poll_timeout(self, timeout):
+        """Sets the maximum time the reactor is polled for events.
+        None (default) blocks until a socket is ready, a timer is due or
+         wakeup() is called. Use 0 when polling from another loop (eg. a
+         rendering loop) which must never block."""
+        self.poll_timeout = timeout
+
+    def in_loop_thread(self):
+        """True if called from the thread polling the reactor, False as long as
+        no thread polled it."""
+        return self.loop_thread == thread.get_ident()
+
+    def wakeup(self):
+        """Interrupts a blocking poll. Safe from any thread."""
+        if self.reactor is not None:
+            self.reactor.wakeup()
+
+    def add_timer(self, delay, function, *args):
+        """Calls function(*args) from the polling thread in delay seconds.
+        Safe from any thread. Returns a timer to be given to cancel_timer().
+        """
+        self._timers_lock.acquire()
+        self._timers_count += 1
+        timer = [time.time()+delay, self._timers_count, function, args]
+        heapq.heappush(self.timers, timer)
+        self._timers_lock.release()
+        if not self.in_loop_thread():
+            self.wakeup()
+        return timer
+
+    def cancel_timer(self, timer):
+        """Cancels a timer returned by add_timer(). Safe from any thread."""
+        timer[2] = None
+
+    def call_soon(self, function, *args):
+        """Calls function(*args) from the polling thread as soon as possible.
+        Safe from any thread."""
+        return self.add_timer(0, function, *args)
+
+    def get_poll_timeout(self):
+        """Returns poll_timeout, shortened for the next due timer."""
+        if not self.timers:
+            return self.poll_timeout
+        delay = max(self.timers[0][0] - time.time(), 0)
+        if self.poll_timeout is None:
+            return delay
+        return min(delay, self.poll_timeout)
+
+    def run_timers(self):
+        """Calls all due timers."""
+        now = time.time() + self.timer_resolution
+        while self.timers and self.timers[0][0] <= now:
+            self._timers_lock.acquire()
+            deadline, tid, function, args = heapq.heappop(self.timers)
+            self._timers_lock.release()
+            if function:
+                try:
+                    function(*args)
+                except Exception:
+                    LOG.exception('error in timer %s%s', function, args)
+
+
+class Future(object):
+    """Result of an operation completed by the event loop.
+    Other threads can block on result(). From the loop thread, result() runs
+     the loop until the future is done.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self._done = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.isSet()
+
+    def cancelled(self):
+        return isinstance(self._exception, CancelledError)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._set_done()
+
+    def cancel(self):
+        """Returns False if the future is already done."""
+        if self.done():
+            return False
+        self.set_exception(CancelledError())
+        return True
+
+    def _set_done(self):
+        self._lock.acquire()
+        self._done.set()
+        callbacks, self._callbacks = self._callbacks, []
+        self._lock.release()
+        for function in callbacks:
+            function(self)
+
+    def add_done_callback(self, function):
+        """Calls function(future) once done, right away if already done.
+        The callback runs in the thread completing the future."""
+        self._lock.acquire()
+        done = self.done()
+        if not done:
+            self._callbacks.append(function)
+        self._lock.release()
+        if done:
+            function(self)
+
+    def wait(self, timeout=None):
+        """Blocks until done or timeout. Returns done().
+        From the loop thread, or while no thread runs the loop, the loop is run
+         until done instead."""
+        if not self.done() and self.loop and (self.loop.loop_thread is None or
+                                              self.loop.in_loop_thread()):
+            self.loop.run_until_complete(self, timeout)
+        else:
+            self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """Returns the result, raising the exception set if any.
+        Raises TimeoutError if not done within timeout seconds."""
+        if not self.wait(timeout):
+            raise TimeoutError('no result after %ss' % timeout)
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError('no result after %ss' % timeout)
+        return self._exception
+
+
+class SharedReactor(object):
+    """Reactor given to each user of an EventLoop: registered objects are
+    polled by the loop and their events given to user.handle_socket_events().
+    To be used from the loop thread.
+    """
+
+    def __init__(self, loop, user):
+        self.loop = loop
+        self.user = user
+        self.name = loop.reactor.name
+
+    def __len__(self):
+        return len([ u for u in self.loop.owners.itervalues()
+                     if u is self.user ])
+
+    def __contains__(self, obj):
+        return self.loop.owners.get(obj) is self.user and \
+            obj in self.loop.reactor
+
+    def register(self, obj, events=EV_READ):
+        self.loop.reactor.register(obj, events)
+        self.loop.owners[obj] = self.user
+
+    def modify(self, obj, events):
+        self.loop.reactor.modify(obj, events)
+
+    def unregister(self, obj):
+        if self.loop.owners.get(obj) is not self.user:
+            return False
+        del self.loop.owners[obj]
+        self.loop.pending_flush.pop(obj, None)
+        return self.loop.reactor.unregister(obj)
+
+    def poll(self, timeout=None):
+        raise NotImplementedError('shared reactors are polled by their loop')
+
+    def wakeup(self):
+        self.loop.wakeup()
+
+    def close(self):
+        """Unregisters all objects of the user. The loop keeps running."""
+        for obj, user in self.loop.owners.items():
+            if user is self.user:
+                self.unregister(obj)
+        if self.user in self.loop.servers:
+            self.loop.servers.remove(self.user)
+
+
+class EventLoop(Scheduler):
+    """Serves many servers and clients from a single thread.
+    Servers registered in self.servers get their flush_clients() called at
+     the end of each tick. Clients put themselves in pending_flush.
+    """
+
+    def __init__(self, reactor_class=None):
+        Scheduler.__init__(self)
+        self.reactor = (reactor_class or get_reactor_class())()
+        self.owners = {}                # { registered object : user }
+        self.servers = []               # users flushing their own clients
+        self.pending_flush = {}         # { sock : client with queued data }
+        self.running = False
+        self.thread = None
+
+    def shared_reactor(self, user):
+        """Returns the reactor to be used by user (see SharedReactor)."""
+        return SharedReactor(self, user)
+
+    def run_once(self):
+        """Dispatches ready sockets, then calls due timers and flushes."""
+        self.loop_thread = thread.get_ident()
+        for obj, events in self.reactor.poll(self.get_poll_timeout()):
+            # may have been unregistered by a previous user in this pass
+            user = self.owners.get(obj)
+            if user is None:
+                continue
+            try:
+                user.handle_socket_events(obj, events)
+            except Exception:
+                LOG.exception('error handling events of %s', user)
+        self.run_timers()
+        for server in self.servers[:]:
+            server.flush_clients()
+        self.flush_clients()
+
+    def flush_clients(self):
+        """Sends data queued by clients, see BaseServer.flush_clients()."""
+        pending, self.pending_flush = self.pending_flush, {}
+        for sock, client in pending.iteritems():
+            if self.owners.get(sock) is not client:
+                continue
+            try:
+                done = client.flush()
+            except socket.error, e:
+                client.handle_error(e)
+                client.close()
+                continue
+            self.reactor.modify(sock, done and EV_READ or EV_READ|EV_WRITE)
+
+    def run_forever(self):
+        """Blocking call: runs the loop until stop()."""
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def run_until_complete(self, future, timeout=None):
+        """Runs the loop until future is done or timeout expires.
+        Returns future.done()."""
+        future.add_done_callback(lambda f: self.wakeup())
+        timer = timeout is not None and self.add_timer(timeout, None)
+        deadline = timeout is not None and time.time() + timeout
+        try:
+            while not future.done():
+                if deadline and time.time() >= deadline:
+                    break
+                self.run_once()
+        finally:
+            if timer:
+                self.cancel_timer(timer)
+        return future.done()
+
+    def call_from_thread(self, function, *args):
+        """Calls function(*args) from the loop thread.
+        Returns a Future set to the value returned by function."""
+        future = Future(self)
+        def call():
+            try:
+                future.set_result(function(*args))
+            except Exception, e:
+                future.set_exception(e)
+        if self.in_loop_thread():
+            call()
+        else:
+            self.call_soon(call)
+        return future
+
+    def start(self):
+        """Runs the loop in its own (daemon) thread, if not already running.
+        Returns the thread."""
+        if self.thread and self.thread.isAlive():
+            return self.thread
+        self.running = True
+        self.thread = Thread(target=self.run_forever, name='event loop')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.loop_thread = self.thread.ident
+        return self.thread
+
+    def stop(self):
+        """Makes run_forever() return. Safe from any thread."""
+        self.running = False
+        self.wakeup()
+        if self.thread and not self.in_loop_thread():
+            self.thread.join()
+
+    def close(self):
+        self.reactor.close()
+        self.owners.clear()
+
+
+_default_loop = None
+_default_loop_lock = Lock()
+
+def get_event_loop():
+    """Returns the default event loop, creating it on first call."""
+    global _default_loop
+    _default_loop_lock.acquire()
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    _default_loop_lock.release()
+    return _default_loop
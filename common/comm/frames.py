@@ -0,0 +1,104 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary framing for the comm protocol.
+
+A client switches a connection to binary mode by sending the ASCII line:
+ binary <VERSION>
+The server replies (in ASCII) 'binary <VERSION>' and reads frames from then on,
+ or 'binary refused <VERSION>' and keeps reading ASCII lines.
+
+A frame is a fixed header (kind, payload length) followed by a payload of
+ packed records. Each kind maps to a command: the cmd_ function receives the
+ tuple of decoded records instead of an ASCII argument line.
+
+kind        command record (network byte order)
+FRAME_LINE  -       an ASCII command line, processed as usual
+FRAME_AU    AU      name (8 chars), value, duration
+FRAME_GAZE  gaze    x, y, z, duration
+FRAME_NECK  neck    x, y, z, attack time
+"""
+
+import struct
+
+VERSION = 1
+
+HEADER = struct.Struct('!BH')           # kind, payload length
+MAX_PAYLOAD = 0xFFFF
+
+FRAME_LINE = 0
+FRAME_AU   = 1
+FRAME_GAZE = 2
+FRAME_NECK = 3
+
+
+class FrameError(ValueError):
+    """A frame payload which does not hold a whole number of records."""
+    pass
+
+
+def _decode_AU(record):
+    return (record[0].rstrip('\0'),) + record[1:]
+
+# { kind : (command, record struct, record decoder) }
+FRAMES = { FRAME_LINE : (None, None, None),
+           FRAME_AU   : ('AU',   struct.Struct('!8sff'), _decode_AU),
+           FRAME_GAZE : ('gaze', struct.Struct('!4f'), None),
+           FRAME_NECK : ('neck', struct.Struct('!4f'), None),
+           }
+
+
+def register_frame(kind, command, record_format, decoder=None):
+    """Adds a kind of frame which records are given to cmd_<command>.
+    decoder: optional function applied to each unpacked record.
+    """
+    if FRAMES.has_key(kind):
+        raise ValueError('frame kind %i already used by %s' % (
+                kind, FRAMES[kind][0]))
+    FRAMES[kind] = (command, struct.Struct(record_format), decoder)
+
+
+def encode(kind, records):
+    """Returns a frame (string) of records of the given kind.
+    For FRAME_LINE, records is the command line."""
+    if kind == FRAME_LINE:
+        payload = records
+    else:
+        record = FRAMES[kind][1]
+        payload = ''.join([ record.pack(*r) for r in records ])
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError('frame payload too big (%iB)' % len(payload))
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def decode(kind, payload):
+    """Returns (command, records) from a frame payload (string or buffer).
+    Raises KeyError for unknown kinds, FrameError for a partial record."""
+    command, record, decoder = FRAMES[kind]
+    if record is None:
+        return None, str(payload)
+    size = record.size
+    if len(payload) % size:
+        raise FrameError('%s frame payload (%iB) is not a multiple of %iB' % (
+                command, len(payload), size))
+    records = [ record.unpack_from(payload, i) for i in
+                xrange(0, len(payload) - size + 1, size) ]
+    if decoder:
+        records = [ decoder(r) for r in records ]
+    return command, tuple(records)
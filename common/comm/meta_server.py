@@ -1,4 +1,3 @@
-import types
 import logging
 
 import comm
@@ -6,11 +5,16 @@ import comm
 LOG = logging.getLogger(__package__)
 
 class MetaRequestHandler(object):
-    """
+    """Routes commands to the current subhandler.
+    Each subhandler gets a routing table merging its commands with ours, so
+     switching subhandler swaps self.cmds and dispatching stays a single dict
+     lookup. Our own commands take precedence.
     """
 
     def __init__(self):
         self.curr_handler = None
+        self.routes = {}                # { subhandler : merged cmds }
+        self.own_cmds = self.cmds
 
     def create_subhandler(self, srv, subhandler_class):
         """Equivalent of create_subserver.
@@ -20,34 +24,44 @@ class MetaRequestHandler(object):
         subhandler.socket = self.socket
         subhandler.addr_port = self.addr_port
         subhandler.server = srv
-        subhandler.send_msg = types.MethodType(comm.BaseComm.send_msg,
-                                               subhandler, subhandler_class)
+        # share our output queue so messages keep their order
+        subhandler.send_msg = self.send_msg
+        self.add_route(subhandler)
         return subhandler
 
+    def add_route(self, subhandler):
+        """Builds the routing table used while subhandler is current."""
+        routes = dict(subhandler.cmds)
+        routes.update(self.own_cmds)
+        self.routes[subhandler] = routes
+
     def set_current_subhandler(self, handler):
         self.curr_handler = handler
+        self.cmds = handler and self.routes[handler] or self.own_cmds
 
-    def handle_notfound(self, cmd, argline):
-        """Routes cmd_ functions to the current handler.
+    def rebuild_routes(self):
+        """Rebuilds dispatch tables of self and subhandlers, then the routes.
+        Call this after cmd_ functions have been added or replaced at runtime.
         """
+        for handler in [self] + self.routes.keys():
+            comm.invalidate_cmd_table(handler.__class__)
+            handler.bind_cmds()
+        self.own_cmds = self.cmds
+        for subhandler in self.routes.keys():
+            self.add_route(subhandler)
+        self.set_current_subhandler(self.curr_handler)
+
+    def handle_notfound(self, cmd, argline):
+        """Neither us nor the current subhandler know about cmd."""
         if not self.curr_handler:
             LOG.debug("unset current handler and no %s() in %s", cmd, self)
             return
-        try:
-            fct = getattr(self.curr_handler, cmd)
-        except AttributeError:
-            LOG.info("%s has no function '%s'", self.curr_handler, cmd)
-        except :
-            raise
-        else:
-            fct(argline)
+        LOG.info("%s has no command '%s'", self.curr_handler, cmd)
 
     def cmd_list(self, argline):
         """list all available commands"""
-        cmds = []
-        for obj in (self, self.curr_handler):
-            cmds.append( [a[4:] for a in dir(obj) if a.startswith('cmd_')] )
-        cmds[1] = filter(lambda x: x not in cmds[0], cmds[1])
+        cmds = [ sorted(self.own_cmds.keys()), sorted(
+                [ c for c in self.cmds.keys() if not self.own_cmds.has_key(c) ])]
         self.send_msg('commands:\t{0[0]}\nextra commands:\t{0[1]}'.format(cmds))
 
 
@@ -76,6 +90,7 @@ class MetaServer(object):
                                  (handler_class, comm.BaseComm),
                                  {'__init__':meta_subhandler_init,
                                   'server':server} )
+        comm.build_cmd_table(commHandler_class)
         self.servers_SHclasses[server] = commHandler_class
         return commHandler_class
 
@@ -0,0 +1,322 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+I/O readiness notification for the comm servers.
+
+A reactor keeps a registry of objects providing fileno() (sockets mostly) and
+ tells which ones are ready. Objects are registered once and stay in the
+ kernel's interest list (epoll, poll), so waiting costs O(ready objects)
+ instead of O(registered objects) with select().
+
+Each reactor also holds a Waker so that other threads can interrupt a blocking
+ poll() with wakeup(): a server can then wait indefinitely when idle.
+
+Available reactors, best first: epoll (Linux), poll, select.
+"""
+
+import os
+import math
+import errno
+import socket
+import select
+
+EV_READ  = 1
+EV_WRITE = 2
+EV_ERROR = 4
+
+
+def _interrupted(err):
+    """True if err (select.error, IOError or OSError) comes from a signal."""
+    return err.args and err.args[0] == errno.EINTR
+
+
+class Waker(object):
+    """Self-pipe: writing a byte makes the reading end readable.
+    On platforms where select() only accepts sockets (Windows), a pair of
+     connected loopback sockets is used instead."""
+
+    def __init__(self):
+        if os.name == 'posix':
+            import fcntl
+            self._r, self._w = os.pipe()
+            for fd in (self._r, self._w):
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._read = lambda: os.read(self._r, 512)
+            self._write = lambda: os.write(self._w, 'w')
+            self._close = lambda: (os.close(self._r), os.close(self._w))
+        else:
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            w = socket.create_connection(listener.getsockname())
+            r = listener.accept()[0]
+            listener.close()
+            r.setblocking(0)
+            w.setblocking(0)
+            self._r = r.fileno()
+            self._read = lambda: r.recv(512)
+            self._write = lambda: w.send('w')
+            self._close = lambda: (r.close(), w.close())
+
+    def fileno(self):
+        return self._r
+
+    def wake(self):
+        """Safe from any thread or signal handler."""
+        try:
+            self._write()
+        except (IOError, OSError, socket.error), e:
+            # full pipe: a wakeup is already pending
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def drain(self):
+        try:
+            while self._read():
+                pass
+        except (IOError, OSError, socket.error), e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        self._close()
+
+
+class BaseReactor(object):
+    """Registry of file objects and their event mask. To be derived."""
+
+    name = None
+
+    def __init__(self):
+        self.handlers = {}      # { fileno : registered object }
+        self.events = {}        # { fileno : event mask }
+        self._setup()
+        self.waker = Waker()
+        self.register(self.waker)
+
+    def __len__(self):
+        """Number of registered objects, not counting the waker."""
+        return len(self.handlers) - 1
+
+    def __contains__(self, obj):
+        fd = self._fileno(obj)
+        return fd is not None and self.handlers.get(fd) is obj
+
+    def _fileno(self, obj):
+        """File descriptor obj was registered with, even if obj is closed."""
+        try:
+            return obj.fileno()
+        except (socket.error, ValueError):
+            for fd, registered in self.handlers.iteritems():
+                if registered is obj:
+                    return fd
+        return None
+
+    def register(self, obj, events=EV_READ):
+        """Adds obj (providing fileno()) to the objects we wait for."""
+        fd = obj.fileno()
+        self.handlers[fd] = obj
+        self.events[fd] = events
+        self._register(fd, events)
+
+    def modify(self, obj, events):
+        """Changes the event mask of a registered object."""
+        fd = obj.fileno()
+        if self.events[fd] != events:
+            self.events[fd] = events
+            self._modify(fd, events)
+
+    def unregister(self, obj):
+        """Removes obj. Shall be called before closing obj.
+        Returns False if obj was not registered."""
+        fd = self._fileno(obj)
+        if fd is None or self.handlers.get(fd) is not obj:
+            return False
+        del self.handlers[fd]
+        del self.events[fd]
+        self._unregister(fd)
+        return True
+
+    def poll(self, timeout=None):
+        """Waits for events.
+        timeout: in seconds, None blocks until an event occurs.
+        Returns: [ (registered object, event mask) ]
+        """
+        try:
+            ready = self._poll(timeout)
+        except (select.error, IOError, OSError), e:
+            if _interrupted(e):
+                return []
+            raise
+        waker_fd = self.waker.fileno()
+        events = []
+        for fd, ev in ready:
+            if fd == waker_fd:
+                self.waker.drain()
+            elif fd in self.handlers:
+                events.append((self.handlers[fd], ev))
+        return events
+
+    def wakeup(self):
+        """Interrupts poll() right away. Safe from any thread."""
+        self.waker.wake()
+
+    def close(self):
+        self.unregister(self.waker)
+        self.waker.close()
+        self.handlers.clear()
+        self.events.clear()
+
+    def _setup(self):
+        pass
+
+    def _register(self, fd, events):
+        pass
+
+    def _modify(self, fd, events):
+        pass
+
+    def _unregister(self, fd):
+        pass
+
+    def _poll(self, timeout):
+        raise NotImplementedError()
+
+
+class SelectReactor(BaseReactor):
+    """Kept for compatibility: select() still scans every registered fd."""
+
+    name = 'select'
+
+    def _poll(self, timeout):
+        rlist = [ fd for fd, ev in self.events.iteritems() if ev & EV_READ ]
+        wlist = [ fd for fd, ev in self.events.iteritems() if ev & EV_WRITE ]
+        r, w, e = select.select(rlist, wlist, self.handlers.keys(), timeout)
+        ready = {}
+        for fds, ev in ((r, EV_READ), (w, EV_WRITE), (e, EV_ERROR)):
+            for fd in fds:
+                ready[fd] = ready.get(fd, 0) | ev
+        return ready.iteritems()
+
+
+class PollReactor(BaseReactor):
+    """poll() based reactor, for systems without epoll."""
+
+    name = 'poll'
+
+    def _setup(self):
+        self._poller = select.poll()
+        self._to_sys = { EV_READ : select.POLLIN | select.POLLPRI,
+                         EV_WRITE: select.POLLOUT }
+        # a hang-up is reported as readable so that recv() notices EOF
+        self._from_sys = ( (select.POLLIN | select.POLLPRI | select.POLLHUP,
+                            EV_READ),
+                           (select.POLLOUT, EV_WRITE),
+                           (select.POLLERR | select.POLLNVAL, EV_ERROR) )
+
+    def _mask(self, events):
+        mask = 0
+        for ev, sys_ev in self._to_sys.iteritems():
+            if events & ev:
+                mask |= sys_ev
+        return mask
+
+    def _register(self, fd, events):
+        self._poller.register(fd, self._mask(events))
+
+    def _modify(self, fd, events):
+        self._poller.register(fd, self._mask(events))
+
+    def _unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def _translate(self, sys_ready):
+        ready = []
+        for fd, sys_ev in sys_ready:
+            ev = 0
+            for sys_mask, mask in self._from_sys:
+                if sys_ev & sys_mask:
+                    ev |= mask
+            ready.append((fd, ev))
+        return ready
+
+    def _poll(self, timeout):
+        if timeout is not None:
+            # round up: a sub-millisecond timeout must not become 0 (no wait)
+            timeout = int(math.ceil(timeout * 1000))
+        return self._translate(self._poller.poll(timeout))
+
+
+class EpollReactor(PollReactor):
+    """epoll() based reactor (Linux 2.6 and above)."""
+
+    name = 'epoll'
+
+    def _setup(self):
+        self._poller = select.epoll()
+        self._to_sys = { EV_READ : select.EPOLLIN | select.EPOLLPRI,
+                         EV_WRITE: select.EPOLLOUT }
+        self._from_sys = ( (select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP,
+                            EV_READ),
+                           (select.EPOLLOUT, EV_WRITE),
+                           (select.EPOLLERR, EV_ERROR) )
+
+    def _modify(self, fd, events):
+        self._poller.modify(fd, self._mask(events))
+
+    def _unregister(self, fd):
+        # the kernel already forgot about closed descriptors
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError), e:
+            if e.args[0] not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def _poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            # epoll truncates to whole milliseconds as well, round up first
+            timeout = math.ceil(timeout * 1000) / 1000.
+        return self._translate(self._poller.poll(timeout))
+
+    def close(self):
+        BaseReactor.close(self)
+        self._poller.close()
+
+
+REACTORS = {}
+for reactor_class in (SelectReactor, PollReactor, EpollReactor):
+    if hasattr(select, reactor_class.name):
+        REACTORS[reactor_class.name] = reactor_class
+del reactor_class
+
+
+def get_reactor_class(name=None):
+    """Returns the reactor class called name, or the best one available."""
+    if name:
+        try:
+            return REACTORS[name]
+        except KeyError:
+            raise ValueError('no reactor %s on this system (have: %s)' % (
+                    name, REACTORS.keys()))
+    for name in ('epoll', 'poll', 'select'):
+        if REACTORS.has_key(name):
+            return REACTORS[name]
@@ -0,0 +1,397 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared memory transport for processes of the same host.
+
+A channel is a file (eg. under /dev/shm) mapped in memory by both processes,
+ holding 2 ring buffers: client to server and server to client. Each ring has
+ a single producer and a single consumer, so a channel serves one client at a
+ time (connecting clients lock the file).
+
+Bytes written to a ring are read by the other side without system call. A
+ named pipe per ring is used as doorbell: the producer writes to it only when
+ the consumer may be waiting for data, which makes the consumer's fileno()
+ readable for select(), poll() and the comm reactors.
+
+A control header in front of the rings tracks connections: each connecting
+ client gets a new generation number, and the stream offsets it starts from in
+ both rings. The server starts a new connection (see serve_channel() in comm)
+ when the generation changes, discarding what was left in the rings: the client
+ only reads replies once the server served its generation. Closing either end
+ sets its closed flag, which the other end reads as end of stream.
+
+ShmChannel mimics the subset of the socket interface used by the comm module,
+ so that handlers and clients work unchanged. Servers use the 'shm:' scheme:
+ ('', 'shm:/dev/shm/lighthead'), see comm.getBaseServerClass().
+"""
+
+import os
+import time
+import mmap
+import fcntl
+import errno
+import struct
+import socket
+
+RING_SIZE = 1 << 16             # bytes of data per direction
+SEND_TIMEOUT = 5.               # in s, sendall() without the consumer reading
+INDEX = struct.Struct('=Q')     # offsets from the start of the stream
+# generation of the client, its offset in ring 0, generation served by the
+#  server, its offset in ring 1, generation closed by the client, server closed
+CONTROL = struct.Struct('=6Q')
+GENERATION, CLIENT_START, SERVED, SERVER_START, CLIENT_CLOSED, SERVER_CLOSED = \
+    range(6)
+
+
+def _nonblocking_write(fd, data):
+    try:
+        os.write(fd, data)
+    except OSError, e:
+        # full pipe: the consumer has enough to wake up
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+class ShmRing(object):
+    """Single producer, single consumer ring of bytes in a memory map.
+    Header: bytes written so far (producer), bytes read so far (consumer).
+    """
+
+    HEADER_SIZE = 2 * INDEX.size
+
+    def __init__(self, mm, offset, capacity, bell_path):
+        self.mm = mm
+        self.head_at = offset
+        self.tail_at = offset + INDEX.size
+        self.data_at = offset + self.HEADER_SIZE
+        self.capacity = capacity
+        # read-write, so that opening never blocks nor fails without a reader
+        self.bell = os.open(bell_path, os.O_RDWR | os.O_NONBLOCK)
+
+    def _head(self):
+        return INDEX.unpack_from(self.mm, self.head_at)[0]
+
+    def _tail(self):
+        return INDEX.unpack_from(self.mm, self.tail_at)[0]
+
+    def readable(self):
+        """Number of bytes which can be read."""
+        return self._head() - self._tail()
+
+    def write(self, data):
+        """Writes as much of data as possible. Returns the number of bytes
+        written."""
+        head = self._head()
+        size = min(len(data), self.capacity - (head - self._tail()))
+        if size <= 0:
+            return 0
+        start = head % self.capacity
+        first = min(size, self.capacity - start)
+        self.mm[self.data_at+start:self.data_at+start+first] = data[:first]
+        if first < size:
+            self.mm[self.data_at:self.data_at+size-first] = data[first:size]
+        INDEX.pack_into(self.mm, self.head_at, head + size)
+        # the consumer read everything before us: it may be waiting
+        if self._tail() == head:
+            _nonblocking_write(self.bell, 'b')
+        return size
+
+    def read_into(self, buf, nbytes, offset=0):
+        """Copies up to nbytes to buf[offset:] (bytearray).
+        Returns the number of bytes read."""
+        tail = self._tail()
+        size = min(self._head() - tail, nbytes)
+        if size <= 0:
+            return 0
+        start = tail % self.capacity
+        first = min(size, self.capacity - start)
+        buf[offset:offset+first] = buffer(self.mm, self.data_at+start, first)
+        if first < size:
+            buf[offset+first:offset+size] = buffer(self.mm, self.data_at,
+                                                   size-first)
+        INDEX.pack_into(self.mm, self.tail_at, tail + size)
+        return size
+
+    def drain_bell(self):
+        try:
+            while os.read(self.bell, 512):
+                pass
+        except OSError, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def ring_bell(self):
+        _nonblocking_write(self.bell, 'b')
+
+    def skip(self, offset=None):
+        """Discards readable bytes (before offset, default: all)."""
+        if offset is None:
+            offset = self._head()
+        INDEX.pack_into(self.mm, self.tail_at, offset)
+
+    def close(self):
+        os.close(self.bell)
+
+
+class ShmChannel(object):
+    """Socket-like end of a shared memory channel.
+    The server create()s the channel, a client connect()s to it.
+    """
+
+    def __init__(self, ring_size=RING_SIZE):
+        self.ring_size = ring_size
+        self.path = None
+        self.mm = None
+        self.rx = self.tx = None
+        self.lock_fd = None
+        self.server = False
+        self.generation = 0             # connection we are an end of
+        self.served = False             # client: server serving generation
+        self.peer_closed = False        # server: client closed generation
+
+    def _map(self, path, server):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            size = os.fstat(fd).st_size
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        half = (size - CONTROL.size) / 2
+        self.ring_size = half - ShmRing.HEADER_SIZE
+        rings = [ ShmRing(self.mm, CONTROL.size + i*half, self.ring_size,
+                          '%s.%i' % (path, i)) for i in (0, 1) ]
+        # ring 0: client to server, ring 1: server to client
+        self.rx, self.tx = server and rings or rings[::-1]
+        self.path = path
+        self.server = server
+
+    def _get(self, field):
+        return INDEX.unpack_from(self.mm, field * INDEX.size)[0]
+
+    def _set(self, field, value):
+        INDEX.pack_into(self.mm, field * INDEX.size, value)
+
+    def create(self, path):
+        """Creates (or resets) the channel files."""
+        size = CONTROL.size + 2 * (ShmRing.HEADER_SIZE + self.ring_size)
+        f = open(path, 'wb')
+        f.write('\0' * size)
+        f.close()
+        for i in (0, 1):
+            bell = '%s.%i' % (path, i)
+            if os.path.exists(bell):
+                os.unlink(bell)
+            os.mkfifo(bell, 0600)
+        self._map(path, True)
+        self.reset()                    # no client (generation 0) yet
+
+    def reset(self):
+        """Server side: starts serving the last connected client, discarding
+        the data of previous connections. Maps the channel again if closed.
+        """
+        if self.mm is None:
+            self._map(self.path, True)
+        generation = self._get(GENERATION)
+        if generation != self.generation:
+            self.rx.skip(self._get(CLIENT_START))
+            self.generation = generation
+        else:
+            self.rx.skip()
+        self.peer_closed = generation == self._get(CLIENT_CLOSED)
+        self.rx.drain_bell()
+        self._set(SERVER_START, self.tx._head())
+        self._set(SERVED, generation)
+        if self.rx.readable():
+            self.rx.ring_bell()
+
+    def ended(self):
+        """Server side: True once the client served closed the channel or
+        another client connected."""
+        return self._get(GENERATION) != self.generation or \
+            (not self.peer_closed and
+             self._get(CLIENT_CLOSED) == self.generation)
+
+    def _check_served(self):
+        """Client side: True once the server serves us, skipping replies sent
+        to previous clients."""
+        if not self.served and self._get(SERVED) == self.generation:
+            self.rx.skip(self._get(SERVER_START))
+            self.served = True
+        return self.served
+
+    def peer_connected(self):
+        """False if the other end closed the channel (or a client died)."""
+        if not self.server:
+            return not self._get(SERVER_CLOSED)
+        if self.ended():
+            return False
+        # a client holds its lock until it closes or exits
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            return False
+        finally:
+            os.close(fd)
+
+    def unlink(self):
+        for name in (self.path, self.path+'.0', self.path+'.1'):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+    def connect(self, path):
+        """Client side: maps an existing channel.
+        Raises socket.error if the channel is missing or already in use."""
+        try:
+            self.lock_fd = os.open(path, os.O_RDONLY)
+        except OSError, e:
+            raise socket.error(errno.ECONNREFUSED, '%s: %s' % (path, e))
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(self.lock_fd)
+            raise socket.error(errno.EBUSY, '%s is used by another client' %
+                               path)
+        self._map(path, False)
+        if self._get(SERVER_CLOSED):
+            self.close()
+            raise socket.error(errno.ECONNREFUSED, '%s is closed' % path)
+        self.generation = self._get(GENERATION) + 1
+        self.served = False
+        self._set(CLIENT_START, self.tx._head())
+        self._set(GENERATION, self.generation)
+        self.tx.ring_bell()             # for the server to serve us
+
+    def connect_ex(self, path):
+        try:
+            self.connect(path)
+        except socket.error, e:
+            return e.args[0]
+        return 0
+
+    def fileno(self):
+        """Readable when data is available for recv_into()."""
+        if self.mm is None:
+            raise socket.error(errno.EBADF, 'channel is closed')
+        return self.rx.bell
+
+    def pending(self):
+        """Number of bytes available, without system call."""
+        if not self.server and not self._check_served():
+            return 0
+        return self.rx.readable()
+
+    def recv_into(self, buf, nbytes=0, flags=0):
+        """Returns 0 at the end of the connection (see the module's doc).
+        Raises socket.error (EAGAIN) if there is nothing to read."""
+        if self.mm is None:
+            raise socket.error(errno.EBADF, 'channel is closed')
+        self.rx.drain_bell()
+        if self.server:
+            if self.ended():
+                return 0
+        elif not self._check_served():
+            if self._get(SERVER_CLOSED):
+                return 0
+            raise socket.error(errno.EAGAIN, 'not served yet by %s' %
+                               self.path)
+        size = self.rx.read_into(buf, nbytes or len(buf))
+        if self.rx.readable():
+            # more than asked for: stay readable
+            self.rx.ring_bell()
+        if not size:
+            if not self.server and self._get(SERVER_CLOSED):
+                return 0
+            raise socket.error(errno.EAGAIN, 'no data in %s' % self.path)
+        return size
+
+    def recv(self, bufsize, flags=0):
+        buf = bytearray(bufsize)
+        return str(buf[:self.recv_into(buf, bufsize)])
+
+    def send(self, data, flags=0):
+        """Returns the number of bytes sent, raises socket.error (EAGAIN) if
+        the ring is full, EPIPE if the other end is gone."""
+        if self.mm is None:
+            raise socket.error(errno.EBADF, 'channel is closed')
+        size = self.tx.write(data)
+        if not size and data:
+            if not self.peer_connected():
+                raise socket.error(errno.EPIPE, '%s: peer is gone' % self.path)
+            raise socket.error(errno.EAGAIN, '%s is full' % self.path)
+        return size
+
+    def sendall(self, data, flags=0):
+        """Blocks until the consumer made room for all data.
+        Raises socket.error (EPIPE) if the other end is gone, socket.timeout
+         if it did not read for SEND_TIMEOUT seconds."""
+        if self.mm is None:
+            raise socket.error(errno.EBADF, 'channel is closed')
+        sent, deadline = 0, None
+        while sent < len(data):
+            size = self.tx.write(sent and data[sent:] or data)
+            if size:
+                sent, deadline = sent + size, None
+                continue
+            if not self.peer_connected():
+                raise socket.error(errno.EPIPE, '%s: peer is gone' % self.path)
+            if deadline is None:
+                deadline = time.time() + SEND_TIMEOUT
+            elif time.time() > deadline:
+                raise socket.timeout('%s: no room for %ss' % (self.path,
+                                                              SEND_TIMEOUT))
+            time.sleep(.0005)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def getsockopt(self, level, option, buflen=0):
+        return 0
+
+    def shutdown(self, how):
+        """Sets our closed flag, read by the other end as end of stream."""
+        if self.mm is None:
+            return
+        if self.server:
+            self._set(SERVER_CLOSED, 1)
+        else:
+            self._set(CLIENT_CLOSED, self.generation)
+        self.tx.ring_bell()
+
+    def close(self):
+        """Closes our end, a client's also shuts the connection down (the
+        server keeps the channel open for the next client, see reset())."""
+        if self.mm is None:
+            return
+        if not self.server:
+            self.shutdown(socket.SHUT_RDWR)
+        self.rx.close()
+        self.tx.close()
+        self.mm.close()
+        self.mm = None
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
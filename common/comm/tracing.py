@@ -0,0 +1,163 @@
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lightweight latency tracing.
+
+Trace points record durations (from a monotonic clock) into histograms with
+ power of 2 buckets of microseconds: recording is a few operations and memory
+ is fixed, so tracing can stay enabled in production. Histograms are read with
+ the 'stats' command of request handlers (see comm.RequestHandler).
+
+A transaction (eg. an AU commit) gets an ID from new_transaction() and carries
+ the time its command was received (see received()) through the pipeline.
+ Completed transactions are kept in TRACER.recent with the time of each stage.
+
+ t = tracing.monotonic()
+ ...
+ tracing.record('stage name', tracing.monotonic() - t)
+"""
+
+import time
+import math
+import itertools
+import threading
+import collections
+
+BUCKETS = 32            # bucket i: [2**(i-1), 2**i[ microseconds, up to ~35min
+RECENT = 64             # completed transactions kept
+
+try:
+    import ctypes, ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                         ctypes.util.find_library('c'), use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        """Seconds from an arbitrary point, never going backwards."""
+        ts = _timespec()                # per call: shared by all threads else
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)):
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    monotonic()
+except (ImportError, AttributeError, OSError, TypeError):
+    monotonic = time.time       # no clock_gettime (eg. Windows)
+
+
+class Histogram(object):
+    """Counts of durations by power of 2 of microseconds."""
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        """duration: in seconds."""
+        us = int(duration * 1e6)
+        bucket = us > 0 and min(int(math.log(us, 2)) + 1, BUCKETS-1) or 0
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.
+
+    def percentile(self, p):
+        """Upper bound (in seconds) of the bucket holding the p-th percentile
+        (p between 0 and 1)."""
+        rank, seen = p * self.count, 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(2**bucket * 1e-6, self.max)
+        return self.max
+
+
+class Tracer(object):
+    """Histograms by trace point name, and recent transactions.
+    enabled: if False, record() does nothing.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.histograms = {}
+        self.recent = collections.deque(maxlen=RECENT)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, name, duration):
+        if not self.enabled:
+            return
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            self._lock.acquire()
+            histogram = self.histograms.setdefault(name, Histogram(name))
+            self._lock.release()
+        histogram.record(duration)
+
+    def received(self, timestamp=None):
+        """Marks the arrival of commands processed by this thread."""
+        self._local.received = timestamp or monotonic()
+
+    def last_received(self):
+        """Returns the arrival time of the commands being processed by this
+        thread, or now."""
+        return getattr(self._local, 'received', None) or monotonic()
+
+    def new_transaction(self):
+        """Returns (ID, arrival time) for a transaction started by the
+        commands being processed."""
+        return self._ids.next(), self.last_received()
+
+    def complete(self, transaction_id, stages):
+        """Keeps a completed transaction.
+        stages: [ (stage name, monotonic time) ]"""
+        self.recent.append((transaction_id, stages))
+
+    def reset(self):
+        self._lock.acquire()
+        self.histograms.clear()
+        self.recent.clear()
+        self._lock.release()
+
+    def get_stats(self):
+        """Returns histograms sorted by name."""
+        return [ self.histograms[name] for name in
+                 sorted(self.histograms.keys()) ]
+
+
+TRACER = Tracer()
+record = TRACER.record
+received = TRACER.received
+new_transaction = TRACER.new_transaction
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# Lighthead-bot programm is a HRI PhD project at the University of Plymouth,
+#  a Robotic Animation System including face, eyes, head and other
+#  supporting algorithms for vision and basic emotions.
+# Copyright (C) 2010 Frederic Delaunay, frederic.delaunay@plymouth.ac.uk
+
+#  This program is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for the comm module.
+
+Run with the common and HRI directories in your PYTHONPATH (see
+ source_me_to_set_env.sh), eg:
+ $ python comm_bench.py tick
+The recv benchmark needs the face module, with the headless backend unless
+ FACE_BACKEND is set (see face/headless.py).
+"""
+
+import os
+import time
+import socket
+import threading
+import logging
+import optparse
+
+import comm
+from comm import reactor
+
+os.environ.setdefault('FACE_BACKEND', 'headless')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values)*p), len(values)-1)]
+
+
+class BenchServer(object):
+    pass
+
+class BenchHandler(object):
+    def cmd_ping(self, argline):
+        pass
+
+
+def bench_tick(options):
+    """Tick latency of serve_once() with 1 active client among n idle ones."""
+    print '%8s %8s %12s %12s' % ('reactor', 'clients', 'mean (us)', 'p99 (us)')
+    for name in sorted(reactor.REACTORS.keys()):
+        for n in options.clients:
+            server = comm.create_server(BenchServer, BenchHandler,
+                                        ('localhost', 0), (False, False))
+            server.set_reactor_class(name)
+            server.start()
+            clients = []
+            for i in xrange(n):
+                sock = socket.create_connection(server.addr_port)
+                clients.append(sock)
+                server.serve_once()
+            while len(server.clients) < n:
+                server.serve_once()
+            active = clients[0]
+            timings = []
+            for i in xrange(options.ticks):
+                active.send('ping\n')
+                t = time.time()
+                server.serve_once()
+                timings.append(time.time() - t)
+            for sock in clients:
+                sock.close()
+            server.shutdown()
+            print '%8s %8i %12.1f %12.1f' % (name, n,
+                                            sum(timings)/len(timings)*1e6,
+                                            percentile(timings, .99)*1e6)
+
+
+def bench_recv(options):
+    """Throughput of AU lines streamed through FaceComm, by recv size."""
+    try:
+        from face import Face, FaceComm, AREAS
+    except ImportError, e:
+        print 'recv: cannot import the face module (%s)' % e
+        return
+    face = Face()
+    face.set_available_AUs(AREAS['face'])
+    handler_class = comm.create_RequestHandlerClass(FaceComm)
+    names, lines = AREAS['face'], []
+    for i in xrange(options.lines):
+        lines.append('AU %s %.3f %.3f\n' % (names[i % len(names)],
+                                             (i % 100) / 100., .2))
+        if i % 50 == 49:
+            lines.append('commit\n')
+    data = ''.join(lines)
+
+    print '%10s %10s %12s %12s' % ('recv size', 'lines', 'time (s)', 'lines/s')
+    for size in options.recv_sizes:
+        producer, consumer = socket.socketpair()
+        handler = handler_class(face, consumer, ('localhost', 'bench'))
+        handler.set_recv_size(size)
+        sender = threading.Thread(target=lambda: (producer.sendall(data),
+                                                  producer.close()))
+        t = time.time()
+        sender.start()
+        while handler.read_socket():
+            pass
+        t = time.time() - t
+        sender.join()
+        print '%10i %10i %12.3f %12.0f' % (size, options.lines, t,
+                                           options.lines/t)
+
+
+BENCHES = { 'tick' : bench_tick,
+            'recv' : bench_recv }
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] '+
+                                   '|'.join(sorted(BENCHES.keys())))
+    parser.add_option('-n', '--clients', dest='clients',
+                      default='1,10,50,100,500',
+                      help='comma separated numbers of connected clients')
+    parser.add_option('-t', '--ticks', dest='ticks', type='int', default=2000,
+                      help='number of measured serve_once() calls')
+    parser.add_option('-l', '--lines', dest='lines', type='int',
+                      default=100000, help='number of streamed AU lines')
+    parser.add_option('-r', '--recv-sizes', dest='recv_sizes',
+                      default='1024,4096,65536',
+                      help='comma separated recv sizes')
+    options, args = parser.parse_args()
+    options.clients = [ int(n) for n in options.clients.split(',') ]
+    options.recv_sizes = [ int(n) for n in options.recv_sizes.split(',') ]
+    logging.basicConfig(level=logging.WARNING, format=comm.LOGFORMAT)
+    for name in args or sorted(BENCHES.keys()):
+        if not BENCHES.has_key(name):
+            parser.error('unknown benchmark: %s' % name)
+        BENCHES[name](options)
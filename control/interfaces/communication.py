@@ -1,18 +1,26 @@
 # communication.py
 
-import threading, time, socket
+import threading, socket
 import comm, config
 
 if hasattr(config, 'DEBUG') and config.DEBUG:
     comm.set_default_logging(debug=config.DEBUG)
 LOG = comm.LOG
 
-class CommBase(comm.BaseClient):
-    
+REPLY_TIMEOUT = 5.      # in s, before a tagged message's reply is given up
+
+class CommBase(comm.AsyncBaseClient):
+    """All instances share the default event loop, running in its own thread.
+
+    Messages end with a tag, which the expression server sends back in its
+     ACK or NACK. send_tagged() returns a comm.Future set by that reply, so
+     callers can block with a timeout (future.result(timeout)) or attach a
+     callback (future.add_done_callback(fct)) instead of polling last_ack.
+     Any number of tagged messages can be outstanding on a connection.
+    """
+
     def __init__(self, server_addrPort):
-        comm.BaseClient.__init__(self, server_addrPort)
-        self.set_timeout(5)
-        threading.Thread(target=self.connect_and_run).start()
+        comm.AsyncBaseClient.__init__(self, server_addrPort)
 
         # information blocks
         self.last_ack = None
@@ -21,6 +29,13 @@ class CommBase(comm.BaseClient):
         self.gaze_info = None
         self.face_info = None
 
+        self.replies = {}               # { tag : [Future] }
+        self.replies_lock = threading.Lock()
+        self.tag_count = 0
+
+        self.loop.start()
+        self.connect()
+
     def handle_connect(self):
         """Callback for sucessful connection.
         Inits communication and set robot on origin"""
@@ -40,14 +55,95 @@ class CommBase(comm.BaseClient):
         if self.connected:
 #            import pdb; pdb.set_trace()
 #            LOG.debug("sending to %s: '%s'", self.target_addr, msg)
-            return comm.BaseClient.send_msg(self, msg)
+            return comm.AsyncBaseClient.send_msg(self, msg)
         LOG.debug("*NOT* sending to %s: '%s'", self.target_addr, msg)
 
+    def new_tag(self, name):
+        """Returns a tag unique to this connection: tag_<name>_<number>"""
+        self.replies_lock.acquire()
+        self.tag_count += 1
+        tag = 'tag_%s_%i' % (name, self.tag_count)
+        self.replies_lock.release()
+        return tag
+
+    def send_tagged(self, msg, tag, timeout=REPLY_TIMEOUT):
+        """Sends msg;tag. Safe from any thread.
+        Returns a comm.Future set to (command, argline) by the ACK or NACK of
+         tag (see expect_reply).
+        """
+        future = self.expect_reply(tag, timeout)
+        if not future.done():
+            self.send_msg('%s;%s' % (msg, tag))
+        return future
+
+    def expect_reply(self, tag, timeout=REPLY_TIMEOUT):
+        """Returns a comm.Future set to (command, argline) by the next ACK or
+         NACK which argline starts with tag. Replies to messages sharing the
+         same tag are matched in order.
+        timeout: seconds after which the future fails with comm.TimeoutError
+         and stops waiting (None: until the reply or disconnection).
+        """
+        future = comm.Future(self.loop)
+        if not self.connected:
+            LOG.debug("*NOT* waiting for %s from %s", tag, self.target_addr)
+            future.set_exception(comm.ProtocolError('not connected'))
+            return future
+        self.replies_lock.acquire()
+        self.replies.setdefault(tag, []).append(future)
+        self.replies_lock.release()
+        if timeout is not None:
+            self.loop.add_timer(timeout, self._expire, tag, future)
+        return future
+
+    def _expire(self, tag, future):
+        if self._forget(tag, future):
+            future.set_exception(comm.TimeoutError('no reply for %s' % tag))
+
+    def _forget(self, tag, future):
+        """Returns False if future was not waiting for a reply anymore."""
+        self.replies_lock.acquire()
+        try:
+            futures = self.replies.get(tag, [])
+            if future not in futures:
+                return False
+            futures.remove(future)
+            if not futures:
+                del self.replies[tag]
+            return True
+        finally:
+            self.replies_lock.release()
+
+    def _reply(self, command, argline):
+        """Sets the oldest future waiting for the tag in argline."""
+        tag = argline.split(None, 1)
+        if not tag:
+            return
+        self.replies_lock.acquire()
+        futures = self.replies.get(tag[0])
+        future = futures and futures.pop(0)
+        if futures == []:
+            del self.replies[tag[0]]
+        self.replies_lock.release()
+        if future:
+            future.set_result((command, argline))
+
+    def close(self):
+        """Fails the futures still waiting for a reply."""
+        comm.AsyncBaseClient.close(self)
+        self.replies_lock.acquire()
+        replies, self.replies = self.replies, {}
+        self.replies_lock.release()
+        for futures in replies.itervalues():
+            for future in futures:
+                future.set_exception(comm.ProtocolError('disconnected'))
+
     def cmd_ACK(self, argline):
         self.last_ack = argline
+        self._reply('ACK', argline)
     
     def cmd_NACK(self, argline):
         self.last_nack = argline
+        self._reply('NACK', argline)
         
     def cmd_INT(self, argline):
         print argline
@@ -73,21 +169,50 @@ class CommBase(comm.BaseClient):
         else:
             neck = (neck[0] and '(%s)' % str(neck[0])[1:-1] or '') + \
                 (neck[1] and '[%s]' % str(neck[1])[1:-1] or '')
-        try:
-            self.send_msg(";;;'';%s;%s;tag_NECK_GAZE" % (str(gaze)[1:-1],
-                                                         neck))
-        except socket.error:
-            self.handle_disconnect()
+        return self.send_tagged(";;;'';%s;%s" % (str(gaze)[1:-1], neck),
+                                'tag_NECK_GAZE')
+
+    def set_neck_orientation(self, orientation, tag=None):
+        """Sends a neck orientation, eg. '(0,0,0)'.
+        Returns the future of the reply to tag_NK_OR_<tag> (see send_tagged).
+        """
+        tag = tag is None and self.new_tag('NK_OR') or 'tag_NK_OR_'+str(tag)
+        return self.send_tagged(";;;'';;%s" % orientation, tag)
+
+    def set_gaze(self, gaze, tag=None):
+        """Sends a gaze focal point, eg. '0,0.5,0'.
+        Returns the future of the reply to tag_GAZE_<tag> (see send_tagged).
+        """
+        tag = tag is None and self.new_tag('GAZE') or 'tag_GAZE_'+str(tag)
+        return self.send_tagged(";;;'';%s;" % gaze, tag)
 
     def set_expression(self, activity='*', expression="neutral", intensity=0):
+        return self.send_tagged("%s;%s;%i;'';;" % (activity, expression,
+                                                   intensity),
+                                'tag_FEXPRESSION')
+
+    def get_snapshot(self, timeout=1):
+        """Waits for the lightHead server's snapshot (up to timeout seconds).
+        """
         try:
-            self.send_msg("%s;%s;%i;'';;;tag_FEXPRESSION" % (activity,
-                                                             expression,
-                                                             intensity))
-        except socket.error:
-            self.handle_disconnect()
-
-    def get_snapshot(self):
-        self.send_msg("get_snapshot")
-        time.sleep(0.1)
+            self.request("get_snapshot", "end_snapshot").result(timeout)
+        except (comm.TimeoutError, comm.ProtocolError), e:
+            LOG.warning("no snapshot from %s: %s", self.target_addr, e)
         return (self.lips_info, self.gaze_info, self.face_info)
+
+    def subscribe(self, features=(), rate=None):
+        """Asks the lightHead server to push features (default: all) when
+        they change, at most rate times per second. Updates set the same
+        information blocks as get_snapshot().
+        Returns a future for the server's ACK or NACK."""
+        future = self.expect_reply('subscribe')
+        self.send_msg(' '.join(['subscribe'] + list(features) +
+                               (rate and [str(rate)] or [])))
+        return future
+
+    def unsubscribe(self):
+        """Stops the pushes of the lightHead server.
+        Returns a future for the server's ACK (or NACK if not subscribed)."""
+        future = self.expect_reply('unsubscribe')
+        self.send_msg("unsubscribe")
+        return future
@@ -24,7 +24,10 @@
 import sys, os, threading, time, random, math, optparse
 import communication, vision, agent, inout, config, conf
 
-LOG = communication.comm.LOG
+comm = communication.comm
+LOG = comm.LOG
+
+ACK_TIMEOUT = 5         # seconds to wait for the expression server's replies
 
 
 def main():
@@ -204,13 +207,16 @@ class RobotControl(threading.Thread):
             
             for x, i in enumerate(sequence):
                 time.sleep( random.randrange(0, 500, 1)/500.0 )
-                self.comm.set_neck_orientation(str(i), str(x))
+                reply = self.comm.set_neck_orientation(str(i), str(x))
 #                x_gaze = random.randrange(0,30,1)/100.0
 #                y_gaze = random.randrange(0,30,1)/100.0
 #                z_gaze = random.randrange(0,30,1)/100.0
 #                set_gaze(str(x_gaze) + "," + str(y_gaze) + "," str(z_gaze))
-                while self.comm.last_ack != "tag_NK_OR_" + str(x):
-                    pass # wait for acknowledgement
+                try:
+                    reply.result(ACK_TIMEOUT)   # wait for acknowledgement
+                except (comm.TimeoutError, comm.ProtocolError), e:
+                    LOG.warning("neck orientation %s not acknowledged: %s",
+                                x, e)
                     
         
     def find_face(self):